@@ -1,14 +1,28 @@
 import io
 import json
+import logging
 import os
-import shutil
 import uuid
 from functools import wraps
 
 try:
-    from convert import convert_cis_to_attack, combine_results
-    from utils import find_file, ClientException, validate_user_json
+    from convert import convert_cis_to_attack, combine_results, \
+        get_mapping, preload_mapping, get_mapping_load_seconds, \
+        mapping_registry, Mapping, EX_MAP, SHEET_NAME, DEFAULT_MAPPING
+    from utils import ClientException, validate_user_json, \
+        validate_retention_json
+    from storage import find_file, find_files, read_report, store_blob, \
+        hash_content, make_blob_path, upload_dir_path, \
+        start_background_migration
+    from retention import run_retention, start_retention_schedule
+    from cli import register_cli
+    from logs import configure_logging, register_request_id
+    from timing import register_timing, timed
+    from metrics import register_metrics
+    from profiling import register_profiling, list_profiles, \
+        find_profile, PROFILERS
     from db.db import initialize_db
+    from db.db_stats import register_query_stats
     from db.db_methods import get_metadata, get_user_departments, \
         get_all_departments_with_access, get_department_by_name, \
         create_department, delete_department, \
@@ -16,12 +30,31 @@ try:
         add_user_to_department, remove_user_from_department, \
         get_bearer_token_by_token, update_bearer_token_last_used, \
         create_bearer_token, verify_bearer_token_access, \
-        revoke_bearer_token, get_bearer_tokens_for_departments
+        revoke_bearer_token, get_bearer_tokens_for_departments, \
+        acquire_report_blob, get_storage_usage, get_retention_policies, \
+        set_retention_policy, delete_retention_policy
     from db.db_utils import extract_metadata
+    from db.models import BearerToken
+    from db.db_cache import QueryCache, ensure_cache_generation, \
+        bump_cache_generation
 except ImportError:
-    from .convert import convert_cis_to_attack, combine_results
-    from .utils import find_file, ClientException, validate_user_json
+    from .convert import convert_cis_to_attack, combine_results, \
+        get_mapping, preload_mapping, get_mapping_load_seconds, \
+        mapping_registry, Mapping, EX_MAP, SHEET_NAME, DEFAULT_MAPPING
+    from .utils import ClientException, validate_user_json, \
+        validate_retention_json
+    from .storage import find_file, find_files, read_report, store_blob, \
+        hash_content, make_blob_path, upload_dir_path, \
+        start_background_migration
+    from .retention import run_retention, start_retention_schedule
+    from .cli import register_cli
+    from .logs import configure_logging, register_request_id
+    from .timing import register_timing, timed
+    from .metrics import register_metrics
+    from .profiling import register_profiling, list_profiles, \
+        find_profile, PROFILERS
     from .db.db import initialize_db
+    from .db.db_stats import register_query_stats
     from .db.db_methods import get_metadata, get_user_departments, \
         get_all_departments_with_access, get_department_by_name, \
         create_department, delete_department, \
@@ -29,8 +62,13 @@ except ImportError:
         add_user_to_department, remove_user_from_department, \
         get_bearer_token_by_token, update_bearer_token_last_used, \
         create_bearer_token, verify_bearer_token_access, \
-        revoke_bearer_token, get_bearer_tokens_for_departments
+        revoke_bearer_token, get_bearer_tokens_for_departments, \
+        acquire_report_blob, get_storage_usage, get_retention_policies, \
+        set_retention_policy, delete_retention_policy
     from .db.db_utils import extract_metadata
+    from .db.models import BearerToken
+    from .db.db_cache import QueryCache, ensure_cache_generation, \
+        bump_cache_generation
 
 
 from flask import Flask, request, send_file, Response, g
@@ -38,6 +76,11 @@ from flask.cli import load_dotenv
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import HTTPException
 
+logger = logging.getLogger('api.app')
+
+# Version of the mapping a converted layer was made with
+MAPPING_VERSION_HEADER = 'X-Mapping-Version'
+
 
 def create_app(config=None):
     """Application factory pattern"""
@@ -77,10 +120,124 @@ def create_app(config=None):
     )
     app.config["SQLALCHEMY_ECHO"] = False
 
+    # Connection pool options, only passed on when set since
+    # in-memory SQLite databases do not use a pool
+    engine_options = {}
+    for option, env_var, parse in [
+        ('pool_size', 'DB_POOL_SIZE', int),
+        ('max_overflow', 'DB_MAX_OVERFLOW', int),
+        ('pool_timeout', 'DB_POOL_TIMEOUT', float),
+        ('pool_recycle', 'DB_POOL_RECYCLE', int),
+        ('pool_pre_ping', 'DB_POOL_PRE_PING',
+         lambda v: v.strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'})
+    ]:
+        if os.getenv(env_var):
+            engine_options[option] = parse(os.getenv(env_var))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
+    # Pragmas applied to every SQLite connection so multiple workers
+    # can share one database file without "database is locked" errors
+    app.config['SQLITE_JOURNAL_MODE'] = os.getenv('SQLITE_JOURNAL_MODE',
+                                                  'WAL')
+    app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS',
+                                                 'NORMAL')
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(
+        os.getenv('SQLITE_BUSY_TIMEOUT', 30000)  # milliseconds
+    )
+    app.config['SQLITE_MMAP_SIZE'] = int(
+        os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)  # bytes
+    )
+
+    # Maximum number of cached /api/files results per worker, 0 disables it
+    app.config['QUERY_CACHE_SIZE'] = int(os.getenv('QUERY_CACHE_SIZE', 256))
+    # Maximum number of converted reports cached per worker, 0 disables it
+    app.config['CONVERSION_CACHE_SIZE'] = int(
+        os.getenv('CONVERSION_CACHE_SIZE', 64)
+    )
+    # Totals above this are estimated when requested with count=estimate
+    app.config['APPROX_COUNT_THRESHOLD'] = int(
+        os.getenv('APPROX_COUNT_THRESHOLD', 10000)
+    )
+
+    # Load the mapping on startup instead of on the first conversion
+    app.config['PRELOAD_MAPPING'] = os.getenv(
+        'PRELOAD_MAPPING', 'False'
+    ).strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'}
+
+    # The ATT&CK mapping, and how often in seconds to check it for changes
+    # which are then loaded without a restart, 0 disables the checks
+    app.config['MAPPING_FILE'] = os.getenv('MAPPING_FILE', EX_MAP)
+    app.config['MAPPING_SHEET'] = os.getenv('MAPPING_SHEET', SHEET_NAME)
+    app.config['MAPPING_CHECK_SECONDS'] = float(
+        os.getenv('MAPPING_CHECK_SECONDS', 60)
+    )
+    # Other mappings selectable per request with ?mapping=<name>, given as
+    # name=file or name=file|sheet separated by ';'
+    app.config['MAPPINGS'] = {}
+    for entry in os.getenv('MAPPINGS', '').split(';'):
+        name, _, source = entry.partition('=')
+        if name.strip() and source.strip():
+            filename, _, sheet_name = source.partition('|')
+            app.config['MAPPINGS'][name.strip()] = (
+                filename.strip(), sheet_name.strip() or SHEET_NAME
+            )
+    # Megabytes the compiled mappings may take per worker before the
+    # least recently used ones are freed
+    app.config['MAPPING_MEMORY_MB'] = float(
+        os.getenv('MAPPING_MEMORY_MB', 32)
+    )
+
+    # Move uploads from the old flat layout in a background thread
+    app.config['MIGRATE_UPLOADS'] = os.getenv(
+        'MIGRATE_UPLOADS', 'False'
+    ).strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'}
+
+    # Start the migration and retention threads in create_app, gunicorn
+    # turns this off when preloading and starts them after forking instead
+    app.config['START_BACKGROUND_TASKS'] = os.getenv(
+        'START_BACKGROUND_TASKS', 'True'
+    ).strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'}
+
+    # Hours between applying the retention policies, 0 disables it
+    app.config['RETENTION_INTERVAL_HOURS'] = float(
+        os.getenv('RETENTION_INTERVAL_HOURS', 0)
+    )
+    # Rebuild the database file after the retention policies deleted reports
+    app.config['RETENTION_VACUUM'] = os.getenv(
+        'RETENTION_VACUUM', 'False'
+    ).strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'}
+
+    # Report how long the phases of each request take
+    app.config['REQUEST_TIMING'] = os.getenv(
+        'REQUEST_TIMING', 'False'
+    ).strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'}
+
+    # Log statements taking longer than this, 0 disables the log
+    app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 0))
+
+    # Serve metrics at /metrics, shared between workers through METRICS_DIR
+    app.config['METRICS_ENABLED'] = os.getenv(
+        'METRICS_ENABLED', 'False'
+    ).strip().lower() in {'1', 'true', 't', 'yes', 'y', 'on'}
+    app.config['METRICS_DIR'] = os.getenv('METRICS_DIR')
+
+    # Log level of the application, and JSON lines unless LOG_FORMAT=text
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+    app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'json').strip().lower()
+    # Share of requests whose per-request info and debug lines are logged
+    app.config['LOG_SAMPLE_RATE'] = float(os.getenv('LOG_SAMPLE_RATE', 1))
+
+    # Super admins can profile single requests, saved to PROFILE_DIR
+    app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR')
+    # Number of saved profiles kept, older ones are removed
+    app.config['PROFILE_KEEP'] = int(os.getenv('PROFILE_KEEP', 20))
+
     # Apply any additional configuration
     if config:
         app.config.update(config)
 
+    configure_logging(app)
+
     # Ensure upload folder exists
     upload_folder = app.config['UPLOAD_FOLDER']
     if not os.path.exists(upload_folder):
@@ -90,20 +247,67 @@ def create_app(config=None):
     db = initialize_db(app)
     app.db = db  # Store db instance on app for easy access
 
-    # Register routes
+    with app.app_context():
+        ensure_cache_generation()
+    if app.config['QUERY_CACHE_SIZE'] > 0:
+        app.extensions['query_cache'] = QueryCache(
+            app.config['QUERY_CACHE_SIZE']
+        )
+    if app.config['CONVERSION_CACHE_SIZE'] > 0:
+        app.extensions['conversion_cache'] = QueryCache(
+            app.config['CONVERSION_CACHE_SIZE']
+        )
+
+    # Register routes, timing first so it covers the other request hooks
+    # and after the request id so its log line carries the id
+    register_request_id(app)
+    register_timing(app)
+    register_query_stats(app, db)
+    register_metrics(app, get_mapping_load_seconds)
     register_routes(app)
+    register_profiling(app)
     register_error_handlers(app)
+    register_cli(app)
+
+    mapping_registry.configure(
+        {DEFAULT_MAPPING: (app.config['MAPPING_FILE'],
+                           app.config['MAPPING_SHEET']),
+         **app.config['MAPPINGS']},
+        DEFAULT_MAPPING,
+        app.config['MAPPING_CHECK_SECONDS'],
+        int(app.config['MAPPING_MEMORY_MB'] * 1024 * 1024)
+    )
+    if app.config['PRELOAD_MAPPING']:
+        preload_mapping()
+    if app.config['START_BACKGROUND_TASKS']:
+        start_background_tasks(app)
 
     return app
 
 
+def start_background_tasks(app) -> None:
+    """Start the upload migration and retention threads if configured."""
+    if app.config['MIGRATE_UPLOADS']:
+        start_background_migration(app)
+    if app.config['RETENTION_INTERVAL_HOURS'] > 0:
+        start_retention_schedule(app)
+
+
 def register_routes(app):
     """Register all routes with the app"""
     upload_folder = app.config['UPLOAD_FOLDER']
     db = app.db
+    conversion_cache = app.extensions.get('conversion_cache')
+    metrics = app.extensions.get('metrics')
 
     @app.before_request
     def before_request():
+        mapping_registry.check()
+        with timed('auth'):
+            authenticate()
+
+    def authenticate():
+        """Identify the user of a request by bearer token or SSO headers"""
         auth_header = request.headers.get('Authorization')
         if auth_header and auth_header.startswith('Bearer '):
             token_str = auth_header[7:]  # Remove 'Bearer ' prefix
@@ -218,10 +422,8 @@ def register_routes(app):
             tokens = get_bearer_tokens_for_departments(department_ids)
 
             return {
-                'tokens': [
-                    # the token field is hidden by default
-                    token.to_dict() for token in tokens
-                ],
+                # the token field is hidden by default
+                'tokens': BearerToken.to_dicts(tokens),
                 'departments': [
                     {
                         'id': dept.id,
@@ -230,8 +432,8 @@ def register_routes(app):
                     for dept in departments
                 ]
             }, 200
-        except Exception as e:
-            print(f"Error fetching bearer tokens: {e}")
+        except Exception:
+            logger.exception("Error fetching bearer tokens")
             return {'message': 'Error fetching bearer tokens'}, 500
 
     @app.post('/api/admin/bearer-tokens', strict_slashes=False)
@@ -277,8 +479,8 @@ def register_routes(app):
 
         except ValueError:
             return {'message': 'Invalid department ID'}, 400
-        except Exception as e:
-            print(f"Error creating bearer token: {e}")
+        except Exception:
+            logger.exception("Error creating bearer token")
             db.session.rollback()
             return {'message': 'Error creating bearer token'}, 500
 
@@ -302,8 +504,8 @@ def register_routes(app):
             else:
                 return {'message': 'Token not found'}, 404
 
-        except Exception as e:
-            print(f"Error revoking bearer token: {e}")
+        except Exception:
+            logger.exception("Error revoking bearer token")
             db.session.rollback()
             return {'message': 'Error revoking bearer token'}, 500
 
@@ -329,10 +531,163 @@ def register_routes(app):
                     for dept in departments
                 ]
             }, 200
-        except Exception as e:
-            print(f"Error fetching departments: {e}")
+        except Exception:
+            logger.exception("Error fetching departments")
             return {'message': 'Error fetching departments'}, 500
 
+    @app.get('/api/admin/storage', strict_slashes=False)
+    @require_admin
+    def api_get_storage_usage():
+        """
+        Get the storage used per department and how much is saved
+        by keeping identical reports only once.
+        """
+        try:
+            departments = get_all_departments_with_access(
+                g.current_user,
+                g.is_super_admin
+            )
+            usage = get_storage_usage([dept.id for dept in departments])
+            empty = {
+                'reports': 0,
+                'unique_reports': 0,
+                'logical_bytes': 0,
+                'stored_bytes': 0,
+                'saved_bytes': 0,
+            }
+
+            return {
+                'departments': [
+                    {
+                        'id': dept.id,
+                        'name': dept.name,
+                        **usage.get(dept.id, empty)
+                    }
+                    for dept in departments
+                ]
+            }, 200
+        except Exception:
+            logger.exception("Error fetching storage usage")
+            return {'message': 'Error fetching storage usage'}, 500
+
+    @app.get('/api/admin/retention', strict_slashes=False)
+    @require_admin
+    def api_get_retention_policies():
+        """Get the retention policies of the departments the user manages"""
+        try:
+            departments = get_all_departments_with_access(
+                g.current_user,
+                g.is_super_admin
+            )
+            policies = get_retention_policies(
+                [dept.id for dept in departments]
+            )
+            return {
+                'policies': [
+                    {
+                        'department_id': policy.department_id,
+                        'max_age_days': policy.max_age_days,
+                        'max_reports_per_host': policy.max_reports_per_host,
+                    }
+                    for policy in policies
+                ]
+            }, 200
+        except Exception:
+            logger.exception("Error fetching retention policies")
+            return {'message': 'Error fetching retention policies'}, 500
+
+    @app.get('/api/admin/retention/preview', strict_slashes=False)
+    @require_super_admin
+    def api_preview_retention():
+        """
+        Get how many reports the retention policies would delete
+        per department if applied now (super admin only)
+        """
+        try:
+            report = run_retention(app.config['UPLOAD_FOLDER'],
+                                   dry_run=True)
+            if report is None:
+                return {
+                    'message': 'Another maintenance job is running'
+                }, 409
+            return {'departments': report}, 200
+        except Exception:
+            logger.exception("Error previewing retention")
+            return {'message': 'Error previewing retention'}, 500
+
+    @app.put('/api/admin/retention/<int:department_id>')
+    @require_super_admin
+    def api_set_retention_policy(department_id):
+        """Set the retention policy of a department (super admin only)"""
+        max_age_days, max_reports_per_host = validate_retention_json(
+            request.get_json(silent=True)
+        )
+
+        try:
+            if not get_department(department_id):
+                return {'message': 'Department not found'}, 404
+
+            policy = set_retention_policy(department_id, max_age_days,
+                                          max_reports_per_host)
+            return {
+                'policy': {
+                    'department_id': policy.department_id,
+                    'max_age_days': policy.max_age_days,
+                    'max_reports_per_host': policy.max_reports_per_host,
+                }
+            }, 200
+        except Exception:
+            logger.exception("Error setting retention policy")
+            db.session.rollback()
+            return {'message': 'Error setting retention policy'}, 500
+
+    @app.delete('/api/admin/retention/<int:department_id>')
+    @require_super_admin
+    def api_delete_retention_policy(department_id):
+        """
+        Remove the retention policy of a department,
+        its reports are kept indefinitely again (super admin only)
+        """
+        try:
+            if delete_retention_policy(department_id):
+                return {'message': 'Retention policy deleted'}, 200
+            else:
+                return {'message': 'Retention policy not found'}, 404
+        except Exception:
+            logger.exception("Error deleting retention policy")
+            db.session.rollback()
+            return {'message': 'Error deleting retention policy'}, 500
+
+    @app.get('/api/admin/profiles', strict_slashes=False)
+    @require_super_admin
+    def api_get_profiles():
+        """Get the saved request profiles, newest first (super admin only)"""
+        try:
+            return {
+                'profiles': list_profiles(app.config['PROFILE_DIR'])
+            }, 200
+        except Exception:
+            logger.exception("Error fetching profiles")
+            return {'message': 'Error fetching profiles'}, 500
+
+    @app.get('/api/admin/profiles/<profile_id>')
+    @require_super_admin
+    def api_get_profile(profile_id):
+        """
+        Download the stats file of a saved profile, or a readable
+        summary of it with `format=text` (super admin only)
+        """
+        found = find_profile(app.config['PROFILE_DIR'], profile_id)
+        if found is None:
+            return {'message': 'Profile not found'}, 404
+        profile, path = found
+        profiler = PROFILERS[profile['kind']]
+
+        if request.args.get('format') == 'text':
+            return Response(profiler.summary(path), mimetype='text/plain')
+        return send_file(path, as_attachment=True,
+                         download_name=os.path.basename(path))
+
     @app.post('/api/admin/departments', strict_slashes=False)
     @require_super_admin
     def api_create_department():
@@ -359,8 +714,8 @@ def register_routes(app):
                     'name': department.name,
                 }
             }, 201
-        except Exception as e:
-            print(f"Error creating department: {e}")
+        except Exception:
+            logger.exception("Error creating department")
             db.session.rollback()
             return {'message': 'Error creating department'}, 500
 
@@ -374,8 +729,8 @@ def register_routes(app):
                 return {'message': 'Department deleted successfully'}, 200
             else:
                 return {'message': 'Department not found'}, 404
-        except Exception as e:
-            print(f"Error deleting department: {e}")
+        except Exception:
+            logger.exception("Error deleting department")
             db.session.rollback()
             return {'message': 'Error deleting department'}, 500
 
@@ -386,8 +741,8 @@ def register_routes(app):
         try:
             users = get_all_users_with_departments()
             return {'users': users}, 200
-        except Exception as e:
-            print(f"Error fetching users: {e}")
+        except Exception:
+            logger.exception("Error fetching users")
             return {'message': 'Error fetching users'}, 500
 
     @app.post('/api/admin/department-users', strict_slashes=False)
@@ -421,8 +776,8 @@ def register_routes(app):
             return {'message': 'User added to department successfully'}, 201
         except ValueError:
             return {'message': 'Invalid department ID'}, 400
-        except Exception as e:
-            print(f"Error adding user to department: {e}")
+        except Exception:
+            logger.exception("Error adding user to department")
             db.session.rollback()
             return {'message': 'Error adding user to department'}, 500
 
@@ -453,8 +808,8 @@ def register_routes(app):
 
         except ValueError:
             return {'message': 'Invalid department ID'}, 400
-        except Exception as e:
-            print(f"Error removing user from department: {e}")
+        except Exception:
+            logger.exception("Error removing user from department")
             db.session.rollback()
             return {'message': 'Error removing user from department'}, 500
 
@@ -467,23 +822,64 @@ def register_routes(app):
             'is_department_admin': g.get('is_department_admin', False),
         }, 200
 
-    @app.get("/api/files/<file_id>")
-    def get_converted_file(file_id: str) -> tuple[str, int] | Response:
-        """Endpoint for retrieving a file by its unique id."""
-        file_name, file_path = find_file(upload_folder, file_id)
-
-        with open(file_path, 'r', encoding='utf-8') as F:
-            cis_data = json.load(F)
-
-        attack_data = convert_cis_to_attack(cis_data)
+    @app.get('/api/mappings')
+    def get_mappings():
+        """Mappings that can be selected with the mapping parameter"""
+        return {'mappings': mapping_registry.describe()}, 200
 
-        mem = io.BytesIO(json.dumps(attack_data).encode('utf-8'))
+    def requested_mapping() -> Mapping:
+        """The mapping selected with the mapping query parameter"""
+        name = request.args.get('mapping') or None
+        try:
+            return get_mapping(name)
+        except KeyError:
+            raise ClientException(f"Unknown mapping: {name}", 400)
 
-        return send_file(
+    @app.get("/api/files/<file_id>")
+    def get_converted_file(file_id: str) -> tuple[str, int] | Response:
+        """
+        Endpoint for retrieving a file by its unique id.
+        Converted with the default mapping unless another one
+        is selected with the `mapping` query parameter.
+        """
+        with timed('read'):
+            file_name, file_path = find_file(upload_folder, file_id)
+
+        # Stored files never change and identical reports share one file,
+        # so a conversion is done once per unique report and mapping.
+        # The generation is read first so a conversion with a mapping
+        # replaced meanwhile is never stored under the newer generation
+        generation = mapping_registry.generation
+        mapping = requested_mapping()
+        key = (file_path, mapping.version)
+        converted = None
+        if conversion_cache is not None:
+            converted = conversion_cache.get(key, generation)
+
+        if converted is None:
+            with timed('read'):
+                cis_data = read_report(upload_folder, file_id, file_path)
+
+            with timed('convert'):
+                attack_data = convert_cis_to_attack(cis_data,
+                                                    mapping=mapping)
+            if metrics is not None:
+                metrics.inc('conversions_total')
+            with timed('serialize'):
+                converted = json.dumps(attack_data).encode('utf-8')
+
+            if conversion_cache is not None:
+                conversion_cache.set(key, generation, converted)
+
+        mem = io.BytesIO(converted)
+
+        response = send_file(
             mem,
             as_attachment=True,
             download_name=f'converted_{file_name}'
         )
+        response.headers[MAPPING_VERSION_HEADER] = mapping.version
+        return response
 
     @app.get('/api/files', strict_slashes=False)
     @require_admin
@@ -498,28 +894,32 @@ def register_routes(app):
 
         If the `verbose` query parameter is set to true, then the response
         will return full file metadata instead of only the ids.
+        With `count=estimate` large total counts may be estimated,
+        which is flagged by `total_count_exact` in the pagination.
         """
 
         # query Metadata objects from the database based on request arguments
         try:
             if request.args.get('verbose', 'false').lower() == 'true':
-                return get_metadata(
-                    g.get('current_user'),
-                    g.get('is_super_admin', False),
-                    request.args,
-                    False
-                ), 200
-            else:
-                ids = get_metadata(
+                with timed('query'):
+                    return get_metadata(
                         g.get('current_user'),
                         g.get('is_super_admin', False),
                         request.args,
-                        True
-                )
+                        False
+                    ), 200
+            else:
+                with timed('query'):
+                    ids = get_metadata(
+                            g.get('current_user'),
+                            g.get('is_super_admin', False),
+                            request.args,
+                            True
+                    )
                 return {'ids': ids}, 200
 
-        except Exception as e:
-            print(f"Failed fetching metadata: {e}")
+        except Exception:
+            logger.exception("Failed fetching metadata")
             return "Internal server error", 500
 
     @app.get('/api/files/aggregate', strict_slashes=False)
@@ -528,37 +928,53 @@ def register_routes(app):
         Endpoint for combining and retrieving multiple files
         by their unique ids. Can also be queryed with the same parameters
         as /api/files to combine all the files it returns.
+        The mapping can be selected like for /api/files/<file_id>.
         """
         file_ids = request.args.getlist('id')
+        mapping = requested_mapping()
 
         # If no file ids are provided, try the request arguments
         # if no IDs, then return 400 Bad Request
         if not file_ids:
-            file_ids = get_metadata(g.get('current_user'),
-                                    g.get('is_super_admin', False),
-                                    request.args, ids=True)
+            with timed('query'):
+                file_ids = get_metadata(g.get('current_user'),
+                                        g.get('is_super_admin', False),
+                                        request.args, ids=True)
             if not file_ids:
                 return {
                     'message': "No file ids were found matching the query"
                 }, 404
 
         cis_data_list = []
-
-        for file_id in file_ids:
-            _, file_path = find_file(upload_folder, file_id)
-
-            with open(file_path, 'r', encoding='utf-8') as F:
-                cis_data_list.append(json.load(F))
-
-        attack_data = combine_results(cis_data_list)
-
-        mem = io.BytesIO(json.dumps(attack_data).encode('utf-8'))
-
-        return send_file(
+        # Identical reports share one file, so each is only read once
+        loaded = {}
+
+        with timed('read'):
+            files = find_files(upload_folder, file_ids)
+            for file_id, (_, file_path) in zip(file_ids, files):
+                if file_path not in loaded:
+                    loaded[file_path] = read_report(upload_folder, file_id,
+                                                    file_path)
+                cis_data_list.append(loaded[file_path])
+
+        with timed('convert'):
+            attack_data = combine_results(cis_data_list, mapping=mapping)
+        if metrics is not None:
+            metrics.observe('aggregate_files', len(cis_data_list))
+            metrics.observe('aggregate_rules', sum(
+                len(cis_data.get('rules', [])) for cis_data in cis_data_list
+            ))
+
+        with timed('serialize'):
+            mem = io.BytesIO(json.dumps(attack_data).encode('utf-8'))
+
+        response = send_file(
             mem,
             as_attachment=True,
             download_name='converted_aggregated_results.json'
         )
+        response.headers[MAPPING_VERSION_HEADER] = mapping.version
+        return response
 
     @app.post('/api/files', strict_slashes=False)
     @require_auth
@@ -566,98 +982,108 @@ def register_routes(app):
         """Endpoint for uploading, converting and storing the converted file.
         Returns a response with the unique id of the converted file."""
         unique_id = str(uuid.uuid4())
-        try:
-            if 'file' not in request.files:
-                return {'message': "No file part"}, 400
-
-            file = request.files['file']
-            if file.filename == '':
-                return {'message': "No selected file"}, 400
-
-            department_id = request.args.get('department_id', type=int)
-
-            # Secure the filename to be able to safely store it
-            filename = secure_filename(file.filename)
-
-            # Secure filename might become empty
-            if filename == '':
-                return {'message': "Invalid filename"}, 400
-
-            # Avoid collisions with existing files
-            while os.path.exists(os.path.join(upload_folder, unique_id)):
-                unique_id = str(uuid.uuid4())
-
-            try:
-                cis_data = json.load(file.stream)
-            except json.JSONDecodeError:
-                return {'message': "Invalid file format"}, 400
-
-            # DATABASE PART #
-            try:
-                bench_type = (cis_data.get('benchmark-title')
-                              .replace(' ', '_'))
-                metadata = extract_metadata(filename, bench_type)
-                # Set remaining metadata fields
-                metadata.id = unique_id
-                metadata.ip_address = request.remote_addr
-                metadata.filename = filename
-                # Handle department assignment
-
-                if hasattr(g, 'is_bearer_token') and g.is_bearer_token:
-                    metadata.department_id = g.department_id
-                elif department_id:
-                    # Verify user has access to this department
-                    departments = get_all_departments_with_access(
-                        g.current_user,
-                        g.is_super_admin
-                    )
-                    department_ids = [dept.id for dept in departments]
+        if 'file' not in request.files:
+            return {'message': "No file part"}, 400
 
-                    if department_id not in department_ids:
-                        return {
-                            'message': 'You do not have access '
-                            'to this department'
-                        }, 403
+        file = request.files['file']
+        if file.filename == '':
+            return {'message': "No selected file"}, 400
 
-                    metadata.department_id = department_id
-                else:
-                    return {
-                        'message': 'No department supplied'
-                    }, 403
+        department_id = request.args.get('department_id', type=int)
 
-                # Only when everything has finished we create the file
-                # Its removed on Exception by the upper handler
-                # Create a unique directory
-                os.makedirs(os.path.join(upload_folder, unique_id))
+        # Secure the filename to be able to safely store it
+        filename = secure_filename(file.filename)
 
-                file_path = os.path.join(
-                    upload_folder, unique_id, filename
-                )
+        # Secure filename might become empty
+        if filename == '':
+            return {'message': "Invalid filename"}, 400
 
-                with open(file_path, 'w', encoding='utf-8') as F:
-                    json.dump(cis_data, F, ensure_ascii=False, indent=2)
+        # Avoid collisions with existing files,
+        # including ones not migrated to the sharded layout yet
+        while os.path.exists(upload_dir_path(upload_folder, unique_id)) \
+                or os.path.exists(os.path.join(upload_folder, unique_id)):
+            unique_id = str(uuid.uuid4())
 
-                db.session.add(metadata)
-                db.session.commit()
-                db.session.refresh(metadata)
-            except Exception as e:
-                print(f"Error extracting metadata: {e}")
-                db.session.rollback()
-                raise e
+        try:
+            cis_data = json.load(file.stream)
+        except json.JSONDecodeError:
+            return {'message': "Invalid file format"}, 400
 
-            # END OF DATABASE PART #
+        # DATABASE PART #
+        try:
+            bench_type = (cis_data.get('benchmark-title')
+                          .replace(' ', '_'))
+            metadata = extract_metadata(filename, bench_type)
+            # Set remaining metadata fields
+            metadata.id = unique_id
+            metadata.ip_address = request.remote_addr
+            metadata.filename = filename
+            # Handle department assignment
+
+            if hasattr(g, 'is_bearer_token') and g.is_bearer_token:
+                metadata.department_id = g.department_id
+            elif department_id:
+                # Verify user has access to this department
+                departments = get_all_departments_with_access(
+                    g.current_user,
+                    g.is_super_admin
+                )
+                department_ids = [dept.id for dept in departments]
 
-            # Send the id of the modified file back to the client
-            return {
-                'id': unique_id,
-                'filename': filename,
-            }, 201
+                if department_id not in department_ids:
+                    return {
+                        'message': 'You do not have access '
+                        'to this department'
+                    }, 403
 
+                metadata.department_id = department_id
+            else:
+                return {
+                    'message': 'No department supplied'
+                }, 403
+
+            # Only when everything has finished we create the file.
+            # It is stored by content, so identical reports are kept once.
+            # Files are shared and not removed on errors, an unreferenced
+            # file is reused by the next upload of the same report
+            content = json.dumps(
+                cis_data, ensure_ascii=False, indent=2
+            ).encode('utf-8')
+            content_hash = hash_content(content)
+            storage_path = make_blob_path(content_hash)
+            # Referenced before writing, which takes the write lock, so
+            # retention can not remove the stored report until committed
+            stored_path = acquire_report_blob(content_hash, storage_path,
+                                              len(content))
+            # Reports packed into a segment are not written again
+            if stored_path == storage_path:
+                store_blob(upload_folder, storage_path, content)
+
+            # Recorded so reading the file needs no directory listing
+            metadata.content_hash = content_hash
+            metadata.storage_path = stored_path
+            metadata.size = len(content)
+
+            db.session.add(metadata)
+            bump_cache_generation()
+            db.session.commit()
+            db.session.refresh(metadata)
         except Exception as e:
-            # Clean up on error, remove the directory with all its files
-            if os.path.exists(os.path.join(upload_folder, unique_id)):
-                shutil.rmtree(os.path.join(upload_folder, unique_id))
-            raise e  # rethrow for the error handler to handle it
+            # Logged with the traceback by the error handler
+            logger.warning("Error extracting metadata: %s", e)
+            db.session.rollback()
+            raise e
+
+        # END OF DATABASE PART #
+
+        if metrics is not None:
+            metrics.inc('uploads_total')
+
+        # Send the id of the modified file back to the client
+        return {
+            'id': unique_id,
+            'filename': filename,
+        }, 201
 
     # Have to specify each page manually since static_url_path at line 17
     # intercepts the requests if @app.route('/<path:path>') is used.
@@ -687,8 +1113,7 @@ def register_error_handlers(app):
     @app.errorhandler(ClientException)
     def handle_client_error(error) -> tuple[str, int]:
         """Handle errors caused by the client, like invalid file ids."""
-        # TODO LOG client caused errors
-        print(error)
+        logger.info("Client error: %s", error)
         return error.to_response()
 
     @app.errorhandler(Exception)
@@ -697,6 +1122,5 @@ def register_error_handlers(app):
         if isinstance(error, HTTPException):
             # Return HTTP errors as is like 404 Not Found
             return error
-        # TODO LOG server caused errors
-        print(error)
+        logger.error("Unhandled error", exc_info=error)
         return {'message': 'Internal Server Error'}, 500
@@ -0,0 +1,90 @@
+# Maintenance commands, run with `flask <group> <command>` in api/
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+try:
+    from storage import migrate_uploads, deduplicate_uploads, pack_reports
+    from retention import run_retention
+except ImportError:
+    from .storage import migrate_uploads, deduplicate_uploads, \
+        pack_reports
+    from .retention import run_retention
+
+storage_cli = AppGroup('storage', help='Manage the stored uploads.')
+retention_cli = AppGroup('retention',
+                         help='Apply the retention policies.')
+
+
+@storage_cli.command('migrate')
+@click.option('--limit', type=int, default=None,
+              help='Maximum number of uploads to move.')
+def migrate_command(limit: int | None) -> None:
+    """Move uploads into the sharded directory layout."""
+    moved = migrate_uploads(current_app.config['UPLOAD_FOLDER'], limit)
+    if moved is None:
+        raise click.ClickException(
+            'Another maintenance job is already running'
+        )
+    click.echo(f'Migrated {moved} uploads to the sharded layout')
+
+
+@storage_cli.command('dedupe')
+@click.option('--limit', type=int, default=None,
+              help='Maximum number of uploads to move.')
+def dedupe_command(limit: int | None) -> None:
+    """Store existing uploads by content so duplicates are kept once."""
+    moved = deduplicate_uploads(current_app.config['UPLOAD_FOLDER'], limit)
+    if moved is None:
+        raise click.ClickException(
+            'Another maintenance job is already running'
+        )
+    click.echo(f'Moved {moved} uploads to the content store')
+
+
+@storage_cli.command('pack')
+@click.option('--older-than', type=click.IntRange(min=0), default=90,
+              show_default=True,
+              help='Only pack reports last uploaded this many days ago.')
+@click.option('--limit', type=int, default=None,
+              help='Maximum number of reports to pack.')
+def pack_command(older_than: int, limit: int | None) -> None:
+    """Pack rarely read reports into segment files."""
+    # time_created is stored as naive UTC
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) \
+        - timedelta(days=older_than)
+    packed = pack_reports(current_app.config['UPLOAD_FOLDER'], cutoff, limit)
+    if packed is None:
+        raise click.ClickException(
+            'Another maintenance job is already running'
+        )
+    click.echo(f'Packed {packed} reports into segments')
+
+
+@retention_cli.command('run')
+@click.option('--dry-run', is_flag=True,
+              help='Only report what would be deleted.')
+@click.option('--vacuum', is_flag=True,
+              help='Rebuild the database file to free space afterwards.')
+def retention_command(dry_run: bool, vacuum: bool) -> None:
+    """Delete reports no longer kept by their department's policy."""
+    report = run_retention(current_app.config['UPLOAD_FOLDER'],
+                           dry_run=dry_run, vacuum=vacuum)
+    if report is None:
+        raise click.ClickException(
+            'Another maintenance job is already running'
+        )
+    verb = 'Would delete' if dry_run else 'Deleted'
+    for entry in report:
+        click.echo(f"{entry['department']}: {verb} {entry['reports']} "
+                   f"reports ({entry['bytes']} bytes)")
+    click.echo(f"{verb} {sum(entry['reports'] for entry in report)} "
+               f"reports in total")
+
+
+def register_cli(app) -> None:
+    """Register all command groups with the app"""
+    app.cli.add_command(storage_cli)
+    app.cli.add_command(retention_cli)
@@ -1,17 +1,38 @@
+import hashlib
+import io
+import logging
 import os
 import sys
-import pandas as pd
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Callable, NamedTuple
+
+# Sampled by LOG_SAMPLE_RATE, see logs.py
+logger = logging.getLogger('api.convert')
 
 # Constants for mapping file
 EX_MAP = 'CIS_Controls_v8_to_Enterprise_ATTCK_v82_Master_Mapping__5262021.xlsx'
 SHEET_NAME = 'V8-ATT&CK Low (Sub-)Techniques'
+# Name of the mapping of EX_MAP and SHEET_NAME
+DEFAULT_MAPPING = 'default'
 
 
-# Load mapping once at import, convert to dicts for fast lookups
-def _load_mapping_dicts(filename: str, sheet_name: str):
+def mapping_path(filename: str) -> str:
+    """The mapping file relative to the project root or the api folder"""
     if not os.path.exists(filename):
-        filename = os.path.join('api', filename)
-    df = pd.read_excel(filename, sheet_name=sheet_name, dtype=str).fillna('')
+        return os.path.join('api', filename)
+    return filename
+
+
+# Convert the mapping to dicts for fast lookups
+def _load_mapping_dicts(source: str | BinaryIO, sheet_name: str):
+    # Only needed for reading the mapping, and slow to import
+    import pandas as pd
+
+    if isinstance(source, str):
+        source = mapping_path(source)
+    df = pd.read_excel(source, sheet_name=sheet_name, dtype=str).fillna('')
     safeguard_map: dict[str, list[str]] = {}
     control_map: dict[str, list[str]] = {}
 
@@ -30,8 +51,293 @@ def _load_mapping_dicts(filename: str, sheet_name: str):
     return safeguard_map, control_map
 
 
-_SAFEGUARD_MAP, _CONTROL_MAP = _load_mapping_dicts(EX_MAP, SHEET_NAME)
-print("Mappings loaded in memory", file=sys.stderr, flush=True)
+def _mapping_size(*maps: dict[str, list[str]]) -> int:
+    """Approximate bytes taken by the dicts of a compiled mapping"""
+    size = 0
+    for mapping in maps:
+        size += sys.getsizeof(mapping)
+        for key, techniques in mapping.items():
+            size += sys.getsizeof(key) + sys.getsizeof(techniques)
+            size += sum(sys.getsizeof(tech) for tech in techniques)
+    return size
+
+
+class Mapping(NamedTuple):
+    """The safeguard and control maps compiled from one mapping sheet"""
+    safeguard_map: dict[str, list[str]]
+    control_map: dict[str, list[str]]
+    # Name the mapping is selected by
+    name: str
+    # Start of the SHA-256 of the file and sheet, shown in layers and headers
+    version: str
+
+
+class MappingSource:
+    """
+    One sheet of a mapping file, compiled on first use.
+
+    With check_seconds set, the file is checked for changes at most that
+    often by check(). A changed file is compiled in a background thread
+    while requests keep using the current mapping, which is then replaced
+    in a single assignment so every conversion uses either the old or the
+    new mapping, never a mix of both.
+    """
+
+    def __init__(self, name: str, filename: str, sheet_name: str,
+                 on_replace: Callable[[], None] | None = None) -> None:
+        self.name = name
+        self.filename = filename
+        self.sheet_name = sheet_name
+        self.check_seconds = 0.0
+        # Called after a changed file replaced the mapping
+        self.on_replace = on_replace
+        # Reported as a metric once the mapping is loaded
+        self.load_seconds: float | None = None
+        # Approximate bytes of the compiled mapping, 0 when not loaded
+        self.size = 0
+        self._mapping: Mapping | None = None
+        # (mtime, size) of the file the mapping was compiled from
+        self._stat: tuple[int, int] | None = None
+        self._next_check = 0.0
+        self._reloading = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._mapping is not None
+
+    def get(self) -> Mapping:
+        """The current mapping, loaded on first use."""
+        mapping = self._mapping
+        if mapping is None:
+            mapping = self.load()
+        return mapping
+
+    def load(self) -> Mapping:
+        """Load the mapping now instead of on the first conversion."""
+        with self._lock:
+            if self._mapping is None:
+                self._compile()
+            return self._mapping
+
+    def reload(self) -> Mapping:
+        """Compile the mapping file again if it changed and swap it in."""
+        with self._lock:
+            replaced = self._compile()
+        if replaced and self.on_replace is not None:
+            self.on_replace()
+        return self._mapping
+
+    def unload(self) -> None:
+        """Free the compiled mapping, it is compiled again on next use"""
+        with self._lock:
+            self._mapping = None
+            self._stat = None
+            self.size = 0
+
+    def _stat_file(self) -> tuple[int, int]:
+        stat = os.stat(mapping_path(self.filename))
+        return stat.st_mtime_ns, stat.st_size
+
+    def _compile(self) -> bool:
+        """
+        Compile the file unless its content is the current version.
+        Returns whether a loaded mapping was replaced.
+        """
+        path = mapping_path(self.filename)
+        stat = self._stat_file()
+        with open(path, 'rb') as F:
+            data = F.read()
+        digest = hashlib.sha256(data)
+        # Sheets of one file are different mappings
+        digest.update(self.sheet_name.encode('utf-8'))
+        version = digest.hexdigest()[:12]
+
+        current = self._mapping
+        if current is not None and current.version == version:
+            # Touched but not changed
+            self._stat = stat
+            return False
+
+        start = time.perf_counter()
+        safeguard_map, control_map = _load_mapping_dicts(io.BytesIO(data),
+                                                         self.sheet_name)
+        seconds = time.perf_counter() - start
+        self._mapping = Mapping(safeguard_map, control_map, self.name,
+                                version)
+        self._stat = stat
+        self.size = _mapping_size(safeguard_map, control_map)
+        self.load_seconds = seconds
+        if current is None:
+            logger.info("Mapping %s %s loaded in %.2f seconds", self.name,
+                        version, seconds)
+            return False
+        logger.info("Mapping %s %s replaced %s, loaded in %.2f seconds",
+                    self.name, version, current.version, seconds)
+        return True
+
+    def check(self) -> bool:
+        """
+        Start compiling the mapping in the background if the file changed
+        since it was loaded, at most once every check_seconds.
+        Returns whether a reload was started.
+        """
+        if self.check_seconds <= 0 or self._mapping is None:
+            return False
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_seconds
+
+        try:
+            changed = self._stat_file() != self._stat
+        except OSError:
+            logger.warning("Mapping file %s can not be read", self.filename)
+            return False
+        if not changed or self._reloading:
+            return False
+        self._reloading = True
+        threading.Thread(target=self._background_reload, daemon=True,
+                         name=f'mapping-reload-{self.name}').start()
+        return True
+
+    def _background_reload(self) -> None:
+        try:
+            self.reload()
+        except Exception:
+            # Keep serving the current mapping, an incomplete file is
+            # tried again on the next check
+            logger.exception("Failed reloading mapping %s", self.name)
+            with self._lock:
+                self._stat = None
+        finally:
+            self._reloading = False
+
+
+class MappingRegistry:
+    """
+    The mappings conversions can be selected with, by name.
+
+    Mappings are compiled on first use and kept in memory until the
+    mappings loaded together take more than memory_budget bytes, then the
+    least recently used ones are freed again. The mapping in use is never
+    freed, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, sources: dict[str, tuple[str, str]],
+                 default: str, memory_budget: int = 32 * 1024 * 1024) -> None:
+        self.sources: OrderedDict[str, MappingSource] = OrderedDict()
+        self.default = default
+        self.memory_budget = memory_budget
+        # Increases whenever a changed file replaced a mapping,
+        # conversions are cached per generation
+        self.generation = 0
+        self._lock = threading.Lock()
+        self.configure(sources, default)
+
+    def configure(self, sources: dict[str, tuple[str, str]], default: str,
+                  check_seconds: float = 0.0,
+                  memory_budget: int | None = None) -> None:
+        """
+        Use the given (filename, sheet name) of every mapping name.
+        Mappings of an unchanged file and sheet stay loaded.
+        """
+        if default not in sources:
+            raise ValueError(f"Default mapping {default} is not configured")
+        with self._lock:
+            current = self.sources
+            self.sources = OrderedDict()
+            for name, (filename, sheet_name) in sources.items():
+                source = current.get(name)
+                if source is None or (source.filename, source.sheet_name) \
+                        != (filename, sheet_name):
+                    source = MappingSource(name, filename, sheet_name,
+                                           self._replaced)
+                source.check_seconds = check_seconds
+                self.sources[name] = source
+            self.default = default
+            if memory_budget is not None:
+                self.memory_budget = memory_budget
+
+    def _replaced(self) -> None:
+        with self._lock:
+            self.generation += 1
+
+    def get(self, name: str | None = None) -> Mapping:
+        """
+        The mapping of the given name, or the default one, loaded on
+        first use. Raises KeyError for names that are not configured.
+        """
+        source = self.sources[name or self.default]
+        mapping = source.get()
+        with self._lock:
+            self.sources.move_to_end(source.name)
+            evicted = self._over_budget(source)
+        for other in evicted:
+            other.unload()
+            logger.info("Mapping %s unloaded to stay within the memory "
+                        "budget", other.name)
+        return mapping
+
+    def _over_budget(self, keep: MappingSource) -> list[MappingSource]:
+        """Least recently used mappings to free to fit the budget"""
+        total = sum(source.size for source in self.sources.values())
+        evicted = []
+        for source in self.sources.values():
+            if total <= self.memory_budget:
+                break
+            if source is keep or not source.loaded:
+                continue
+            total -= source.size
+            evicted.append(source)
+        return evicted
+
+    def load(self, name: str | None = None) -> Mapping:
+        """Load a mapping now instead of on the first conversion."""
+        return self.get(name)
+
+    def check(self) -> None:
+        """Reload the loaded mappings whose file changed, see MappingSource"""
+        for source in list(self.sources.values()):
+            source.check()
+
+    def describe(self) -> list[dict]:
+        """Name, file, sheet and loaded version of every mapping"""
+        described = []
+        for name, source in sorted(self.sources.items()):
+            mapping = source._mapping
+            described.append({
+                'name': name,
+                'file': os.path.basename(source.filename),
+                'sheet': source.sheet_name,
+                'default': name == self.default,
+                'version': mapping.version if mapping is not None else None,
+            })
+        return described
+
+    @property
+    def load_seconds(self) -> float | None:
+        """Seconds loading the default mapping took"""
+        return self.sources[self.default].load_seconds
+
+
+mapping_registry = MappingRegistry({DEFAULT_MAPPING: (EX_MAP, SHEET_NAME)},
+                                   DEFAULT_MAPPING)
+
+
+def preload_mapping() -> Mapping:
+    """Load the default mapping now instead of on the first conversion."""
+    return mapping_registry.load()
+
+
+def get_mapping(name: str | None = None) -> Mapping:
+    """The safeguard and control maps of a mapping, loaded on first use."""
+    return mapping_registry.get(name)
+
+
+def get_mapping_load_seconds() -> float | None:
+    """Seconds it took to load the default mapping, None if not loaded yet"""
+    return mapping_registry.load_seconds
 
 
 def gradient_color(score: float) -> str:
@@ -106,14 +412,17 @@ def _assemble_techniques(
 
 def generate_techniques(
     cis_data: dict,
-    include_comments: bool = False
+    include_comments: bool = False,
+    mapping: Mapping | None = None
 ) -> list[dict]:
     """
     Aggregate CIS rule results into ATT&CK techniques,
     summarizing each test as "rule-id : Pass/Fail".
-    Uses pre-loaded mapping dictionaries for lookups.
+    Uses the given mapping for lookups, or the current one of get_mapping.
     Sub-techniques now also contribute to their parent technique.
     """
+    mapping = mapping or get_mapping()
+    safeguard_map, control_map = mapping.safeguard_map, mapping.control_map
     aggregator: dict[str, dict] = {}
     raw_entries: list[tuple[str, bool, str]] = []
 
@@ -135,13 +444,13 @@ def generate_techniques(
 
         # Find matching ATT&CK techniques by CIS Safeguard prefix
         matched_techs: set[str] = set()
-        for sg_key, tech_list in _SAFEGUARD_MAP.items():
+        for sg_key, tech_list in safeguard_map.items():
             if sg_key.startswith(low):
                 matched_techs.update(tech_list)
 
         # If no safeguard match, try CIS Control exact match
         if not matched_techs:
-            matched_techs.update(_CONTROL_MAP.get(high, []))
+            matched_techs.update(control_map.get(high, []))
 
         # Ensure sub-techniques contribute to their parent technique
         parents = {t.split('.')[0] for t in matched_techs if '.' in t}
@@ -160,10 +469,12 @@ def generate_techniques(
 
 def build_layer(
     cis_data: dict,
-    techniques: list[dict]
+    techniques: list[dict],
+    mapping: Mapping | None = None
 ) -> dict:
     """
     Build the final Navigator layer JSON with header and techniques.
+    The name and version of the mapping used are added to the metadata.
     """
     layer = {
         'version': '4.5.0',
@@ -175,25 +486,34 @@ def build_layer(
         'description': 'Aggregated CIS findings mapped to MITRE ATT&CK',
         'techniques': techniques
     }
-    print(f"Navigator layer with {len(techniques)} techniques generated")
+    if mapping is not None:
+        layer['metadata'] = [
+            {'name': 'mapping', 'value': mapping.name},
+            {'name': 'mapping_version', 'value': mapping.version},
+        ]
+    logger.debug("Navigator layer with %d techniques generated",
+                 len(techniques))
     return layer
 
 
 def convert_cis_to_attack(
     cis_data: dict,
-    include_comments: bool = False
+    include_comments: bool = False,
+    mapping: Mapping | None = None
 ) -> dict:
     """
     Load mapping, generate techniques, and build the full Navigator layer.
-    By default, comments are omitted.
+    By default, comments are omitted and the current mapping is used.
     """
-    techniques = generate_techniques(cis_data, include_comments)
-    return build_layer(cis_data, techniques)
+    mapping = mapping or get_mapping()
+    techniques = generate_techniques(cis_data, include_comments, mapping)
+    return build_layer(cis_data, techniques, mapping)
 
 
 def combine_results(
     cis_data_list: list[dict],
-    include_comments: bool = False
+    include_comments: bool = False,
+    mapping: Mapping | None = None
 ) -> dict:
     """
     Combine multiple CIS datasets at the rule level: if a rule fails in any,
@@ -225,4 +545,4 @@ def combine_results(
         'rules': list(merged.values())
     }
 
-    return convert_cis_to_attack(combined_cis, include_comments)
+    return convert_cis_to_attack(combined_cis, include_comments, mapping)
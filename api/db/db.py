@@ -1,10 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
 
 # This file is used to initialize the database with the Flask app.
 # There is most likely a better solution,
 # but there was way too many circular dependencies otherwise
 db = SQLAlchemy()
 
+SQLITE_JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL',
+                        'OFF'}
+SQLITE_SYNCHRONOUS_LEVELS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+
 
 def initialize_db(app) -> SQLAlchemy:
     """Initialize the database with the Flask app."""
@@ -12,6 +17,86 @@ def initialize_db(app) -> SQLAlchemy:
     db.init_app(app)
 
     with app.app_context():
+        # Has to be registered before the first connection is made
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect',
+                         sqlite_pragma_listener(sqlite_pragmas(app.config)))
+
         # db.drop_all()  # Drop all tables if they exist
         db.create_all()
+        upgrade_schema()
     return db
+
+
+def sqlite_pragmas(config) -> list[tuple[str, str | int]]:
+    """
+    Collect the pragmas applied to every SQLite connection from the config.
+    Values are validated since pragmas can not be parameterized.
+    """
+    journal_mode = config['SQLITE_JOURNAL_MODE'].upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f"Invalid SQLite journal mode: {journal_mode}")
+
+    synchronous = config['SQLITE_SYNCHRONOUS'].upper()
+    if synchronous not in SQLITE_SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Invalid SQLite synchronous level: {synchronous}")
+
+    return [
+        # Wait for locks held by other workers instead of failing
+        ('busy_timeout', int(config['SQLITE_BUSY_TIMEOUT'])),
+        # WAL lets readers and a writer work at the same time
+        ('journal_mode', journal_mode),
+        # NORMAL is safe from corruption in WAL mode
+        ('synchronous', synchronous),
+        ('mmap_size', int(config['SQLITE_MMAP_SIZE'])),
+    ]
+
+
+def sqlite_pragma_listener(pragmas: list[tuple[str, str | int]]):
+    """Create a connect event listener applying the pragmas."""
+
+    def set_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return set_pragmas
+
+
+def upgrade_schema() -> None:
+    """
+    Bring databases created by older versions up to date.
+    create_all only creates missing tables, so columns and indexes
+    added to existing tables have to be created separately, and indexes
+    removed from the models dropped. Only indexes named ix_* are dropped.
+    New columns on existing tables must be nullable.
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in
+                    inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(text(
+                    f'ALTER TABLE {preparer.format_table(table)} '
+                    f'ADD COLUMN {preparer.format_column(column)} '
+                    f'{column_type}'
+                ))
+
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+        wanted = {index.name for index in table.indexes}
+        for index in inspector.get_indexes(table.name):
+            name = index['name']
+            if not name or not name.startswith('ix_') or name in wanted:
+                continue
+            with db.engine.begin() as connection:
+                connection.execute(text(
+                    f'DROP INDEX {preparer.quote(name)}'
+                ))
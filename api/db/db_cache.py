@@ -0,0 +1,114 @@
+# Caching helpers for query results served by the API.
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+try:
+    from db.models import CacheGeneration
+    from db.db import db
+except ImportError:
+    from .models import CacheGeneration
+    from .db import db
+
+# There is only ever a single generation row
+GENERATION_ROW_ID = 1
+
+
+class QueryCache:
+    """
+    Bounded LRU cache for query results local to a single worker.
+
+    Entries are only valid for the generation they were computed in.
+    The generation lives in the database so every worker observes the same
+    value, and as soon as a newer generation is seen the cache is emptied.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+
+    def _sync_generation(self, generation: int) -> bool:
+        """
+        Drop all entries if the generation moved forward.
+        Returns False if the caller observed an older generation,
+        in which case the cache should be bypassed.
+        """
+        if generation > self._generation:
+            self._entries.clear()
+            self._generation = generation
+        return generation == self._generation
+
+    def get(self, key: Hashable, generation: int) -> Any | None:
+        """Return the cached value for key or None on a miss."""
+        with self._lock:
+            if not self._sync_generation(generation) \
+                    or key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key: Hashable, generation: int, value: Any) -> None:
+        """Store value for key, evicting the least recently used entry."""
+        with self._lock:
+            if not self._sync_generation(generation):
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def ensure_cache_generation() -> None:
+    """Create the generation row if it does not exist yet."""
+    stmt = select(CacheGeneration).where(
+        CacheGeneration.id == GENERATION_ROW_ID
+    )
+    if db.session.execute(stmt).scalar_one_or_none() is not None:
+        return
+
+    db.session.add(CacheGeneration(id=GENERATION_ROW_ID, value=0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker created it first
+        db.session.rollback()
+
+
+def get_cache_generation() -> int:
+    """Retrieve the current cache generation."""
+    stmt = select(CacheGeneration.value).where(
+        CacheGeneration.id == GENERATION_ROW_ID
+    )
+    return db.session.execute(stmt).scalar() or 0
+
+
+def bump_cache_generation() -> None:
+    """
+    Invalidate cached query results in all workers.
+    This does not commit, so the bump becomes visible together
+    with the change that caused it.
+    """
+    stmt = (
+        update(CacheGeneration)
+        .where(CacheGeneration.id == GENERATION_ROW_ID)
+        .values(value=CacheGeneration.value + 1)
+    )
+    if db.session.execute(stmt).rowcount == 0:
+        db.session.add(CacheGeneration(id=GENERATION_ROW_ID, value=1))
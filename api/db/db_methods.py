@@ -1,20 +1,25 @@
 # A file for database methods for querrying and manipulating the database.
-from datetime import datetime
-from sqlalchemy import Subquery, select, func, and_, or_, sql
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import Subquery, select, update, delete, func, and_, or_, \
+    sql, text
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, joinedload
 from werkzeug.datastructures import MultiDict
 from enum import Enum
 import uuid
 
 try:
     from db.models import Metadata, Benchmark, Department, Result, Hostname, \
-        DepartmentUser, BearerToken
+        DepartmentUser, BearerToken, ReportBlob, RetentionPolicy
     from db.db import db
+    from db.db_cache import get_cache_generation, bump_cache_generation
 except ImportError:
     from .models import Metadata, Benchmark, Department, Result, Hostname, \
-        DepartmentUser, BearerToken
+        DepartmentUser, BearerToken, ReportBlob, RetentionPolicy
     from .db import db
+    from .db_cache import get_cache_generation, bump_cache_generation
 
 
 class Filter_type(Enum):
@@ -27,23 +32,72 @@ def get_metadata(user_handle: str,
                  is_super_admin: bool,
                  args: MultiDict[str, str],
                  ids: bool = False) -> dict | list[str]:
-    """Converting from arguments in request.args to function arguments."""
-    return execute_query(
-        user_handle,
-        is_super_admin,
-        min_time=datetime.fromisoformat(args.get('min_time'))
+    """
+    Converting from arguments in request.args to function arguments.
+    Results are served from the app's query cache when possible.
+    """
+    query_args = parse_query_args(args, ids)
+
+    cache = current_app.extensions.get('query_cache')
+    if cache is None:
+        return execute_query(user_handle, is_super_admin, **query_args)
+
+    # The cache key is based on what the user can see, not who they are
+    if is_super_admin:
+        scope = None
+    else:
+        scope = tuple(sorted(
+            dept.id for dept in get_user_departments(user_handle)
+        ))
+    key = (scope, normalize_query_args(query_args))
+
+    # Read the generation before querying, so that a result computed while
+    # the data changes is never stored under the newer generation
+    generation = get_cache_generation()
+    result = cache.get(key, generation)
+    if result is None:
+        result = execute_query(user_handle, is_super_admin, **query_args)
+        cache.set(key, generation, result)
+    return result
+
+
+def parse_query_args(args: MultiDict[str, str], ids: bool) -> dict:
+    """Parse request arguments into keyword arguments for execute_query."""
+    return {
+        'min_time': datetime.fromisoformat(args.get('min_time'))
         if args.get('min_time') else None,
-        max_time=datetime.fromisoformat(args.get('max_time'))
+        'max_time': datetime.fromisoformat(args.get('max_time'))
         if args.get('max_time') else None,
-        departments=args.getlist('department'),
-        benchmarks=args.getlist('benchmark'),
-        results=args.getlist('result'),
-        hostnames=args.getlist('hostname'),
-        search_string=args.get('search', type=str),
-        page=args.get('page', 0, type=int),
-        page_size=args.get('page_size', 20, type=int),
-        ids_only=ids
-    )
+        'departments': args.getlist('department'),
+        'benchmarks': args.getlist('benchmark'),
+        'results': args.getlist('result'),
+        'hostnames': args.getlist('hostname'),
+        'search_string': args.get('search', type=str),
+        'page': args.get('page', 0, type=int),
+        'page_size': args.get('page_size', 20, type=int),
+        'ids_only': ids,
+        # Opt-in, estimated totals only kick in above the threshold
+        'count_threshold': current_app.config['APPROX_COUNT_THRESHOLD']
+        if args.get('count') == 'estimate' else None
+    }
+
+
+def normalize_query_args(query_args: dict) -> tuple:
+    """
+    Turn parsed query arguments into a hashable cache key,
+    so equivalent requests map to the same key.
+    """
+    normalized = []
+    for name, value in sorted(query_args.items()):
+        # Pagination does not affect the list of ids
+        if query_args['ids_only'] and \
+                name in ('page', 'page_size', 'count_threshold'):
+            continue
+        # Filter options are treated as a set by compute_filter
+        if isinstance(value, list):
+            value = tuple(sorted(set(value), key=str))
+        normalized.append((name, value))
+    return tuple(normalized)
 
 
 def get_benchmark(name: str) -> Benchmark:
@@ -105,6 +159,202 @@ def get_hostname(name: str) -> Hostname:
         hostname = db.session.execute(stmt).scalar_one_or_none()
     return hostname
 
+
+# Stay well below SQLite's limit on the number of bound parameters
+STORAGE_LOOKUP_BATCH_SIZE = 500
+
+
+def get_storage_paths(file_ids: list[str]) \
+        -> dict[str, tuple[str, str, int | None, int | None]]:
+    """
+    Look up where files are stored with as few queries as possible.
+    Files uploaded before storage paths were recorded are left out.
+
+    :returns: Dictionary of file id to (filename, storage_path,
+    segment_offset, size) tuples, the offset is only set for reports
+    packed into a segment.
+    """
+    unique_ids = list(dict.fromkeys(file_ids))
+    paths = {}
+    for start in range(0, len(unique_ids), STORAGE_LOOKUP_BATCH_SIZE):
+        stmt = select(
+            Metadata.id, Metadata.filename, Metadata.storage_path,
+            ReportBlob.segment_offset, Metadata.size
+        ).outerjoin(
+            ReportBlob, ReportBlob.content_hash == Metadata.content_hash
+        ).where(
+            Metadata.id.in_(
+                unique_ids[start:start + STORAGE_LOOKUP_BATCH_SIZE]
+            ),
+            Metadata.storage_path.is_not(None)
+        )
+        for file_id, *location in db.session.execute(stmt):
+            paths[file_id] = tuple(location)
+    return paths
+
+
+def update_storage_path(file_id: str, storage_path: str, size: int) -> bool:
+    """Record the new location of a stored file."""
+    metadata = db.session.get(Metadata, file_id)
+    if metadata is None:
+        return False
+    metadata.storage_path = storage_path
+    metadata.size = size
+    db.session.commit()
+    return True
+
+
+def acquire_report_blob(content_hash: str, storage_path: str,
+                        size: int) -> str:
+    """
+    Add a reference to the stored report with this hash,
+    registering it if it is new. Committed by the caller.
+    :returns: Where the report is stored, which differs from storage_path
+    when it was packed into a segment already.
+    """
+    # Updating first takes the write lock on SQLite,
+    # so no other worker can register the same hash in between
+    stmt = update(ReportBlob).where(
+        ReportBlob.content_hash == content_hash
+    ).values(ref_count=ReportBlob.ref_count + 1).returning(
+        ReportBlob.storage_path
+    )
+    stored_path = db.session.execute(stmt).scalar_one_or_none()
+    if stored_path is not None:
+        return stored_path
+
+    db.session.add(ReportBlob(content_hash=content_hash,
+                              storage_path=storage_path,
+                              size=size, ref_count=1))
+    return storage_path
+
+
+def get_files_without_blob(limit: int | None = None) -> list[str]:
+    """Ids of files not stored by content hash yet."""
+    stmt = select(Metadata.id).where(
+        Metadata.content_hash.is_(None)
+    ).order_by(Metadata.id).limit(limit)
+    return list(db.session.execute(stmt).scalars())
+
+
+def update_report_blob(file_id: str, content_hash: str,
+                       storage_path: str, size: int) -> str:
+    """
+    Point an existing file at the stored report with this hash.
+    :returns: Where the report is stored, see acquire_report_blob.
+    """
+    metadata = db.session.get(Metadata, file_id)
+    storage_path = acquire_report_blob(content_hash, storage_path, size)
+    metadata.content_hash = content_hash
+    metadata.storage_path = storage_path
+    metadata.size = size
+    db.session.commit()
+    return storage_path
+
+
+def get_cold_report_blobs(cutoff: datetime, limit: int | None = None) \
+        -> list:
+    """
+    Stored reports not packed into a segment yet
+    whose newest file was uploaded before the cutoff.
+    :returns: (content_hash, storage_path, size) rows.
+    """
+    newest = select(
+        Metadata.content_hash,
+        func.max(Metadata.time_created).label('time_created')
+    ).where(
+        Metadata.content_hash.is_not(None)
+    ).group_by(Metadata.content_hash).subquery()
+    stmt = select(
+        ReportBlob.content_hash, ReportBlob.storage_path, ReportBlob.size
+    ).join(
+        newest, newest.c.content_hash == ReportBlob.content_hash
+    ).where(
+        ReportBlob.segment_offset.is_(None),
+        newest.c.time_created < cutoff
+    ).order_by(ReportBlob.id).limit(limit)
+    return db.session.execute(stmt).all()
+
+
+def pack_report_blobs(segment_path: str,
+                      offsets: dict[str, int]) -> None:
+    """Record that reports were packed into a segment at these offsets."""
+    for content_hash, offset in offsets.items():
+        db.session.execute(
+            update(ReportBlob)
+            .where(ReportBlob.content_hash == content_hash)
+            .values(storage_path=segment_path, segment_offset=offset)
+        )
+        db.session.execute(
+            update(Metadata)
+            .where(Metadata.content_hash == content_hash)
+            .values(storage_path=segment_path)
+        )
+    db.session.commit()
+
+
+def lock_unused_storage_paths(storage_paths: list[str]) -> list[str]:
+    """
+    Take the write lock and find the paths no stored report uses.
+    Their files can be removed until the caller commits, uploads of the
+    same reports wait for the lock and write them again afterwards.
+    """
+    # Updating takes the write lock on SQLite even when nothing matches,
+    # and sees the rows uploads committed while waiting for it
+    stmt = update(ReportBlob).where(
+        ReportBlob.storage_path.in_(storage_paths)
+    ).values(ref_count=ReportBlob.ref_count).returning(
+        ReportBlob.storage_path
+    )
+    in_use = set(db.session.execute(stmt).scalars())
+    return [path for path in storage_paths if path not in in_use]
+
+
+def get_storage_usage(department_ids: list[int]) -> dict[int, dict]:
+    """
+    Compare the size of all reports in each department with the size
+    actually stored once identical reports are deduplicated.
+    Files not stored by content hash count as stored in full.
+    :returns: Per department id with reports, its report counts and sizes.
+    """
+    per_file = select(
+        Metadata.department_id,
+        func.count().label('reports'),
+        func.coalesce(func.sum(Metadata.size), 0).label('logical_bytes'),
+        func.coalesce(func.sum(Metadata.size).filter(
+            Metadata.content_hash.is_(None)
+        ), 0).label('unhashed_bytes'),
+        func.count(Metadata.content_hash.distinct()).label('unique_reports'),
+    ).where(
+        Metadata.department_id.in_(department_ids)
+    ).group_by(Metadata.department_id)
+
+    # Every distinct report of a department counted once
+    distinct_blobs = select(
+        Metadata.department_id, ReportBlob.content_hash, ReportBlob.size
+    ).join(
+        ReportBlob, ReportBlob.content_hash == Metadata.content_hash
+    ).where(
+        Metadata.department_id.in_(department_ids)
+    ).distinct().subquery()
+    per_blob = select(
+        distinct_blobs.c.department_id,
+        func.sum(distinct_blobs.c.size)
+    ).group_by(distinct_blobs.c.department_id)
+    blob_bytes = dict(db.session.execute(per_blob).all())
+
+    usage = {}
+    for row in db.session.execute(per_file):
+        stored = blob_bytes.get(row.department_id, 0) + row.unhashed_bytes
+        usage[row.department_id] = {
+            'reports': row.reports,
+            'unique_reports': row.unique_reports,
+            'logical_bytes': row.logical_bytes,
+            'stored_bytes': stored,
+            'saved_bytes': row.logical_bytes - stored,
+        }
+    return usage
+
 # Department and User Management Methods
 
 
@@ -123,6 +373,7 @@ def create_department(name: str) -> Department:
     """Create a new department."""
     department = Department(name=name)
     db.session.add(department)
+    bump_cache_generation()
     db.session.commit()
     return department
 
@@ -139,7 +390,11 @@ def delete_department(department_id: int) -> bool:
         for token in tokens:
             token.is_active = False
 
+        db.session.execute(delete(RetentionPolicy).where(
+            RetentionPolicy.department_id == department_id
+        ))
         db.session.delete(department)
+        bump_cache_generation()
         db.session.commit()
         return True
     return False
@@ -173,6 +428,7 @@ def add_user_to_department(department_id: int, user_handle: str) \
         user_handle=user_handle
     )
     db.session.add(dept_user)
+    bump_cache_generation()
     db.session.commit()
     return dept_user
 
@@ -188,6 +444,7 @@ def remove_user_from_department(department_id: int, user_handle: str) -> bool:
     dept_user = db.session.execute(stmt).scalar_one_or_none()
     if dept_user:
         db.session.delete(dept_user)
+        bump_cache_generation()
         db.session.commit()
         return True
     return False
@@ -288,7 +545,8 @@ def execute_query(
     search_string: str | None = None,
     page: int = 0,
     page_size: int = 20,
-    ids_only: bool = False
+    ids_only: bool = False,
+    count_threshold: int | None = None
 ) -> dict | list[str]:
     """
     Executes a query against the Metadata table using a variety of filters,
@@ -297,12 +555,16 @@ def execute_query(
     Filters can be applied to restrict results by time range, department,
     benchmark, result type, hostname, and filename search string.
 
+    If `count_threshold` is set, the total count is derived from the filter
+    counts instead of counting again, unless it is below the threshold.
+
     Returns:
         list[str]: If `ids_only` is True, returns a list of metadata IDs.
         dict: If `ids_only` is False, returns a dictionary with:
             - "filters": Dictionary of filter metadata
                 (e.g., available departments with counts).
-            - "pagination": Info curent page, page size, and total count.
+            - "pagination": Info curent page, page size, total count and
+                whether the total count is exact or estimated.
             - "data": List of metadata records as dictionaries.
     """
 
@@ -365,27 +627,75 @@ def execute_query(
     if ids_only:
         return db.session.execute(ids_stmt).scalars().all()
 
-    # Count the total number of results for pagination
-    total_count = db.session.execute(count_stmt).scalar()
-
-    # Apply pagination and ordering
-    data_stmt = data_stmt.order_by(mdt_alias.time_created.desc())
+    # Apply pagination and ordering, loading the related rows to_dict
+    # includes in the same query instead of one query per row
+    data_stmt = data_stmt.options(
+        joinedload(mdt_alias.hostname),
+        joinedload(mdt_alias.benchmark),
+        joinedload(mdt_alias.result),
+        joinedload(mdt_alias.department),
+    ).order_by(mdt_alias.time_created.desc())
     data_stmt = data_stmt.offset(page * page_size).limit(page_size)
 
     data = db.session.execute(data_stmt).scalars().all()
 
+    # Count the total number of results for pagination
+    total_count = None
+    if count_threshold is not None:
+        total_count = estimate_count(data_for_filters['department'],
+                                     departments)
+        if total_count < count_threshold:
+            total_count = None
+    total_count_exact = total_count is None
+
+    # A partially filled page tells the exact total for free
+    if total_count is not None and len(data) < page_size \
+            and (data or page == 0):
+        total_count = page * page_size + len(data)
+        total_count_exact = True
+
+    if total_count is None:
+        total_count = db.session.execute(count_stmt).scalar()
+
     # Structure of the output
     return {
         "filters": data_for_filters,
         "pagination": {
             "page": page,
             "page_size": page_size,
-            "total_count": total_count
+            "total_count": total_count,
+            "total_count_exact": total_count_exact
         },
-        "data": [item.to_dict() for item in data]
+        "data": Metadata.to_dicts(data)
     }
 
 
+def estimate_count(filter_counts: list[dict],
+                   selected: list[int | str | None]) -> int:
+    """
+    Estimate the total number of matching files from the counts of
+    a standard filter computed by get_filters_data.
+
+    Those counts have every other filter applied and are grouped by the
+    filter's own column, so summing the selected options (or all options
+    if none are selected) gives the total. It can only differ from the
+    real count if files reference rows that no longer exist.
+    """
+    if not selected:
+        return sum(option['count'] for option in filter_counts)
+
+    # The same null handling as compute_filter
+    options = set(selected)
+    include_none = None in options or 'null' in options
+    options = {str(option) for option in options
+               if option is not None and option != 'null'}
+    return sum(
+        option['count'] for option in filter_counts
+        if (option['id'] is None and include_none)
+        or (option['id'] is not None and str(option['id']) in options)
+    )
+
+
 def exclude_filter(current_filter, filters):
     """Helper which returns all filters except the current one"""
     return [f for f in filters if f is not None and f is not current_filter]
@@ -508,6 +818,132 @@ def get_filters_data(subq, filters_data):
     return filters_list
 
 
+def get_retention_policies(department_ids: list[int] | None = None) \
+        -> list[RetentionPolicy]:
+    """Get the retention policies, of the given departments if specified."""
+    stmt = select(RetentionPolicy).order_by(RetentionPolicy.department_id)
+    if department_ids is not None:
+        stmt = stmt.where(RetentionPolicy.department_id.in_(department_ids))
+    return db.session.execute(stmt).scalars().all()
+
+
+def set_retention_policy(department_id: int, max_age_days: int | None,
+                         max_reports_per_host: int | None) \
+        -> RetentionPolicy:
+    """Create or replace the retention policy of a department."""
+    stmt = select(RetentionPolicy).where(
+        RetentionPolicy.department_id == department_id
+    )
+    policy = db.session.execute(stmt).scalar_one_or_none()
+    if policy is None:
+        policy = RetentionPolicy(department_id=department_id)
+        db.session.add(policy)
+    policy.max_age_days = max_age_days
+    policy.max_reports_per_host = max_reports_per_host
+    db.session.commit()
+    return policy
+
+
+def delete_retention_policy(department_id: int) -> bool:
+    """Remove the retention policy of a department, keeping all reports."""
+    stmt = delete(RetentionPolicy).where(
+        RetentionPolicy.department_id == department_id
+    )
+    deleted = db.session.execute(stmt).rowcount > 0
+    db.session.commit()
+    return deleted
+
+
+def get_expired_files(policy: RetentionPolicy, now: datetime) \
+        -> list[tuple[str, int | None]]:
+    """
+    Files of a department no longer kept by its retention policy.
+    :param now: Current time in naive UTC, like time_created.
+    :returns: Id and size tuples, oldest first.
+    """
+    conditions = []
+    if policy.max_age_days is not None:
+        conditions.append(
+            Metadata.time_created < now - timedelta(days=policy.max_age_days)
+        )
+    if policy.max_reports_per_host is not None:
+        # Number the reports of each host from newest to oldest
+        ranked = select(
+            Metadata.id,
+            func.row_number().over(
+                partition_by=Metadata.hostname_id,
+                order_by=(Metadata.time_created.desc(), Metadata.id.desc())
+            ).label('rank')
+        ).where(
+            Metadata.department_id == policy.department_id,
+            Metadata.hostname_id.isnot(None)
+        ).subquery()
+        conditions.append(Metadata.id.in_(
+            select(ranked.c.id).where(
+                ranked.c.rank > policy.max_reports_per_host
+            )
+        ))
+    if not conditions:
+        return []
+
+    stmt = select(Metadata.id, Metadata.size).where(
+        Metadata.department_id == policy.department_id,
+        or_(*conditions)
+    ).order_by(Metadata.time_created, Metadata.id)
+    return [tuple(row) for row in db.session.execute(stmt)]
+
+
+def delete_files(file_ids: list[str]) -> tuple[list, list[str]]:
+    """
+    Delete files and release the stored reports they reference.
+    Does not commit.
+    :returns: The deleted (id, storage_path, content_hash) rows and
+    the (storage_path, segment_offset) of reports no longer referenced.
+    """
+    deleted = db.session.execute(
+        delete(Metadata).where(Metadata.id.in_(file_ids)).returning(
+            Metadata.id, Metadata.storage_path, Metadata.content_hash
+        )
+    ).all()
+
+    # One update for every number of references released
+    released = Counter(row.content_hash for row in deleted
+                       if row.content_hash is not None)
+    by_count = {}
+    for content_hash, count in released.items():
+        by_count.setdefault(count, []).append(content_hash)
+    for count, hashes in by_count.items():
+        db.session.execute(
+            update(ReportBlob)
+            .where(ReportBlob.content_hash.in_(hashes))
+            .values(ref_count=ReportBlob.ref_count - count)
+        )
+
+    unused = db.session.execute(
+        delete(ReportBlob).where(
+            ReportBlob.content_hash.in_(list(released)),
+            ReportBlob.ref_count <= 0
+        ).returning(ReportBlob.storage_path, ReportBlob.segment_offset),
+        execution_options={'synchronize_session': 'fetch'}
+    ).all()
+
+    bump_cache_generation()
+    return deleted, unused
+
+
+def optimize_database(vacuum: bool = False) -> None:
+    """
+    Refresh the statistics of the query planner and optionally
+    rebuild the database file to give back the space of deleted rows.
+    """
+    # VACUUM can not run inside a transaction
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('ANALYZE'))
+        if vacuum:
+            connection.execute(text('VACUUM'))
+
+
 def create_bearer_token(department_id: int,
                         machine_name: str, created_by: str) -> BearerToken:
     """Create a new bearer token for a department."""
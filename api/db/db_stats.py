@@ -0,0 +1,90 @@
+# Counting and timing the SQL statements executed per request.
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+logger = logging.getLogger('api.db')
+
+
+class QueryStats:
+    """Number of statements and their total duration in seconds."""
+    __slots__ = ('count', 'duration')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+
+
+def register_query_stats(app, db) -> None:
+    """
+    Count and time the statements of every request into g.query_stats
+    and log statements slower than SLOW_QUERY_MS with the types of their
+    parameters, the values can be tokens or other secrets.
+    Only hooked into the engine when timing, metrics or the slow query
+    log are enabled.
+    """
+    slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+    if not (app.config['REQUEST_TIMING'] or app.config['METRICS_ENABLED']
+            or slow_query_seconds > 0):
+        return
+
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context,
+                    executemany):
+        if context is not None:
+            context.query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, parameters, context,
+                  executemany):
+        start = getattr(context, 'query_start', None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+
+        if has_request_context():
+            stats = g.get('query_stats')
+            if stats is not None:
+                stats.count += 1
+                stats.duration += duration
+
+        if 0 < slow_query_seconds <= duration:
+            logger.warning('Slow query', extra={
+                'slow_query_ms': round(duration * 1000, 2),
+                'statement': statement,
+                'parameter_types': parameter_types(parameters, executemany),
+            })
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+
+def parameter_types(parameters, executemany: bool) -> list[str]:
+    """Type names of the bound parameters, of the first row if many."""
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+    if isinstance(parameters, dict):
+        parameters = parameters.values()
+    return [type(value).__name__ for value in parameters]
+
+
+@contextmanager
+def capture_queries(engine):
+    """Record every statement executed within the block."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
@@ -7,8 +7,11 @@ except ImportError:
     from .models import Metadata
     from .db_methods import get_benchmark, get_result, get_hostname
 
+import logging
 from datetime import datetime
 
+logger = logging.getLogger('api.db')
+
 
 # TODO: Needs to be tested
 def extract_metadata(filename: str, bench_type: str) -> Metadata:
@@ -55,8 +58,8 @@ def extract_metadata(filename: str, bench_type: str) -> Metadata:
     benchmark_str = bench_type
     try:
         benchmark = get_benchmark(benchmark_str)
-    except Exception as e:
-        print(f"Error fetching benchmark: {e}")
+    except Exception:
+        logger.exception("Error fetching benchmark")
         benchmark = None
 
     if len(time_and_result) == 2:
@@ -65,8 +68,8 @@ def extract_metadata(filename: str, bench_type: str) -> Metadata:
         result_str = "Passing"
     try:
         result = get_result(result_str)
-    except Exception as e:
-        print(f"Error fetching result: {e}")
+    except Exception:
+        logger.exception("Error fetching result")
         result = None
 
     # Fine for now, as the remaining fields are added later
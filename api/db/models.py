@@ -20,42 +20,91 @@ class BaseModel(db.Model):
         return f"<{self.__class__.__name__} {self.id}>"
 
     def to_dict(self):
+        return _get_serializer(type(self))(self, None)
+
+    @classmethod
+    def to_dicts(cls, rows) -> list[dict]:
+        """
+        Serialize many rows at once.
+        Related objects shared between rows are only serialized once.
+        """
+        serialize = _get_serializer(cls)
+        related_cache = {}
+        return [serialize(row, related_cache) for row in rows]
+
+
+# Serializers compiled per model class, see _compile_serializer
+_SERIALIZERS = {}
+
+
+def _get_serializer(cls):
+    serializer = _SERIALIZERS.get(cls)
+    if serializer is None:
+        serializer = _SERIALIZERS[cls] = _compile_serializer(cls)
+    return serializer
+
+
+def _compile_serializer(cls):
+    """
+    Build the to_dict function for a model class. Everything to_dict needs
+    from the table and mapper is resolved once here instead of per row.
+    """
+    # Ability to hide certain fields from the output
+    hidden_fields = set(getattr(cls, "__hidden_fields__", set()))
+    utc_fields = set(getattr(cls, "__utc_timestamp_fields__", set()))
+
+    # (name, is_datetime, is_utc) for each serialized column,
+    # foreign key columns are skipped
+    columns = [
+        (column.name, isinstance(column.type, sa.DateTime),
+         column.name in utc_fields)
+        for column in cls.__table__.columns
+        if not column.foreign_keys and column.name not in hidden_fields
+    ]
+    # One-to-many relationships have no to_dict, so they are always None
+    relationships = [
+        (rel.key, rel.uselist)
+        for rel in cls.__mapper__.relationships
+        if rel.key not in hidden_fields
+    ]
+
+    def serialize(obj, related_cache):
         result_dict = {}
-        # Ability to hide certain fields from the output
-        hidden_fields = set(getattr(self, "__hidden_fields__", set()))
-
-        for column in self.__table__.columns:
-            # Skip foreign key columns and hidden fields
-            if column.foreign_keys or column.name in hidden_fields:
-                continue
-
-            value = getattr(self, column.name)
-            if isinstance(value, datetime.datetime):
-                if (
-                    hasattr(self, "__utc_timestamp_fields__") and
-                    column.name in self.__utc_timestamp_fields__
-                ):
+        for name, is_datetime, is_utc in columns:
+            value = getattr(obj, name)
+            if is_datetime and isinstance(value, datetime.datetime):
+                if is_utc:
                     value = value.replace(tzinfo=datetime.timezone.utc)
-
                 value = value.isoformat()
-            result_dict[column.name] = value
+            result_dict[name] = value
 
         # Add related objects to the dictionary
-        for rel in self.__mapper__.relationships:
-            if rel.key not in hidden_fields:
-                related_obj = getattr(self, rel.key)
-                if related_obj is not None and hasattr(related_obj, "to_dict"):
-                    result_dict[rel.key] = related_obj.to_dict()
-                else:
-                    result_dict[rel.key] = None
+        for key, uselist in relationships:
+            if uselist:
+                result_dict[key] = None
+                continue
+            related_obj = getattr(obj, key)
+            if related_obj is None:
+                result_dict[key] = None
+            elif related_cache is None:
+                result_dict[key] = related_obj.to_dict()
+            else:
+                related_dict = related_cache.get(id(related_obj))
+                if related_dict is None:
+                    related_dict = related_obj.to_dict()
+                    related_cache[id(related_obj)] = related_dict
+                result_dict[key] = related_dict
 
         return result_dict
 
+    return serialize
+
 
 class Metadata(BaseModel):
     """Model representing metadata of a file."""
     __tablename__ = "metadata"
-    __hidden_fields__ = {"ip_address"}
+    __hidden_fields__ = {"ip_address", "storage_path", "size",
+                         "content_hash"}
 
     # Note: UUIDs are not natively supported by SQLite
     id: Mapped[str] = mapped_column(
@@ -64,34 +113,56 @@ class Metadata(BaseModel):
     )
     ip_address: Mapped[str | None] = mapped_column(nullable=True, index=True)
     filename: Mapped[str]
+    # Path relative to the upload folder and size in bytes of the stored
+    # file, not set for files uploaded before these were recorded
+    storage_path: Mapped[str | None] = mapped_column(nullable=True)
+    size: Mapped[int | None] = mapped_column(nullable=True)
+    # SHA-256 of the stored file, identical reports share one ReportBlob
+    content_hash: Mapped[str | None] = mapped_column(
+        sa.String(64), nullable=True, index=True
+    )
     time_created: Mapped[datetime.datetime | None] = mapped_column(
         sa.DateTime, index=True, default=func.now()
     )
 
     hostname_id: Mapped[int | None] = mapped_column(
-        sa.ForeignKey("hostname.id"), nullable=True, index=True
+        sa.ForeignKey("hostname.id"), nullable=True
     )
     hostname: Mapped[Hostname | None] = relationship("Hostname")
 
     benchmark_id: Mapped[int | None] = mapped_column(
-        sa.ForeignKey("benchmark.id"), nullable=True, index=True
+        sa.ForeignKey("benchmark.id"), nullable=True
     )
     benchmark: Mapped[Benchmark | None] = relationship("Benchmark")
 
     result_id: Mapped[int | None] = mapped_column(
-        sa.ForeignKey("result.id"), nullable=True, index=True
+        sa.ForeignKey("result.id"), nullable=True
     )
     result: Mapped[Result | None] = relationship("Result")
 
     department_id: Mapped[int | None] = mapped_column(
         sa.ForeignKey("department.id", ondelete="SET NULL"),
-        nullable=True, index=True,
+        nullable=True,
     )
     department: Mapped[Department | None] = relationship(
         "Department",
         back_populates="file_metadata"
     )
 
+    # Listing files always filters on department and/or one of the other
+    # foreign keys, then restricts and orders by time_created.
+    # These also serve lookups on the foreign key alone.
+    __table_args__ = (
+        sa.Index("ix_metadata_department_id_time_created",
+                 "department_id", "time_created"),
+        sa.Index("ix_metadata_hostname_id_time_created",
+                 "hostname_id", "time_created"),
+        sa.Index("ix_metadata_benchmark_id_time_created",
+                 "benchmark_id", "time_created"),
+        sa.Index("ix_metadata_result_id_time_created",
+                 "result_id", "time_created"),
+    )
+
 
 class Benchmark(BaseModel):
     __tablename__ = "benchmark"
@@ -137,6 +208,54 @@ class Hostname(BaseModel):
     name: Mapped[str] = mapped_column(unique=True)
 
 
+class ReportBlob(BaseModel):
+    """
+    A report stored once by the hash of its content,
+    shared by every Metadata row with that content_hash.
+    """
+    __tablename__ = "report_blob"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    content_hash: Mapped[str] = mapped_column(sa.String(64), unique=True)
+    # Either a file of its own or a segment packing many reports,
+    # in which case the report is the size bytes at segment_offset
+    storage_path: Mapped[str] = mapped_column(index=True)
+    segment_offset: Mapped[int | None] = mapped_column(nullable=True)
+    size: Mapped[int]
+    # Number of Metadata rows referencing this report
+    ref_count: Mapped[int] = mapped_column(nullable=False, default=0)
+
+
+class RetentionPolicy(BaseModel):
+    """
+    How long reports of a department are kept.
+    Reports older than max_age_days are deleted, as are reports beyond
+    the newest max_reports_per_host of each host. Unset limits are ignored.
+    """
+    __tablename__ = "retention_policy"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    department_id: Mapped[int] = mapped_column(
+        sa.ForeignKey("department.id", ondelete="CASCADE"),
+        nullable=False,
+        unique=True
+    )
+    max_age_days: Mapped[int | None] = mapped_column(nullable=True)
+    max_reports_per_host: Mapped[int | None] = mapped_column(nullable=True)
+
+
+class CacheGeneration(BaseModel):
+    """
+    Single row counter shared by all workers through the database.
+    Bumped whenever data visible through /api/files changes so that
+    per-worker query caches know their entries are stale.
+    """
+    __tablename__ = "cache_generation"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    value: Mapped[int] = mapped_column(nullable=False, default=0)
+
+
 class DepartmentUser(BaseModel):
     """Association table for department-user relationships"""
     __tablename__ = "department_user"
@@ -0,0 +1,67 @@
+# Gunicorn settings, used with `gunicorn --config gunicorn.conf.py`.
+#
+# The app is created once in the master with the ATT&CK mapping loaded,
+# and the workers forked from it share that memory copy-on-write instead
+# of each loading their own copy. Set GUNICORN_PRELOAD=false to load the
+# app in every worker instead. Either way every worker starts its own
+# migration and retention threads, the master runs none.
+import gc
+import os
+import tempfile
+
+wsgi_app = 'app:create_app()'
+bind = f":{os.getenv('WEB_PORT', '5000')}"
+workers = int(os.getenv('WORKER_THREADS', 2))
+
+if workers > 1:
+    # Each worker counts its own requests, /metrics reports their sum
+    os.environ.setdefault(
+        'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'gunicorn-metrics')
+    )
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True').strip().lower() \
+    in {'1', 'true', 't', 'yes', 'y', 'on'}
+if preload_app:
+    # Built in the master so the workers inherit it
+    os.environ.setdefault('PRELOAD_MAPPING', 'true')
+    # Threads do not survive forking, post_fork starts them in the workers
+    os.environ['START_BACKGROUND_TASKS'] = 'false'
+
+
+def on_starting(server):
+    """Remove the metrics of workers from an earlier run."""
+    directory = os.getenv('METRICS_DIR')
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith('metrics-') and name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+
+
+def pre_fork(server, worker):
+    """
+    Move everything loaded so far out of reach of the garbage collector,
+    so collections in the workers do not write to the shared pages.
+    """
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    """
+    Drop the database connections inherited from the master without
+    closing them, each worker opens its own. Then start the background
+    threads create_app skipped in the master.
+    """
+    if not preload_app:
+        return
+    try:
+        from app import start_background_tasks
+    except ImportError:
+        from api.app import start_background_tasks
+
+    app = server.app.wsgi()
+    with app.app_context():
+        for engine in app.db.engines.values():
+            engine.dispose(close=False)
+    start_background_tasks(app)
@@ -0,0 +1,133 @@
+# Logging as JSON lines, correlated by the id of the request.
+import json
+import logging
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+
+# Header carrying the request id from the proxy and back to the client
+REQUEST_ID_HEADER = 'X-Request-Id'
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# Loggers of events logged for most requests, only kept for
+# LOG_SAMPLE_RATE of the requests. Warnings and errors are always kept.
+SAMPLED_LOGGERS = ('api.requests', 'api.convert')
+
+# Attributes every LogRecord has, anything else was passed as extra
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {
+    'message', 'asctime', 'request_id',
+}
+
+
+def current_request_id() -> str | None:
+    if not has_request_context():
+        return None
+    return g.get('request_id')
+
+
+class RequestIdFilter(logging.Filter):
+    """Add the id of the current request to every record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Drop info and debug records of requests not sampled for logging."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not has_request_context():
+            return True
+        return g.get('log_sampled', True)
+
+
+class StdoutHandler(logging.StreamHandler):
+    """Write to sys.stdout as it is when logging, like logging.lastResort."""
+
+    def __init__(self) -> None:
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the extra fields passed to it."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id is not None:
+            entry['request_id'] = request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(app) -> None:
+    """
+    Log to stdout at LOG_LEVEL, as JSON lines or as plain text with
+    LOG_FORMAT=text. Configuring again replaces the earlier handler.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if getattr(handler, 'api_handler', False):
+            root.removeHandler(handler)
+
+    handler = StdoutHandler()
+    handler.api_handler = True
+    handler.addFilter(RequestIdFilter())
+    if app.config['LOG_FORMAT'] == 'text':
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: '
+            '%(message)s'
+        ))
+    else:
+        handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    logging.getLogger('api').setLevel(app.config['LOG_LEVEL'].upper())
+
+    for name in SAMPLED_LOGGERS:
+        logger = logging.getLogger(name)
+        for sampling_filter in [f for f in logger.filters
+                                if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(sampling_filter)
+        logger.addFilter(SamplingFilter())
+
+
+def register_request_id(app) -> None:
+    """
+    Give every request an id, taken from the X-Request-Id header when
+    the proxy sets one, and decide whether it is sampled for logging.
+    """
+    sample_rate = app.config['LOG_SAMPLE_RATE']
+
+    @app.before_request
+    def assign_request_id():
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        g.request_id = request_id
+        g.log_sampled = sample_rate >= 1 or random.random() < sample_rate
+
+    @app.after_request
+    def add_request_id(response):
+        request_id = g.get('request_id')
+        if request_id is not None:
+            response.headers[REQUEST_ID_HEADER] = request_id
+        return response
@@ -0,0 +1,286 @@
+# Metrics of the running app, exposed at /metrics in the Prometheus format.
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import Response, g, request
+
+logger = logging.getLogger('api.metrics')
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)  # seconds
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+FILE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000)
+RULE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+# Seconds between writing the metrics of a worker to METRICS_DIR
+FLUSH_INTERVAL = 1.0
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of one process. With a directory
+    every process writes its values there, so any of them can report
+    the sum over all workers.
+    """
+
+    def __init__(self, directory: str | None = None) -> None:
+        self.directory = directory
+        # name -> (type, help, buckets)
+        self.definitions: dict[str, tuple[str, str, tuple | None]] = {}
+        # name -> labels -> value, or bucket counts and sum for histograms
+        self.values: dict[str, dict[tuple, float | list]] = {}
+        # Functions returning (name, labels, value) tuples when collected
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.last_flush = 0.0
+        # Process the snapshot file belongs to, see snapshot_path
+        self.pid = None
+        self.nonce = None
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._define(name, 'counter', help_text)
+
+    def gauge(self, name: str, help_text: str) -> None:
+        self._define(name, 'gauge', help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple) -> None:
+        self._define(name, 'histogram', help_text, buckets)
+
+    def _define(self, name, kind, help_text, buckets=None) -> None:
+        self.definitions[name] = (kind, help_text, buckets)
+        self.values[name] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        buckets = self.definitions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            counts = series.get(key)
+            if counts is None:
+                # One count per bucket, one above all buckets and the sum
+                counts = series[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict[str, list]:
+        """The current values of this process in a JSON friendly form."""
+        with self.lock:
+            snapshot = {
+                name: [[list(key), value if isinstance(value, float | int)
+                        else list(value)] for key, value in series.items()]
+                for name, series in self.values.items()
+            }
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                snapshot[name].append([sorted(labels.items()), value])
+        return snapshot
+
+    def snapshot_path(self) -> str:
+        """
+        The file of this process. A nonce keeps a recycled PID from
+        overwriting the values of an earlier worker, the gunicorn master
+        removes the files of stopped workers when starting.
+        """
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid, self.nonce = pid, uuid.uuid4().hex
+        return os.path.join(self.directory,
+                            f'metrics-{pid}-{self.nonce}.json')
+
+    def flush(self) -> None:
+        """Write the values of this process for the other workers."""
+        if self.directory is None:
+            return
+        self.last_flush = time.monotonic()
+        path = self.snapshot_path()
+        with open(f'{path}.tmp', 'w') as F:
+            json.dump(self.snapshot(), F)
+        os.replace(f'{path}.tmp', path)
+
+    def maybe_flush(self) -> None:
+        if self.directory is not None \
+                and time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def collect(self) -> dict[str, dict[tuple, float | list]]:
+        """Values summed over all workers, gauges take the largest value."""
+        if self.directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name)) as F:
+                        snapshots.append(json.load(F))
+                except (OSError, ValueError) as e:
+                    logger.warning("Skipping metrics file %s: %s",
+                                   name, e)
+
+        merged = {name: {} for name in self.definitions}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                if name not in self.definitions:
+                    continue
+                kind = self.definitions[name][0]
+                for labels, value in series:
+                    key = tuple(tuple(label) for label in labels)
+                    current = merged[name].get(key)
+                    if current is None:
+                        merged[name][key] = value
+                    elif kind == 'histogram':
+                        merged[name][key] = [a + b for a, b
+                                             in zip(current, value)]
+                    elif kind == 'gauge':
+                        merged[name][key] = max(current, value)
+                    else:
+                        merged[name][key] = current + value
+        return merged
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, series in self.collect().items():
+            kind, help_text, buckets = self.definitions[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(series.items()):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(key)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    labels = format_labels(key + (('le', str(bound)),))
+                    lines.append(f'{name}_bucket{labels} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(key)} {value[-1]}')
+                lines.append(f'{name}_count{format_labels(key)} '
+                             f'{cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(key: tuple) -> str:
+    if not key:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in key
+    )
+    return '{' + labels + '}'
+
+
+def cache_collector(cache_name: str, cache):
+    """Report the hits and misses a QueryCache counts itself."""
+    def collect():
+        return [
+            ('cache_hits_total', {'cache': cache_name}, cache.hits),
+            ('cache_misses_total', {'cache': cache_name}, cache.misses),
+        ]
+    return collect
+
+
+def mapping_collector(mapping_load_seconds):
+    """Report the load time once the mapping is loaded."""
+    def collect():
+        seconds = mapping_load_seconds()
+        if seconds is None:
+            return []
+        return [('mapping_load_duration_seconds', {}, seconds)]
+    return collect
+
+
+def register_metrics(app, mapping_load_seconds) -> None:
+    """
+    Collect metrics and serve them at /metrics if METRICS_ENABLED.
+    mapping_load_seconds returns how long loading the mapping took,
+    or None while it is not loaded.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    directory = app.config['METRICS_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    registry = MetricsRegistry(directory or None)
+    registry.histogram('http_request_duration_seconds',
+                       'Time spent handling requests per route.',
+                       LATENCY_BUCKETS)
+    registry.counter('http_requests_total',
+                     'Requests handled per route and status.')
+    registry.histogram('db_queries_per_request',
+                       'Database queries executed per request.',
+                       QUERY_BUCKETS)
+    registry.histogram('db_query_duration_seconds',
+                       'Time spent executing queries per request.',
+                       LATENCY_BUCKETS)
+    registry.counter('uploads_total', 'Reports uploaded.')
+    registry.counter('conversions_total',
+                     'Reports converted, not served from the cache.')
+    registry.histogram('aggregate_files',
+                       'Files combined per aggregate request.',
+                       FILE_BUCKETS)
+    registry.histogram('aggregate_rules',
+                       'Rules combined per aggregate request.',
+                       RULE_BUCKETS)
+    registry.counter('cache_hits_total', 'Cache hits per cache.')
+    registry.counter('cache_misses_total', 'Cache misses per cache.')
+    registry.gauge('mapping_load_duration_seconds',
+                   'Time it took to load the ATT&CK mapping.')
+    registry.collectors.append(mapping_collector(mapping_load_seconds))
+    for cache_name in ('query', 'conversion'):
+        cache = app.extensions.get(f'{cache_name}_cache')
+        if cache is not None:
+            registry.collectors.append(cache_collector(cache_name, cache))
+    app.extensions['metrics'] = registry
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.observe('http_request_duration_seconds',
+                         time.perf_counter() - start,
+                         route=route, method=request.method)
+        registry.inc('http_requests_total', route=route,
+                     method=request.method, status=response.status_code)
+        stats = g.get('query_stats')
+        if stats is not None:
+            registry.observe('db_queries_per_request', stats.count,
+                             route=route)
+            registry.observe('db_query_duration_seconds', stats.duration,
+                             route=route)
+        registry.maybe_flush()
+        return response
+
+    @app.get('/metrics')
+    def get_metrics():
+        """Metrics of all workers for Prometheus"""
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    atexit.register(registry.flush)
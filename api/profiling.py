@@ -0,0 +1,220 @@
+# Profiling single requests on demand of a super admin.
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, request
+
+logger = logging.getLogger('api.profiling')
+
+# Header naming the profiler to run a request under
+PROFILE_HEADER = 'X-Profile'
+# Header of the response naming the saved profile
+PROFILE_ID_HEADER = 'X-Profile-Id'
+# Frames recorded per allocation by the memory profiler
+TRACEMALLOC_FRAMES = 25
+# Lines shown in the text summary of a profile
+SUMMARY_LINES = 40
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Both profilers are process wide, so one request is profiled at a time
+_profile_lock = threading.Lock()
+
+
+class CpuProfile:
+    """Function call statistics, readable with pstats or snakeviz."""
+    kind = 'cpu'
+    suffix = '.prof'
+
+    def __init__(self) -> None:
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self) -> dict:
+        self.profiler.disable()
+        return {}
+
+    def save(self, path: str) -> None:
+        self.profiler.dump_stats(path)
+
+    @staticmethod
+    def summary(path: str) -> str:
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats('cumulative') \
+            .print_stats(SUMMARY_LINES)
+        return out.getvalue()
+
+
+class MemoryProfile:
+    """
+    Peak memory of the request and the allocations still held when it
+    ends, readable with tracemalloc.Snapshot.load. Allocations of other
+    requests served at the same time are included.
+    """
+    kind = 'memory'
+    suffix = '.tracemalloc'
+
+    def __init__(self) -> None:
+        # Leave tracing alone if it was started with PYTHONTRACEMALLOC
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+        self.snapshot = None
+
+    def stop(self) -> dict:
+        self.snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if self.started:
+            tracemalloc.stop()
+        return {'peak_bytes': peak}
+
+    def save(self, path: str) -> None:
+        self.snapshot.dump(path)
+
+    @staticmethod
+    def summary(path: str) -> str:
+        snapshot = tracemalloc.Snapshot.load(path)
+        stats = snapshot.statistics('lineno')
+        return '\n'.join(str(stat) for stat in stats[:SUMMARY_LINES]) + '\n'
+
+
+PROFILERS = {profiler.kind: profiler
+             for profiler in (CpuProfile, MemoryProfile)}
+
+
+def list_profiles(directory: str | None) -> list[dict]:
+    """Saved profiles, newest first."""
+    if not directory or not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as F:
+                profiles.append(json.load(F))
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping profile %s: %s", name, e)
+    return sorted(profiles, key=lambda profile: profile['created'],
+                  reverse=True)
+
+
+def find_profile(directory: str | None,
+                 profile_id: str) -> tuple[dict, str] | None:
+    """The description and stats file of a saved profile"""
+    if not directory or not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(directory, f'{profile_id}.json')) as F:
+            profile = json.load(F)
+    except (OSError, ValueError):
+        return None
+    path = os.path.join(directory,
+                        profile_id + PROFILERS[profile['kind']].suffix)
+    if not os.path.exists(path):
+        return None
+    return profile, path
+
+
+def remove_old_profiles(directory: str, keep: int) -> None:
+    for profile in list_profiles(directory)[keep:]:
+        suffix = PROFILERS[profile['kind']].suffix
+        for name in (f"{profile['id']}.json", profile['id'] + suffix):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def register_profiling(app) -> None:
+    """
+    Run requests of super admins sending the X-Profile header under the
+    requested profiler and save the result to PROFILE_DIR. Needs to be
+    registered after the authentication hook. Without PROFILE_DIR the
+    header is ignored.
+    """
+    directory = app.config['PROFILE_DIR']
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    keep = app.config['PROFILE_KEEP']
+
+    @app.before_request
+    def start_profile():
+        kind = request.headers.get(PROFILE_HEADER)
+        if kind is None:
+            return None
+        if not g.get('is_super_admin'):
+            return {'message': 'Super admin privileges required'}, 403
+        profiler = PROFILERS.get(kind.strip().lower())
+        if profiler is None:
+            return {
+                'message': f"{PROFILE_HEADER} must be one of: "
+                           f"{', '.join(PROFILERS)}"
+            }, 400
+        if not _profile_lock.acquire(blocking=False):
+            return {'message': 'Another request is being profiled'}, 409
+        g.profile_start = time.perf_counter()
+        try:
+            g.profile = profiler()
+        except Exception:
+            _profile_lock.release()
+            raise
+        return None
+
+    def stop_profile() -> tuple[CpuProfile | MemoryProfile, dict] | None:
+        profile = g.pop('profile', None)
+        if profile is None:
+            return None
+        try:
+            details = profile.stop()
+        finally:
+            _profile_lock.release()
+        details['duration_ms'] = round(
+            (time.perf_counter() - g.pop('profile_start')) * 1000, 2
+        )
+        return profile, details
+
+    @app.after_request
+    def save_profile(response):
+        stopped = stop_profile()
+        if stopped is None:
+            return response
+        profile, details = stopped
+        profile_id = uuid.uuid4().hex
+        try:
+            profile.save(os.path.join(directory, profile_id + profile.suffix))
+            with open(os.path.join(directory, f'{profile_id}.json'),
+                      'w') as F:
+                json.dump({
+                    'id': profile_id,
+                    'kind': profile.kind,
+                    'method': request.method,
+                    'path': request.full_path.rstrip('?'),
+                    'status': response.status_code,
+                    'user': g.get('current_user'),
+                    'created': datetime.now(timezone.utc).isoformat(),
+                    **details,
+                }, F)
+            remove_old_profiles(directory, keep)
+        except OSError:
+            logger.exception("Error saving profile")
+            return response
+        response.headers[PROFILE_ID_HEADER] = profile_id
+        return response
+
+    @app.teardown_request
+    def discard_profile(exception=None):
+        # Only left when the request failed before the response was made
+        stop_profile()
@@ -0,0 +1,146 @@
+# Deleting reports no longer kept by the retention policy of their department.
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    from db.db import db
+    from db.db_methods import get_retention_policies, get_expired_files, \
+        delete_files, optimize_database, get_department, \
+        lock_unused_storage_paths
+    from storage import maintenance_lock, to_absolute_path, \
+        remove_upload_dir, find_legacy_file
+    from utils import ClientException
+except ImportError:
+    from .db.db import db
+    from .db.db_methods import get_retention_policies, get_expired_files, \
+        delete_files, optimize_database, get_department, \
+        lock_unused_storage_paths
+    from .storage import maintenance_lock, to_absolute_path, \
+        remove_upload_dir, find_legacy_file
+    from .utils import ClientException
+
+logger = logging.getLogger('api.retention')
+
+# Files deleted per transaction, keeps the write lock short for uploads
+RETENTION_BATCH_SIZE = 500
+
+
+def file_size(upload_folder: str, file_id: str, size: int | None) -> int:
+    """Size of a file, looked up on disk when it was not recorded."""
+    if size is not None:
+        return size
+    try:
+        return os.path.getsize(find_legacy_file(upload_folder, file_id)[1])
+    except (OSError, ClientException):
+        return 0
+
+
+def delete_expired_files(upload_folder: str, file_ids: list[str],
+                         batch_size: int = RETENTION_BATCH_SIZE) -> int:
+    """
+    Delete files with their rows in batches. Stored reports are removed
+    once no file references them anymore. Needs an app context.
+    :returns: Number of bytes freed on disk.
+    """
+    freed = 0
+    for start in range(0, len(file_ids), batch_size):
+        try:
+            deleted, unused = delete_files(file_ids[start:start + batch_size])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        for row in deleted:
+            if row.content_hash is None:
+                freed += remove_upload_dir(upload_folder, row.id)
+        if not unused:
+            continue
+        # Removed while holding the write lock, so an upload can not store
+        # the same report again in between. Segments are append only, so
+        # they are removed once empty.
+        try:
+            for storage_path in lock_unused_storage_paths(
+                    sorted({storage_path for storage_path, _ in unused})):
+                path = to_absolute_path(upload_folder, storage_path)
+                if os.path.exists(path):
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return freed
+
+
+def run_retention(upload_folder: str, dry_run: bool = False,
+                  vacuum: bool = False,
+                  now: datetime | None = None) -> list[dict] | None:
+    """
+    Apply the retention policy of every department. Needs an app context.
+
+    :param dry_run: Only report what would be deleted.
+    :param vacuum: Rebuild the database file afterwards to free space.
+    :param now: Time the policies are applied at, the current time if None.
+    :returns: Per department the number of reports and their total size,
+    None if another maintenance job is running.
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    # time_created is stored as naive UTC
+    now = now.astimezone(timezone.utc).replace(tzinfo=None)
+
+    with maintenance_lock(upload_folder) as acquired:
+        if not acquired:
+            return None
+
+        report = []
+        for policy in get_retention_policies():
+            expired = get_expired_files(policy, now)
+            department = get_department(policy.department_id)
+            entry = {
+                'department_id': policy.department_id,
+                'department': department.name if department else None,
+                'reports': len(expired),
+                'bytes': sum(file_size(upload_folder, file_id, size)
+                             for file_id, size in expired),
+            }
+            if not dry_run:
+                entry['freed_bytes'] = delete_expired_files(
+                    upload_folder, [file_id for file_id, _ in expired]
+                )
+            report.append(entry)
+
+        if not dry_run and any(entry['reports'] for entry in report):
+            optimize_database(vacuum)
+        return report
+
+
+def start_retention_schedule(app) -> threading.Thread:
+    """Apply the retention policies periodically in a background thread."""
+    interval = app.config['RETENTION_INTERVAL_HOURS'] * 3600
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    report = run_retention(
+                        app.config['UPLOAD_FOLDER'],
+                        vacuum=app.config['RETENTION_VACUUM']
+                    )
+            except Exception:
+                logger.exception("Error applying retention policies")
+                continue
+            if report:
+                deleted = sum(entry['reports'] for entry in report)
+                freed = sum(entry['freed_bytes'] for entry in report)
+                logger.info("Retention deleted %d reports, freeing %d "
+                            "bytes", deleted, freed)
+
+    thread = threading.Thread(target=run, name='retention', daemon=True)
+    thread.start()
+    return thread
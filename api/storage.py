@@ -0,0 +1,466 @@
+# Resolving where uploaded files are stored in the upload folder.
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import NamedTuple
+
+from werkzeug.utils import secure_filename
+
+try:
+    from utils import ClientException
+    from db.db_methods import get_storage_paths, update_storage_path, \
+        get_files_without_blob, update_report_blob, get_cold_report_blobs, \
+        pack_report_blobs
+except ImportError:
+    from .utils import ClientException
+    from .db.db_methods import get_storage_paths, update_storage_path, \
+        get_files_without_blob, update_report_blob, get_cold_report_blobs, \
+        pack_report_blobs
+
+try:
+    import fcntl
+except ImportError:  # Windows, only a single process is expected there
+    fcntl = None
+
+logger = logging.getLogger('api.storage')
+
+# Held by any job moving or deleting stored files
+MAINTENANCE_LOCK_FILE = '.maintenance.lock'
+# Directory in the upload folder holding the packed cold reports
+SEGMENT_DIR = 'segments'
+# A segment is closed once it grows past this size
+SEGMENT_MAX_SIZE = 256 * 1024 * 1024  # bytes
+
+
+class PackedReport(NamedTuple):
+    """A report stored in a segment together with other reports."""
+    path: str
+    offset: int
+    size: int
+
+
+def validate_file_id(file_id: str) -> str:
+    """Normalize a file id and make sure it is safe to use in a path."""
+    # UUIDs are not case-sensitive
+    file_id = file_id.lower()
+    # Ensure file_id is safe to use as a filename
+    if secure_filename(file_id) != file_id:
+        raise ClientException("Invalid file id", 400)
+    return file_id
+
+
+def upload_dir(file_id: str) -> str:
+    """
+    Directory of an upload relative to the upload folder.
+    Uploads are spread over two levels of subdirectories named after
+    the start of their id, so no directory holds too many entries.
+    """
+    return f'{file_id[:2]}/{file_id[2:4]}/{file_id}'
+
+
+def upload_dir_path(upload_folder: str, file_id: str) -> str:
+    """Absolute directory of an upload in the sharded layout."""
+    return os.path.join(upload_folder, *upload_dir(file_id).split('/'))
+
+
+def make_storage_path(file_id: str, filename: str) -> str:
+    """Path relative to the upload folder where a new upload is stored."""
+    # Always stored with forward slashes so the database is portable
+    return f'{upload_dir(file_id)}/{filename}'
+
+
+def make_blob_path(content_hash: str) -> str:
+    """Path relative to the upload folder of a report stored by its hash."""
+    return f'{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.json'
+
+
+def to_absolute_path(upload_folder: str, storage_path: str) -> str:
+    """Turn a path relative to the upload folder into an absolute one."""
+    return os.path.join(upload_folder, *storage_path.split('/'))
+
+
+def hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def store_blob(upload_folder: str, storage_path: str,
+               content: bytes) -> None:
+    """
+    Store a report at its content addressed path,
+    identical reports are only written once.
+    """
+    path = to_absolute_path(upload_folder, storage_path)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Only ever expose a complete file, even with concurrent writers
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as F:
+            F.write(content)
+        os.replace(tmp_path, path)
+
+
+def place_file(source_path: str, target_path: str) -> None:
+    """
+    Make a file available at a new path without moving it yet,
+    so readers of the old path are not interrupted.
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    # Only ever expose a complete file at the new path
+    tmp_path = f'{target_path}.migrating'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copy2(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
+def find_file(upload_folder: str, file_id: str) \
+        -> tuple[str, str | PackedReport]:
+    """Find a file by its unique id in the Uploads folder.
+    :returns: Filename and path to the file tuple."""
+    return find_files(upload_folder, [file_id])[0]
+
+
+def find_files(upload_folder: str, file_ids: list[str]) \
+        -> list[tuple[str, str | PackedReport]]:
+    """
+    Find many files by their unique ids, using the storage paths
+    recorded in the database instead of searching the upload folder.
+    Reports packed into a segment are found as a PackedReport,
+    either kind of path is read with open_report or read_report.
+    :returns: Filename and path tuples in the same order as the ids.
+    """
+    file_ids = [validate_file_id(file_id) for file_id in file_ids]
+    stored = get_storage_paths(file_ids)
+
+    files = []
+    for file_id in file_ids:
+        if file_id in stored:
+            filename, storage_path, offset, size = stored[file_id]
+            path = to_absolute_path(upload_folder, storage_path)
+            if offset is not None:
+                path = PackedReport(path, offset, size)
+            files.append((filename, path))
+        else:
+            files.append(find_legacy_file(upload_folder, file_id))
+    return files
+
+
+def open_report(location: str | PackedReport):
+    """Open a report found by find_files for reading as text."""
+    if isinstance(location, PackedReport):
+        # Only the bytes of this report are read from the segment
+        with open(location.path, 'rb') as F:
+            F.seek(location.offset)
+            content = F.read(location.size)
+        return io.StringIO(content.decode('utf-8'))
+    return open(location, 'r', encoding='utf-8')
+
+
+def read_report(upload_folder: str, file_id: str,
+                location: str | PackedReport):
+    """
+    Load a report found by find_files. The maintenance jobs remove the
+    old file of a report once its new place is recorded, so a location
+    found before that is looked up again once.
+    """
+    try:
+        with open_report(location) as F:
+            return json.load(F)
+    except FileNotFoundError:
+        _, location = find_file(upload_folder, file_id)
+    with open_report(location) as F:
+        return json.load(F)
+
+
+def find_legacy_file(upload_folder: str, file_id: str) -> tuple[str, str]:
+    """
+    Find a file without a recorded storage path
+    by looking into its directory in the upload folder.
+    Uploads not migrated to the sharded layout yet are checked first.
+    :returns: Filename and path to the file tuple."""
+    file_dir = os.path.join(upload_folder, file_id)
+    # Check if a folder with the id exists,
+    # short ids could clash with the shard directories
+    if len(file_id) <= 2 or not os.path.isdir(file_dir):
+        file_dir = upload_dir_path(upload_folder, file_id)
+        if not os.path.isdir(file_dir):
+            raise ClientException("No file by this id found", 404)
+
+    # The folder should contain exactly one file
+    files = os.listdir(file_dir)
+
+    # Should not happen
+    if len(files) > 1:
+        raise ClientException("Multiple files found", 500)
+    elif len(files) == 0:
+        raise ClientException("No file found", 500)
+
+    return files[0], os.path.join(file_dir, files[0])
+
+
+def remove_upload_dir(upload_folder: str, file_id: str) -> int:
+    """
+    Remove the directory of an upload not stored by content hash,
+    in either the flat or the sharded layout.
+    :returns: Number of bytes freed.
+    """
+    freed = 0
+    candidates = [upload_dir_path(upload_folder, file_id)]
+    # Short ids could clash with the shard directories
+    if len(file_id) > 2:
+        candidates.append(os.path.join(upload_folder, file_id))
+    for file_dir in candidates:
+        if os.path.isdir(file_dir):
+            freed += sum(entry.stat().st_size
+                         for entry in os.scandir(file_dir) if entry.is_file())
+            shutil.rmtree(file_dir)
+    return freed
+
+
+def is_legacy_upload_dir(entry: os.DirEntry) -> bool:
+    """Whether a directory in the upload folder is a not migrated upload."""
+    # Shard directories have two character names, the lock file is hidden
+    return entry.is_dir() and len(entry.name) > 2 \
+        and not entry.name.startswith('.') and entry.name != SEGMENT_DIR
+
+
+@contextmanager
+def maintenance_lock(upload_folder: str):
+    """
+    Make sure only one process moves or deletes stored files at a time.
+    Yields whether the lock was acquired.
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    with open(os.path.join(upload_folder, MAINTENANCE_LOCK_FILE), 'w') as F:
+        try:
+            fcntl.flock(F, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(F, fcntl.LOCK_UN)
+
+
+def migrate_upload(upload_folder: str, file_id: str) -> bool:
+    """
+    Move one upload from the flat layout into the sharded layout.
+    The file is linked into place and recorded before the old directory
+    is removed, so the upload stays readable the whole time with
+    read_report.
+    """
+    old_dir = os.path.join(upload_folder, file_id)
+    files = os.listdir(old_dir)
+    if len(files) != 1:
+        logger.warning("Skipping migration of %s, expected one file "
+                       "but found %d", old_dir, len(files))
+        return False
+
+    filename = files[0]
+    old_path = os.path.join(old_dir, filename)
+    storage_path = make_storage_path(file_id, filename)
+    new_path = to_absolute_path(upload_folder, storage_path)
+    place_file(old_path, new_path)
+
+    update_storage_path(file_id, storage_path, os.path.getsize(new_path))
+    shutil.rmtree(old_dir)
+    return True
+
+
+def migrate_uploads(upload_folder: str, limit: int | None = None) \
+        -> int | None:
+    """
+    Move uploads stored directly in the upload folder
+    into the sharded layout. Needs an app context.
+
+    :param limit: Maximum number of uploads to move, all if None.
+    :returns: Number of uploads moved,
+    None if another maintenance job is running.
+    """
+    with maintenance_lock(upload_folder) as acquired:
+        if not acquired:
+            return None
+
+        moved = 0
+        with os.scandir(upload_folder) as entries:
+            legacy_ids = [entry.name for entry in entries
+                          if is_legacy_upload_dir(entry)]
+        for file_id in legacy_ids:
+            if limit is not None and moved >= limit:
+                break
+            try:
+                if migrate_upload(upload_folder, file_id):
+                    moved += 1
+            except OSError as e:
+                logger.error("Failed migrating upload %s: %s", file_id, e)
+        return moved
+
+
+def deduplicate_upload(upload_folder: str, file_id: str) -> None:
+    """
+    Move one file into the content addressed store. Like the migration
+    the file stays readable from its old place until it is recorded.
+    """
+    _, old_path = find_file(upload_folder, file_id)
+    with open(old_path, 'rb') as F:
+        content_hash = hash_content(F.read())
+
+    storage_path = make_blob_path(content_hash)
+    new_path = to_absolute_path(upload_folder, storage_path)
+    # An identical report might be stored already
+    placed = not os.path.exists(new_path)
+    if placed:
+        place_file(old_path, new_path)
+
+    stored_path = update_report_blob(file_id, content_hash, storage_path,
+                                     os.path.getsize(new_path))
+    # Not needed if the identical report was packed into a segment
+    if placed and stored_path != storage_path:
+        os.remove(new_path)
+
+    # Only remove directories belonging to this upload alone
+    old_dir = os.path.dirname(old_path)
+    if os.path.basename(old_dir) == file_id:
+        shutil.rmtree(old_dir)
+
+
+def deduplicate_uploads(upload_folder: str, limit: int | None = None) \
+        -> int | None:
+    """
+    Move files stored per upload into the content addressed store,
+    so identical reports are only kept once. Needs an app context.
+
+    :param limit: Maximum number of files to move, all if None.
+    :returns: Number of files moved,
+    None if another maintenance job is running.
+    """
+    with maintenance_lock(upload_folder) as acquired:
+        if not acquired:
+            return None
+
+        moved = 0
+        for file_id in get_files_without_blob(limit):
+            try:
+                deduplicate_upload(upload_folder, file_id)
+                moved += 1
+            except (OSError, ClientException) as e:
+                logger.error("Failed deduplicating upload %s: %s",
+                             file_id, e)
+        return moved
+
+
+def make_segment_path() -> str:
+    """Path relative to the upload folder of a new segment."""
+    return f'{SEGMENT_DIR}/{uuid.uuid4().hex}.seg'
+
+
+def write_segment(upload_folder: str, blobs: list,
+                  max_size: int) -> tuple[int, int]:
+    """
+    Pack stored reports into a new segment, until it is full.
+    The segment is recorded before the separate files are removed,
+    so the reports stay readable the whole time with read_report.
+    :returns: Number of reports consumed from blobs and number packed.
+    """
+    storage_path = make_segment_path()
+    path = to_absolute_path(upload_folder, storage_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    consumed = 0
+    offsets = {}
+    sources = []
+    with open(f'{path}.tmp', 'wb') as S:
+        for blob in blobs:
+            if offsets and S.tell() + blob.size > max_size:
+                break
+            consumed += 1
+            source = to_absolute_path(upload_folder, blob.storage_path)
+            try:
+                with open(source, 'rb') as F:
+                    content = F.read()
+            except OSError as e:
+                logger.error("Failed packing report %s: %s",
+                             blob.content_hash, e)
+                continue
+            # Reads trust the recorded size, never pack a damaged file
+            if hash_content(content) != blob.content_hash \
+                    or len(content) != blob.size:
+                logger.warning("Not packing report %s, its content "
+                               "does not match the hash", blob.content_hash)
+                continue
+            offsets[blob.content_hash] = S.tell()
+            S.write(content)
+            sources.append(source)
+        S.flush()
+        os.fsync(S.fileno())
+
+    if not offsets:
+        os.remove(f'{path}.tmp')
+        return consumed, 0
+
+    os.replace(f'{path}.tmp', path)
+    pack_report_blobs(storage_path, offsets)
+    for source in sources:
+        os.remove(source)
+    return consumed, len(offsets)
+
+
+def pack_reports(upload_folder: str, cutoff: datetime,
+                 limit: int | None = None,
+                 max_size: int = SEGMENT_MAX_SIZE) -> int | None:
+    """
+    Pack reports of which every file was uploaded before the cutoff into
+    append only segments, leaving one file per segment instead of one
+    per report. Needs an app context.
+
+    :param cutoff: Naive UTC time, like time_created.
+    :param limit: Maximum number of reports to pack, all if None.
+    :param max_size: Size in bytes after which a new segment is started.
+    :returns: Number of reports packed,
+    None if another maintenance job is running.
+    """
+    with maintenance_lock(upload_folder) as acquired:
+        if not acquired:
+            return None
+
+        blobs = get_cold_report_blobs(cutoff, limit)
+        packed = 0
+        while blobs:
+            consumed, written = write_segment(upload_folder, blobs, max_size)
+            blobs = blobs[consumed:]
+            packed += written
+        return packed
+
+
+def start_background_migration(app) -> threading.Thread:
+    """Migrate the upload folder in a background thread."""
+
+    def run():
+        with app.app_context():
+            moved = migrate_uploads(app.config['UPLOAD_FOLDER'])
+            deduplicated = deduplicate_uploads(app.config['UPLOAD_FOLDER'])
+        if moved:
+            logger.info("Migrated %d uploads to the sharded layout", moved)
+        if deduplicated:
+            logger.info("Moved %d uploads to the content store",
+                        deduplicated)
+
+    thread = threading.Thread(target=run, name='upload-migration',
+                              daemon=True)
+    thread.start()
+    return thread
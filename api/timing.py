@@ -0,0 +1,81 @@
+# Timing the phases of a request, reported in the Server-Timing header.
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+
+from flask import g, request
+
+# Sampled by LOG_SAMPLE_RATE, see logs.py
+logger = logging.getLogger('api.requests')
+
+# Returned when timing is off, so timed phases cost a single lookup
+_NOT_TIMED = nullcontext()
+
+
+def timed(phase: str):
+    """
+    Time a phase of the current request if request timing is enabled.
+    Phases entered more than once in a request are added up.
+    """
+    timings = g.get('timings')
+    if timings is None:
+        return _NOT_TIMED
+    return _timer(timings, phase)
+
+
+@contextmanager
+def _timer(timings: dict, phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) \
+            + time.perf_counter() - start
+
+
+def format_server_timing(timings: dict, total: float) -> str:
+    """Format phase durations in seconds as a Server-Timing header."""
+    metrics = [f'{phase};dur={duration * 1000:.2f}'
+               for phase, duration in timings.items()]
+    metrics.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(metrics)
+
+
+def register_timing(app) -> None:
+    """
+    Time every request when REQUEST_TIMING is enabled.
+    Needs to be registered before the other request hooks
+    for those to be timed as well.
+    """
+    if not app.config['REQUEST_TIMING']:
+        return
+
+    @app.before_request
+    def start_timing():
+        g.timings = {}
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def report_timing(response):
+        timings = g.pop('timings', None)
+        if timings is None:
+            return response
+        total = time.perf_counter() - g.pop('request_start')
+        # Statements executed in any of the phases
+        stats = g.get('query_stats')
+        if stats is not None:
+            timings['sql'] = stats.duration
+
+        response.headers['Server-Timing'] = format_server_timing(timings,
+                                                                 total)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s %s', request.method, request.path, extra={
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(total * 1000, 2),
+                'timings_ms': {phase: round(duration * 1000, 2)
+                               for phase, duration in timings.items()},
+                'queries': stats.count if stats is not None else None,
+            })
+        return response
@@ -1,8 +1,3 @@
-import os
-
-from werkzeug.utils import secure_filename
-
-
 class ClientException(Exception):
     """Custom exception for client errors
      with message and status code to be returned in the response."""
@@ -17,33 +12,6 @@ class ClientException(Exception):
         return {'message': self.message}, self.status_code
 
 
-def find_file(upload_folder: str, file_id: str) -> tuple[str, str]:
-    """Find a file by its unique id in the Uploads folder.
-    :returns: Filename and path to the file tuple."""
-    # UUIDs are not case-sensitive
-    file_id = file_id.lower()
-    # Ensure file_id is safe to use as a filename
-    secure_file_id = secure_filename(file_id)
-    if secure_file_id != file_id:
-        raise ClientException("Invalid file id", 400)
-
-    file_dir = os.path.join(upload_folder, file_id)
-    # Check if a folder with the id exists
-    if not os.path.isdir(file_dir):
-        raise ClientException("No file by this id found", 404)
-
-    # The folder should contain exactly one file
-    files = os.listdir(file_dir)
-
-    # Should not happen
-    if len(files) > 1:
-        raise ClientException("Multiple files found", 500)
-    elif len(files) == 0:
-        raise ClientException("No file found", 500)
-
-    return files[0], os.path.join(file_dir, files[0])
-
-
 def validate_user_json(data: dict) -> None:
     """
     Validates the JSON payload for user creation or deletion requests.
@@ -68,3 +36,37 @@ def validate_user_json(data: dict) -> None:
             "Department ID must be an integer",
             400
         )
+
+
+def validate_retention_json(data: dict) -> tuple[int | None, int | None]:
+    """
+    Validates the JSON payload for setting a retention policy.
+
+    :param data: The incoming HTTP request JSON object
+    :raises ClientException
+    :return: max_age_days and max_reports_per_host, None when unset
+    """
+    if not isinstance(data, dict):
+        raise ClientException("Retention policy is required", 400)
+
+    limits = []
+    for field in ('max_age_days', 'max_reports_per_host'):
+        value = data.get(field)
+        # bool is a subclass of int
+        if value is not None and (
+            isinstance(value, bool) or not isinstance(value, int)
+            or value < 1
+        ):
+            raise ClientException(
+                f"{field} must be a positive integer or null",
+                400
+            )
+        limits.append(value)
+
+    if all(limit is None for limit in limits):
+        raise ClientException(
+            "At least one of max_age_days and max_reports_per_host "
+            "is required",
+            400
+        )
+    return limits[0], limits[1]
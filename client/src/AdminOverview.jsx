@@ -63,6 +63,7 @@ function AdminOverview() {
   const [activeDateTo, setActiveDateTo] = useState('');
 
   const [totalNumberOfFiles, setTotalNumberOfFiles] = useState(0);
+  const [isTotalEstimated, setIsTotalEstimated] = useState(false);
   const [currentPage, setCurrentPage] = useState(0);
   const [hasMoreFiles, setHasMoreFiles] = useState(false);
   const [pageSize] = useState(20);
@@ -203,6 +204,7 @@ function AdminOverview() {
     setActiveDateTo(dateTo);
 
     setTotalNumberOfFiles(result.pagination.total_count);
+    setIsTotalEstimated(!result.pagination.total_count_exact);
 
     // Check if there are more files to load
     const totalPages = Math.ceil(result.pagination.total_count / pageSize);
@@ -263,8 +265,14 @@ function AdminOverview() {
     setCurrentPage(nextPage);
 
     // Check if there are more files to load
+    // An estimated total may be off, so keep loading until a page is not full
     const totalPages = Math.ceil(result.pagination.total_count / pageSize);
-    setHasMoreFiles(nextPage < totalPages - 1);
+    setHasMoreFiles(result.data.length === pageSize
+      && (nextPage < totalPages - 1 || !result.pagination.total_count_exact));
+    if (result.pagination.total_count_exact) {
+      setTotalNumberOfFiles(result.pagination.total_count);
+      setIsTotalEstimated(false);
+    }
     setIsLoadingMore(false);
     loadMoreAbortController.current = null;
   }
@@ -408,7 +416,7 @@ function AdminOverview() {
                 )}
           </button>
 
-          <p>{t.showNFiles(totalNumberOfFiles)}</p>
+          <p>{t.showNFiles(isTotalEstimated ? `~${totalNumberOfFiles}` : totalNumberOfFiles)}</p>
           <h2>{t.aggregation}</h2>
           <iframe id="aggregateFrame"></iframe>
           {files.length === 0 || (selectedFiles.length === 0 && !isAllFilesChecked)
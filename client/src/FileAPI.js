@@ -351,6 +351,8 @@ export async function fetchFilesMetadata(
     url.pathname = '/api/files';
     queryParams.forEach((value, key) => url.searchParams.append(key, value));
     url.searchParams.append('verbose', 'true');
+    // Large totals may be estimated, see pagination.total_count_exact
+    url.searchParams.append('count', 'estimate');
     console.log('fetching files metadata from: ' + url.toString());
     response = await fetch(url, { signal });
   }
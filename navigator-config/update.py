@@ -1,8 +1,13 @@
+import argparse
+import hashlib
 import requests
 import json
 import os
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 import logging
 
@@ -12,10 +17,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+CONFIG_URL = (
+    "https://mitre-attack.github.io/attack-navigator/assets/config.json"
+)
+# Number of files downloaded at the same time
+DEFAULT_WORKERS = 8
+
+# Bytes read and written at a time while downloading
+CHUNK_SIZE = 1024 * 1024
+
+# Outcomes of downloading a single file
+DOWNLOADED = "downloaded"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+class IncompleteDownload(Exception):
+    """The connection closed before the whole file was received."""
+
+
+def positive_int(value):
+    """Argument type of a whole number of at least one."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"expected a positive whole number, got {value!r}"
+        )
+    return number
+
+
+def file_sha256(path):
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 class MitreAttackDownloader:
-    def __init__(self, base_dir="mitre_attack_local"):
+    def __init__(
+        self,
+        base_dir="mitre_attack_local",
+        config_url=CONFIG_URL,
+        max_workers=DEFAULT_WORKERS,
+        collections=None,
+        latest=None,
+    ):
         self.base_dir = Path(base_dir)
+        self.config_url = config_url
+        self.max_workers = max_workers
+        # Names of the collections to mirror, all when empty
+        self.collections = collections or []
+        # Number of most recent versions mirrored per collection
+        self.latest = latest
         self.base_dir.mkdir(exist_ok=True)
 
         # Create base subdirectories
@@ -28,60 +86,225 @@ class MitreAttackDownloader:
         # Track created collection directories
         self.collection_dirs = {}
 
+        # URL, validators, size and hash of every downloaded file, so
+        # later runs only download what changed
+        self.manifest_path = self.base_dir / "manifest.json"
+        self.manifest = self.load_manifest()
+
+        # One session shared by all downloads so connections are reused,
+        # with a connection per worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def load_manifest(self):
+        """The manifest of an earlier run, empty if there is none."""
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f).get("files", {})
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.warning(f"Ignoring invalid manifest: {e}")
+            return {}
+
+    def save_manifest(self):
+        """Write the manifest, replacing the old one only once complete."""
+        temp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"files": dict(sorted(self.manifest.items()))}, f, indent=2
+            )
+        os.replace(temp_path, self.manifest_path)
+
+    def manifest_key(self, local_path):
+        return local_path.relative_to(self.base_dir).as_posix()
+
     def download_file_with_retry(
-        self, url, local_path, max_retries=3, delay=1
+        self, url, local_path, max_retries=5, delay=1, headers=None
     ):
-        """Download a file with retry logic and error handling."""
+        """
+        Download a file with retry logic and error handling.
+
+        The response is streamed to a .part file next to local_path, which
+        replaces local_path once complete. A download interrupted in this
+        or an earlier run continues where it stopped with a Range request,
+        unless the file changed on the server since. Retries wait twice as
+        long as the one before, starting at delay seconds.
+
+        Returns (response, sha256 of the file), where the response is a
+        304 without saving anything if conditional headers were given and
+        the file did not change, or (None, None) if the download failed.
+        """
+        part_path = local_path.with_name(local_path.name + ".part")
+        # Validators of the partial download, to resume it only if the
+        # file did not change in between
+        part_info_path = local_path.with_name(local_path.name + ".part.json")
+
         for attempt in range(max_retries):
             try:
                 logger.info(
                     f"Downloading {url} (attempt {attempt + 1}/{max_retries})"
                 )
-                response = requests.get(url, timeout=30)
-                response.raise_for_status()
-
-                # Ensure parent directory exists
-                local_path.parent.mkdir(parents=True, exist_ok=True)
-
-                # Save the file
-                with open(local_path, "w", encoding="utf-8") as f:
-                    if url.endswith(".json"):
-                        # Pretty print JSON for readability
-                        json.dump(response.json(), f, ensure_ascii=False)
+                request_headers = dict(headers or {})
+                offset = self.resumable_offset(url, part_path, part_info_path)
+                if offset:
+                    request_headers["Range"] = f"bytes={offset}-"
+                    request_headers["If-Range"] = self.read_part_info(
+                        part_info_path
+                    )["validator"]
+                    # The part holds decoded bytes, so continue in the
+                    # representation whose ranges match those
+                    request_headers["Accept-Encoding"] = "identity"
+
+                with self.session.get(
+                    url, headers=request_headers, stream=True, timeout=30
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code == 304:
+                        logger.info(f"Not modified since last run: {url}")
+                        self.remove_partial(part_path, part_info_path)
+                        return response, None
+
+                    # Ensure parent directory exists
+                    local_path.parent.mkdir(parents=True, exist_ok=True)
+
+                    if response.status_code == 206:
+                        if not response.headers.get(
+                            "Content-Range", ""
+                        ).startswith(f"bytes {offset}-"):
+                            self.remove_partial(part_path, part_info_path)
+                            raise IncompleteDownload(
+                                "unexpected Content-Range "
+                                f"{response.headers.get('Content-Range')}"
+                            )
+                        logger.info(f"Resuming {url} from byte {offset}")
                     else:
-                        f.write(response.text)
+                        offset = 0
+                        self.write_part_info(part_info_path, url, response)
+                    digest = self.stream_to_file(response, part_path, offset)
+
+                if url.endswith(".json"):
+                    self.check_json_start(part_path)
+                os.replace(part_path, local_path)
+                part_info_path.unlink(missing_ok=True)
 
                 logger.info(f"Successfully downloaded to {local_path}")
-                return True
+                return response, digest.hexdigest()
 
-            except requests.exceptions.RequestException as e:
+            except (
+                requests.exceptions.RequestException,
+                IncompleteDownload,
+            ) as e:
                 logger.error(f"Attempt {attempt + 1} failed for {url}: {e}")
+                if isinstance(e, requests.exceptions.HTTPError) and (
+                    e.response.status_code == 416
+                ):
+                    # The partial download is not a part of this file
+                    self.remove_partial(part_path, part_info_path)
                 if attempt < max_retries - 1:
-                    time.sleep(delay)
+                    time.sleep(delay * 2**attempt)
                     continue
                 else:
                     logger.error(
                         f"Failed to download {url} after {max_retries} "
                         "attempts"
                     )
-                    return False
+                    return None, None
             except json.JSONDecodeError as e:
                 logger.error(f"Invalid JSON in response from {url}: {e}")
-                return False
+                self.remove_partial(part_path, part_info_path)
+                return None, None
             except Exception as e:
                 logger.error(f"Unexpected error downloading {url}: {e}")
-                return False
-        return False
+                return None, None
+        return None, None
 
-    def fetch_config(
-        self,
-        config_url="https://mitre-attack.github.io/attack-navigator/assets/"
-        "config.json",
-    ):
+    def read_part_info(self, part_info_path):
+        try:
+            with open(part_info_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def write_part_info(self, part_info_path, url, response):
+        """Remember what a partial download can be resumed with."""
+        part_info_path.parent.mkdir(parents=True, exist_ok=True)
+        # Weak ETags can not be used with If-Range
+        etag = response.headers.get("ETag", "")
+        validator = etag if etag and not etag.startswith("W/") else (
+            response.headers.get("Last-Modified")
+        )
+        with open(part_info_path, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "validator": validator}, f)
+
+    def resumable_offset(self, url, part_path, part_info_path):
+        """Bytes of a partial download of url, 0 if it can not resume."""
+        if not part_path.is_file():
+            return 0
+        info = self.read_part_info(part_info_path)
+        if info.get("url") != url or not info.get("validator"):
+            self.remove_partial(part_path, part_info_path)
+            return 0
+        return part_path.stat().st_size
+
+    def remove_partial(self, part_path, part_info_path):
+        part_path.unlink(missing_ok=True)
+        part_info_path.unlink(missing_ok=True)
+
+    def stream_to_file(self, response, part_path, offset):
+        """
+        Write the response body to part_path after its first offset
+        bytes, and return the SHA-256 of the complete file.
+        """
+        digest = hashlib.sha256()
+        if offset:
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+
+        expected = response.headers.get("Content-Length")
+        written = 0
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                written += len(chunk)
+
+        # The length of an encoded body is checked by urllib3
+        encoded = response.headers.get("Content-Encoding", "identity")
+        if (
+            expected is not None
+            and encoded == "identity"
+            and written != int(expected)
+        ):
+            raise IncompleteDownload(
+                f"received {written} of {expected} bytes"
+            )
+        return digest
+
+    def check_json_start(self, path):
+        """
+        Reject a body that can not be a JSON document, like an HTML error
+        page, without parsing the whole file.
+        """
+        with open(path, "rb") as f:
+            start = f.read(64).lstrip()
+        if not start.startswith((b"{", b"[")):
+            raise json.JSONDecodeError(
+                "Expecting a JSON object or array",
+                start.decode("utf-8", "replace"), 0
+            )
+
+    def fetch_config(self, config_url=None):
         """Fetch the MITRE ATT&CK Navigator configuration."""
+        config_url = config_url or self.config_url
         try:
             logger.info(f"Fetching config from: {config_url}")
-            response = requests.get(config_url, timeout=30)
+            response = self.session.get(config_url, timeout=30)
             response.raise_for_status()
             config = response.json()
 
@@ -115,7 +338,7 @@ class MitreAttackDownloader:
                 f"Loading collection index from: {collection_index_url}"
             )
 
-            response = requests.get(collection_index_url, timeout=30)
+            response = self.session.get(collection_index_url, timeout=30)
             response.raise_for_status()
             collection_index = response.json()
 
@@ -152,8 +375,6 @@ class MitreAttackDownloader:
         normalized = normalized.replace("&", "and")
 
         # Replace spaces and special characters with hyphens
-        import re
-
         normalized = re.sub(r"[^\w\s-]", "", normalized)
         normalized = re.sub(r"[-\s]+", "-", normalized)
 
@@ -162,6 +383,104 @@ class MitreAttackDownloader:
 
         return normalized or "unknown"
 
+    def version_key(self, version):
+        """Sort key of a version like 16.1, newest last."""
+        return [
+            int(part)
+            for part in re.findall(r"\d+", str(version.get("version", "")))
+        ]
+
+    def select_collections(self, collection_index):
+        """
+        Keep only the selected collections, matched by their name or
+        directory name, and of those only the latest versions.
+        Raises ValueError when a selected collection is not in the index,
+        so a mistyped name does not prune the mirror.
+        """
+        selected = []
+        found = set()
+        wanted = {
+            self.normalize_collection_name(name) for name in self.collections
+        }
+        for collection in collection_index.get("collections", []):
+            name = self.normalize_collection_name(collection.get("name", ""))
+            if wanted and name not in wanted:
+                logger.info(
+                    f"Skipping collection {collection.get('name', 'Unknown')}"
+                )
+                continue
+            collection = collection.copy()
+            if self.latest and "versions" in collection:
+                latest = {
+                    id(version)
+                    for version in sorted(
+                        collection["versions"], key=self.version_key
+                    )[-self.latest:]
+                }
+                # Keep the order of the index
+                collection["versions"] = [
+                    version
+                    for version in collection["versions"]
+                    if id(version) in latest
+                ]
+            selected.append(collection)
+            found.add(name)
+
+        missing = wanted - found
+        if missing:
+            raise ValueError(
+                f"Collections not found in the index: "
+                f"{', '.join(sorted(missing))}"
+            )
+
+        selected_index = collection_index.copy()
+        selected_index["collections"] = selected
+        return selected_index
+
+    def prune(self, collection_index):
+        """
+        Remove files of collections and versions that are no longer
+        mirrored, so they are not copied into the image.
+        Returns the removed paths.
+        """
+        keep = set()
+        for collection in collection_index.get("collections", []):
+            for version in collection.get("versions", []):
+                if "url" in version:
+                    filename = os.path.basename(urlparse(version["url"]).path)
+                    keep.add(
+                        self.data_dir
+                        / self.normalize_collection_name(
+                            collection.get("name", "")
+                        )
+                        / filename
+                    )
+
+        removed = []
+        for path in sorted(self.data_dir.rglob("*")):
+            if not path.is_file():
+                continue
+            for suffix in (".part.json", ".part"):
+                if path.name.endswith(suffix):
+                    original = path.with_name(path.name[: -len(suffix)])
+                    break
+            else:
+                original = path
+            if original not in keep:
+                path.unlink()
+                self.manifest.pop(self.manifest_key(path), None)
+                removed.append(path)
+
+        for directory in sorted(self.data_dir.iterdir()):
+            if directory.is_dir() and not any(directory.iterdir()):
+                directory.rmdir()
+                self.collection_dirs.pop(directory.name, None)
+
+        if removed:
+            self.save_manifest()
+            logger.info(f"Removed {len(removed)} files no longer mirrored")
+        return removed
+
     def get_local_path_for_collection(self, collection_name, filename):
         """
         Get the appropriate local directory for a collection,
@@ -182,51 +501,86 @@ class MitreAttackDownloader:
 
         return self.collection_dirs[dir_name] / filename
 
+    def download_one(self, url, local_path):
+        """
+        Download a single file unless it is already present.
+        Returns (outcome, manifest entry, seconds).
+
+        Published ATT&CK versions do not change, so a file matching its
+        manifest entry is only requested again conditionally on its ETag
+        or Last-Modified, and not at all if the server sent neither.
+        """
+        start = time.monotonic()
+        entry = self.manifest.get(self.manifest_key(local_path))
+        headers = {}
+        if (
+            entry
+            and entry.get("url") == url
+            and local_path.is_file()
+            and local_path.stat().st_size == entry.get("size")
+        ):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            if not headers:
+                return UNCHANGED, entry, time.monotonic() - start
+
+        response, sha256 = self.download_file_with_retry(
+            url, local_path, headers=headers
+        )
+        if response is None:
+            return FAILED, None, time.monotonic() - start
+        if response.status_code == 304:
+            return UNCHANGED, entry, time.monotonic() - start
+
+        entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "size": local_path.stat().st_size,
+            "sha256": sha256,
+        }
+        return DOWNLOADED, entry, time.monotonic() - start
+
     def download_all_collections(self, collection_index):
-        """Download all collection files and update URLs to local paths."""
+        """
+        Download all collection files and update URLs to local paths.
+        Files are downloaded on a pool of max_workers threads, the
+        updated index lists them in the same order as the original.
+        """
         try:
             if "collections" not in collection_index:
                 raise KeyError("collections not found in collection index")
 
             updated_collections = []
-            total_files = 0
-            downloaded_files = 0
-            failed_files = []
-
-            # Count total files first
-            for collection in collection_index["collections"]:
-                if "versions" in collection:
-                    total_files += len(collection["versions"])
-
-            logger.info(
-                f"Found {total_files} files to download across "
-                f"{len(collection_index['collections'])} collections"
-            )
+            # (collection index, version index, url, local path)
+            downloads = []
 
-            for collection in collection_index["collections"]:
+            for i, collection in enumerate(collection_index["collections"]):
                 logger.info(
                     f"Processing collection: "
                     f"{collection.get('name', 'Unknown')}"
                 )
 
                 updated_collection = collection.copy()
-                updated_versions = []
+                updated_collections.append(updated_collection)
 
                 if "versions" not in collection:
                     logger.warning(
                         f"No versions found in collection "
                         f"{collection.get('name', 'Unknown')}"
                     )
-                    updated_collections.append(updated_collection)
                     continue
 
-                for version in collection["versions"]:
+                # Versions are replaced by their local copy once downloaded
+                updated_collection["versions"] = list(collection["versions"])
+                for j, version in enumerate(collection["versions"]):
                     if "url" not in version:
                         logger.warning(
                             f"No URL found in version "
                             f"{version.get('version', 'Unknown')}"
                         )
-                        updated_versions.append(version)
                         continue
 
                     # Extract filename from URL
@@ -234,25 +588,59 @@ class MitreAttackDownloader:
                     parsed_url = urlparse(url)
                     filename = os.path.basename(parsed_url.path)
 
-                    # Determine local path based on collection type
+                    # Determine local path based on collection type,
+                    # directories are created here before the downloads
                     local_path = self.get_local_path_for_collection(
                         collection.get("name", ""), filename
                     )
+                    downloads.append((i, j, url, local_path))
+
+            total_files = len(downloads)
+            logger.info(
+                f"Found {total_files} files to download across "
+                f"{len(collection_index['collections'])} collections"
+            )
 
-                    # Download the file
-                    if self.download_file_with_retry(url, local_path):
+            downloaded_files = 0
+            unchanged_files = 0
+            downloaded_bytes = 0
+            failed_files = []
+            start = time.monotonic()
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {
+                    pool.submit(self.download_one, url, local_path): (
+                        i, j, url, local_path
+                    )
+                    for i, j, url, local_path in downloads
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    i, j, url, local_path = futures[future]
+                    outcome, entry, seconds = future.result()
+                    if outcome == DOWNLOADED:
                         downloaded_files += 1
+                        downloaded_bytes += entry["size"]
+                    elif outcome == UNCHANGED:
+                        unchanged_files += 1
+                    if entry is not None:
+                        self.manifest[self.manifest_key(local_path)] = entry
                         # Update the version with local path
-                        updated_version = version.copy()
+                        versions = updated_collections[i]["versions"]
+                        updated_version = versions[j].copy()
                         updated_version["url"] = local_path.as_posix()
-                        updated_versions.append(updated_version)
+                        versions[j] = updated_version
                     else:
-                        failed_files.append(url)
                         # Keep original URL if download failed
-                        updated_versions.append(version)
+                        failed_files.append(url)
+                    size = entry["size"] if entry is not None else 0
+                    logger.info(
+                        f"[{done}/{total_files}] {outcome.capitalize()} "
+                        f"{local_path.name} ({size / 1e6:.1f} MB "
+                        f"in {seconds:.1f}s)"
+                    )
 
-                updated_collection["versions"] = updated_versions
-                updated_collections.append(updated_collection)
+            elapsed = time.monotonic() - start
+            self.save_manifest()
 
             # Update the collection index with new local paths
             updated_collection_index = collection_index.copy()
@@ -269,8 +657,12 @@ class MitreAttackDownloader:
                 f"Updated collection index saved to {self.updated_index_path}"
             )
             logger.info(
-                f"Download summary: {downloaded_files}/{total_files} "
-                "files downloaded successfully"
+                f"Download summary: "
+                f"{downloaded_files + unchanged_files}/{total_files} "
+                f"files available locally, {unchanged_files} unchanged, "
+                f"{downloaded_files} downloaded with "
+                f"{downloaded_bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+                f"({downloaded_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
             )
 
             if failed_files:
@@ -286,6 +678,33 @@ class MitreAttackDownloader:
             logger.error(f"Error downloading collections: {e}")
             raise
 
+    def verify(self):
+        """
+        Hash every file of the manifest again. Files that are missing or
+        changed are dropped from the manifest, so the next run downloads
+        them again. Returns their paths.
+        """
+        damaged = []
+        for key, entry in sorted(self.manifest.items()):
+            local_path = self.base_dir / key
+            if not local_path.is_file():
+                logger.warning(f"Missing: {local_path}")
+            elif local_path.stat().st_size != entry.get("size") or (
+                file_sha256(local_path) != entry.get("sha256")
+            ):
+                logger.warning(f"Checksum mismatch: {local_path}")
+            else:
+                continue
+            damaged.append(local_path)
+            del self.manifest[key]
+
+        self.save_manifest()
+        logger.info(
+            f"Verified {len(self.manifest) + len(damaged)} files, "
+            f"{len(damaged)} missing or damaged"
+        )
+        return damaged
+
     def update_config_for_local_use(self, config):
         """Update config to use local collection index."""
         updated_config = config.copy()
@@ -309,8 +728,17 @@ class MitreAttackDownloader:
             # Step 1: Fetch config
             config = self.fetch_config()
 
-            # Step 2: Fetch collection index
-            collection_index = self.fetch_collection_index(config)
+            # Step 2: Fetch collection index, and only keep the
+            # collections and versions to mirror
+            collection_index = self.select_collections(
+                self.fetch_collection_index(config)
+            )
+            if collection_index["collections"]:
+                self.prune(collection_index)
+            else:
+                logger.warning(
+                    "No collections in the index, keeping the downloaded files"
+                )
 
             # Step 3: Download all collection files
             updated_collection_index = self.download_all_collections(
@@ -338,10 +766,52 @@ class MitreAttackDownloader:
             raise
 
 
-def main():
+def main(argv=None):
     """Example usage of the MitreAttackDownloader."""
+    parser = argparse.ArgumentParser(
+        description="Download the ATT&CK Navigator data for offline use."
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=DEFAULT_WORKERS,
+        help=f"files downloaded at the same time (default {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--collection",
+        action="append",
+        dest="collections",
+        metavar="NAME",
+        help="only mirror this collection, like enterprise-attack or "
+        "'Enterprise ATT&CK', can be given more than once (default all)",
+    )
+    parser.add_argument(
+        "--latest",
+        type=positive_int,
+        metavar="N",
+        help="only mirror the N most recent versions of each collection "
+        "(default all)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="only check the downloaded files against the manifest",
+    )
+    args = parser.parse_args(argv)
+
     try:
-        downloader = MitreAttackDownloader("mitre_attack_local")
+        downloader = MitreAttackDownloader(
+            "mitre_attack_local",
+            max_workers=args.workers,
+            collections=args.collections,
+            latest=args.latest,
+        )
+        if args.verify:
+            damaged = downloader.verify()
+            for path in damaged:
+                print(f"Download again: {path}")
+            return not damaged
+
         result = downloader.run()
 
         print(f"Data location: {result['base_dir']}")
@@ -358,4 +828,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(0 if main() else 1)
@@ -0,0 +1,135 @@
+"""
+Benchmarks of converting CIS reports with synthetic reports.
+
+Run from the project root with
+`python -m tests.benchmarks.bench_convert [--save FILE] [--compare FILE]`.
+`--save` records the results as a JSON baseline, `--compare` reports the
+change against one and exits with 1 if any benchmark got slower than the
+threshold, so a baseline saved on the main branch can be checked on
+another branch or commit. Compare baselines made on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from api import convert
+from tests.benchmarks.synthetic import generate_report, \
+    generate_host_reports
+
+
+def best_of(func, repeat: int) -> float:
+    """Return the fastest of several runs in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmarks(quick: bool) -> list[tuple[str, callable, int]]:
+    """(name, function, repeats) of every benchmark"""
+    cases = []
+    for rules in (1_000, 10_000) if quick else (1_000, 10_000, 100_000):
+        report = generate_report(rules)
+        cases.append((f'generate_techniques[{rules}]',
+                      lambda report=report:
+                      convert.generate_techniques(report), 5))
+        cases.append((f'generate_techniques_comments[{rules}]',
+                      lambda report=report:
+                      convert.generate_techniques(report, True), 5))
+
+    for hosts, rules in ((10, 1_000),) if quick \
+            else ((10, 1_000), (100, 1_000), (10, 10_000)):
+        reports = generate_host_reports(hosts, rules)
+        cases.append((f'combine_results[{hosts}x{rules}]',
+                      lambda reports=reports:
+                      convert.combine_results(reports), 3))
+
+    scores = [i / 100_000 for i in range(100_000)]
+    cases.append(('gradient_color[100000]',
+                  lambda: [convert.gradient_color(s) for s in scores], 5))
+
+    if not quick:
+        cases.append(('_load_mapping_dicts', lambda: convert
+                      ._load_mapping_dicts(convert.EX_MAP,
+                                           convert.SHEET_NAME), 3))
+    return cases
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict[str, float], baseline: dict,
+            threshold: float) -> list[str]:
+    """Names of the benchmarks slower than the baseline by threshold."""
+    regressions = []
+    print(f"\nCompared to {baseline.get('commit')} "
+          f"from {baseline.get('created')}:")
+    for name, seconds in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f'{name:45} new')
+            continue
+        change = seconds / before - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:45} {change:+8.1%}{flag}')
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown counted as a regression '
+                             '(default 0.2, 20%%)')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest reports and the mapping load')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, func, repeat in benchmarks(args.quick):
+        results[name] = best_of(func, repeat)
+        print(f'{name:45} {results[name] * 1000:10.2f} ms')
+
+    if args.save:
+        with open(args.save, 'w') as F:
+            json.dump({
+                'created': datetime.now(timezone.utc).isoformat(),
+                'commit': current_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'results': results,
+            }, F, indent=2)
+            F.write('\n')
+        print(f'\nBaseline written to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as F:
+            baseline = json.load(F)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
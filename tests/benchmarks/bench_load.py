@@ -0,0 +1,393 @@
+"""
+Load test of the API against a seeded fleet of reports.
+
+Run from the project root, first seeding a database and upload folder
+`python -m tests.benchmarks.bench_load seed --dir /tmp/fleet`
+and then driving a local gunicorn started on them
+`python -m tests.benchmarks.bench_load run --dir /tmp/fleet`.
+`run --url` targets an already running server instead, started with
+the DATABASE_URL and UPLOAD_FOLDER printed by `seed`.
+Everything runs offline, authentication is expected to be disabled.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+from api.app import create_app
+from api.db.models import Benchmark, Department, Hostname, Metadata, \
+    ReportBlob, Result
+from api.storage import hash_content, make_blob_path, store_blob
+from tests.benchmarks.synthetic import generate_report, \
+    generate_host_reports
+
+MANIFEST = 'fleet.json'
+DATABASE = 'fleet.db'
+UPLOADS = 'uploads'
+# Endpoints driven by the load test and their default share of requests
+DEFAULT_MIX = 'list=4,file=4,aggregate=1,upload=1'
+
+
+def seed(directory: str, departments: int, hosts: int, reports: int,
+         benchmarks: int, rules: int) -> dict:
+    """
+    Create a database and upload folder with hosts per department,
+    each with reports spread over the benchmarks, and a manifest of
+    the ids the load test picks from.
+    """
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    upload_folder = os.path.abspath(os.path.join(directory, UPLOADS))
+    database = os.path.abspath(os.path.join(directory, DATABASE))
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}',
+        'UPLOAD_FOLDER': upload_folder,
+        'QUERY_CACHE_SIZE': 0,
+        'LOG_LEVEL': 'WARNING',
+    })
+    session = app.db.session
+    start = datetime(2025, 1, 1)
+
+    with app.app_context():
+        department_rows = [Department(name=f'Department {d + 1}')
+                           for d in range(departments)]
+        benchmark_titles = [f'Synthetic Benchmark {b + 1}'
+                            for b in range(benchmarks)]
+        benchmark_rows = [Benchmark(name=title.replace(' ', '_'))
+                          for title in benchmark_titles]
+        result_rows = [Result(name='Passing'), Result(name='NonPassing')]
+        session.add_all(department_rows + benchmark_rows + result_rows)
+
+        # Every host is scanned `reports` times with one of the benchmarks
+        fleet = [(d, h, (d * hosts + h) % benchmarks)
+                 for d in range(departments) for h in range(hosts)]
+        host_rows = []
+        file_ids = []
+        for b, title in enumerate(benchmark_titles):
+            scans = [(d, h) for d, h, benchmark in fleet if benchmark == b]
+            contents = generate_host_reports(
+                len(scans) * reports, rules, seed=b, title=title
+            )
+            for i, (d, h) in enumerate(scans):
+                hostname = Hostname(name=f'HOST-{d + 1:03d}-{h + 1:04d}')
+                host_rows.append(hostname)
+                for r in range(reports):
+                    content = json.dumps(
+                        contents[i * reports + r], ensure_ascii=False,
+                        indent=2
+                    ).encode('utf-8')
+                    content_hash = hash_content(content)
+                    storage_path = make_blob_path(content_hash)
+                    store_blob(upload_folder, storage_path, content)
+                    session.add(ReportBlob(
+                        content_hash=content_hash, storage_path=storage_path,
+                        size=len(content), ref_count=1
+                    ))
+                    time_created = start + timedelta(days=7 * r, minutes=i)
+                    result = result_rows[(i + r) % 2]
+                    file_id = str(uuid.uuid4())
+                    file_ids.append(file_id)
+                    session.add(Metadata(
+                        id=file_id,
+                        filename=f'{hostname.name}-{title.replace(" ", "_")}'
+                                 f'-{time_created:%Y%m%dT%H%M%SZ}'
+                                 f'-{result.name}.json',
+                        ip_address='127.0.0.1',
+                        storage_path=storage_path,
+                        size=len(content),
+                        content_hash=content_hash,
+                        time_created=time_created,
+                        hostname=hostname,
+                        benchmark=benchmark_rows[b],
+                        result=result,
+                        department=department_rows[d],
+                    ))
+            session.commit()
+
+        manifest = {
+            'database_url': f'sqlite:///{database}',
+            'upload_folder': upload_folder,
+            'rules': rules,
+            'departments': [row.id for row in department_rows],
+            'benchmarks': [row.id for row in benchmark_rows],
+            'results': [row.id for row in result_rows],
+            'hostnames': [row.id for row in host_rows],
+            'file_ids': file_ids,
+        }
+    with open(os.path.join(directory, MANIFEST), 'w') as F:
+        json.dump(manifest, F)
+    return manifest
+
+
+def multipart_upload(report: dict, filename: str) -> tuple[bytes, str]:
+    """Body and content type of a form uploading the report."""
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; '
+        f'filename="{filename}"\r\n'
+        'Content-Type: application/json\r\n\r\n'
+    ).encode('utf-8') + json.dumps(report).encode('utf-8') \
+        + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Scenario:
+    """Builds the requests of each endpoint from the seeded fleet."""
+
+    def __init__(self, manifest: dict, aggregate_size: int) -> None:
+        self.manifest = manifest
+        self.aggregate_size = aggregate_size
+        # A pool of uploads keeps generating reports out of the timings
+        self.uploads = [
+            generate_report(manifest['rules'], seed=1000 + i,
+                            title='Synthetic Benchmark 1')
+            for i in range(20)
+        ]
+
+    def request(self, endpoint: str,
+                rng: random.Random) -> tuple[str, str, bytes | None, dict]:
+        """(method, path, body, headers) of a request to the endpoint"""
+        manifest = self.manifest
+        if endpoint == 'list':
+            params = [('verbose', 'true'), ('page', rng.randint(0, 4))]
+            # Usually narrowed down by one or two facets
+            for facet, key in (('department', 'departments'),
+                               ('benchmark', 'benchmarks'),
+                               ('result', 'results'),
+                               ('hostname', 'hostnames')):
+                if rng.random() < 0.4:
+                    params.append((facet, rng.choice(manifest[key])))
+            return 'GET', f'/api/files?{urlencode(params)}', None, {}
+        if endpoint == 'file':
+            file_id = rng.choice(manifest['file_ids'])
+            return 'GET', f'/api/files/{file_id}', None, {}
+        if endpoint == 'aggregate':
+            file_ids = rng.sample(manifest['file_ids'], min(
+                len(manifest['file_ids']),
+                rng.randint(2, self.aggregate_size)
+            ))
+            query = urlencode([('id', file_id) for file_id in file_ids])
+            return 'GET', f'/api/files/aggregate?{query}', None, {}
+        if endpoint == 'upload':
+            host = f'LOAD-{rng.randrange(10 ** 6):06d}'
+            filename = f'{host}-Synthetic_Benchmark_1-' \
+                       f'{datetime.now():%Y%m%dT%H%M%SZ}.json'
+            body, content_type = multipart_upload(
+                rng.choice(self.uploads), filename
+            )
+            department = rng.choice(manifest['departments'])
+            return 'POST', f'/api/files?department_id={department}', \
+                body, {'Content-Type': content_type}
+        raise ValueError(f'Unknown endpoint {endpoint}')
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(','):
+        endpoint, _, weight = part.partition('=')
+        weights[endpoint.strip()] = float(weight or 1)
+    return weights
+
+
+def drive(url: str, scenario: Scenario, mix: dict[str, float],
+          concurrency: int, duration: float,
+          seed: int) -> tuple[dict[str, list], float]:
+    """
+    Send requests from concurrency connections for duration seconds.
+    Returns the latencies and failures per endpoint and the elapsed time.
+    """
+    target = urlsplit(url)
+    endpoints = list(mix)
+    weights = [mix[endpoint] for endpoint in endpoints]
+    samples = {endpoint: [] for endpoint in endpoints}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(index: int) -> None:
+        rng = random.Random(seed + index)
+        connection = http.client.HTTPConnection(target.hostname,
+                                                target.port, timeout=120)
+        try:
+            while time.monotonic() < deadline:
+                endpoint = rng.choices(endpoints, weights)[0]
+                method, path, body, headers = scenario.request(endpoint, rng)
+                start = time.perf_counter()
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    response.read()
+                    ok = response.status < 400
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    ok = False
+                latency = time.perf_counter() - start
+                with lock:
+                    samples[endpoint].append((latency, ok))
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(client, i)
+                       for i in range(concurrency)]:
+            future.result()
+    return samples, time.perf_counter() - start
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    index = max(0, min(len(sorted_values) - 1,
+                       round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: dict[str, list], elapsed: float) -> dict[str, dict]:
+    summary = {}
+    for endpoint, results in samples.items():
+        latencies = sorted(latency for latency, _ in results)
+        if not latencies:
+            continue
+        summary[endpoint] = {
+            'requests': len(results),
+            'errors': sum(1 for _, ok in results if not ok),
+            'throughput': len(results) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    return summary
+
+
+def print_summary(summary: dict[str, dict]) -> None:
+    print(f"{'endpoint':10} {'requests':>9} {'errors':>7} {'req/s':>8} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, row in summary.items():
+        print(f"{endpoint:10} {row['requests']:9d} {row['errors']:7d} "
+              f"{row['throughput']:8.1f} {row['p50_ms']:9.1f} "
+              f"{row['p95_ms']:9.1f} {row['p99_ms']:9.1f}")
+
+
+def start_gunicorn(manifest: dict, workers: int, port: int,
+                   env: dict | None = None) -> subprocess.Popen:
+    """Start gunicorn on the seeded fleet and wait until it answers."""
+    server_env = os.environ | {
+        'DATABASE_URL': manifest['database_url'],
+        'UPLOAD_FOLDER': manifest['upload_folder'],
+        'ENABLE_SSO': 'False',
+        'LOG_LEVEL': 'WARNING',
+    } | (env or {})
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers),
+         '-b', f'127.0.0.1:{port}', 'app:create_app()'],
+        cwd=os.path.join(os.path.dirname(__file__), '..', '..', 'api'),
+        env=server_env
+    )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited while starting')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=5)
+            connection.request('GET', '/api/auth/status')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='seed a fleet')
+    seed_parser.add_argument('--dir', required=True)
+    seed_parser.add_argument('--departments', type=int, default=5)
+    seed_parser.add_argument('--hosts', type=int, default=50,
+                             help='hosts per department')
+    seed_parser.add_argument('--reports', type=int, default=4,
+                             help='reports per host')
+    seed_parser.add_argument('--benchmarks', type=int, default=3)
+    seed_parser.add_argument('--rules', type=int, default=300,
+                             help='rules per report')
+
+    run_parser = commands.add_parser('run', help='drive the API')
+    run_parser.add_argument('--dir', required=True)
+    run_parser.add_argument('--url',
+                            help='running server to target instead of '
+                                 'starting gunicorn')
+    run_parser.add_argument('--workers', type=int, default=2,
+                            help='gunicorn workers')
+    run_parser.add_argument('--port', type=int, default=8765)
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--duration', type=float, default=30,
+                            help='seconds')
+    run_parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help=f'endpoint weights (default {DEFAULT_MIX})')
+    run_parser.add_argument('--aggregate-size', type=int, default=20,
+                            help='most reports combined per aggregate')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--json', metavar='FILE',
+                            help='also write the summary as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'seed':
+        start = time.perf_counter()
+        manifest = seed(args.dir, args.departments, args.hosts,
+                        args.reports, args.benchmarks, args.rules)
+        print(f"Seeded {len(manifest['file_ids'])} reports in "
+              f"{time.perf_counter() - start:.1f} s\n"
+              f"DATABASE_URL={manifest['database_url']}\n"
+              f"UPLOAD_FOLDER={manifest['upload_folder']}")
+        return 0
+
+    with open(os.path.join(args.dir, MANIFEST)) as F:
+        manifest = json.load(F)
+    scenario = Scenario(manifest, args.aggregate_size)
+    mix = parse_mix(args.mix)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_gunicorn(manifest, args.workers, args.port)
+        url = f'http://127.0.0.1:{args.port}'
+    try:
+        samples, elapsed = drive(url, scenario, mix, args.concurrency,
+                                 args.duration, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(samples, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as F:
+            json.dump({
+                'url': url,
+                'concurrency': args.concurrency,
+                'duration': elapsed,
+                'mix': mix,
+                'endpoints': summary,
+            }, F, indent=2)
+            F.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
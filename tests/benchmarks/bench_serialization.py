@@ -0,0 +1,83 @@
+"""
+Benchmark for serializing Metadata rows to dictionaries.
+
+Run from the project root with
+`python -m tests.benchmarks.bench_serialization [rows]`.
+"""
+import json
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from api.app import create_app
+from api.db.models import Metadata, Benchmark, Department, Hostname, Result
+
+
+def seed(app, rows: int) -> None:
+    """Insert rows Metadata entries spread over a few related entries."""
+    departments = [Department(name=f'dept{i}') for i in range(5)]
+    benchmarks = [Benchmark(name=f'bench{i}') for i in range(3)]
+    results = [Result(name='Passing'), Result(name='NonPassing')]
+    hostnames = [Hostname(name=f'host{i}') for i in range(200)]
+    app.db.session.add_all(departments + benchmarks + results + hostnames)
+
+    start = datetime(2025, 1, 1)
+    app.db.session.add_all([
+        Metadata(
+            id=f'{i:036d}',
+            filename=f'host{i % 200}-bench{i % 3}-{i}.json',
+            ip_address='127.0.0.1',
+            time_created=start + timedelta(minutes=i),
+            department=departments[i % 5],
+            benchmark=benchmarks[i % 3],
+            result=results[i % 2],
+            hostname=hostnames[i % 200],
+        )
+        for i in range(rows)
+    ])
+    app.db.session.commit()
+
+
+def best_of(func, repeat: int = 5) -> float:
+    """Return the fastest of several runs in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(rows: int = 10_000) -> None:
+    upload_dir = tempfile.mkdtemp(prefix='bench_uploads_')
+    app = create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': upload_dir,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+    })
+    try:
+        with app.app_context():
+            seed(app, rows)
+            data = app.db.session.query(Metadata).all()
+
+            per_row = best_of(lambda: [item.to_dict() for item in data])
+            print(f'to_dict per row:  {per_row * 1000:8.2f} ms '
+                  f'for {len(data)} rows')
+
+            if hasattr(Metadata, 'to_dicts'):
+                bulk = best_of(lambda: Metadata.to_dicts(data))
+                print(f'to_dicts bulk:    {bulk * 1000:8.2f} ms '
+                      f'for {len(data)} rows')
+
+            dumped = best_of(
+                lambda: json.dumps([item.to_dict() for item in data])
+            )
+            print(f'to_dict + dumps:  {dumped * 1000:8.2f} ms')
+    finally:
+        shutil.rmtree(upload_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
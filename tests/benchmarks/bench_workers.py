@@ -0,0 +1,89 @@
+"""
+Memory of gunicorn workers with and without preloading the app.
+
+Run from the project root on Linux with
+`python -m tests.benchmarks.bench_workers [--workers 4]`.
+Starts gunicorn with gunicorn.conf.py once with GUNICORN_PRELOAD=true
+and once with false, both loading the mapping on startup, and reports
+the RSS and PSS of every worker. PSS divides shared pages between the
+processes sharing them, so its total is the memory actually used.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tests.benchmarks.bench_load import start_gunicorn
+
+
+def memory_kb(pid: int) -> dict[str, int]:
+    """Rss and Pss of a process in kB"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as F:
+        for line in F:
+            name, _, value = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                values[name] = int(value.split()[0])
+    return values
+
+
+def children(pid: int) -> list[int]:
+    pids = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as F:
+            pids.extend(int(child) for child in F.read().split())
+    return pids
+
+
+def measure(preload: bool, workers: int, port: int, settle: float) -> list:
+    directory = tempfile.mkdtemp(prefix='bench_workers_')
+    fleet = {
+        'database_url': f'sqlite:///{directory}/bench.db',
+        'upload_folder': os.path.join(directory, 'uploads'),
+    }
+    server = start_gunicorn(fleet, workers, port, env={
+        'GUNICORN_PRELOAD': str(preload),
+        'PRELOAD_MAPPING': 'true',
+    })
+    try:
+        deadline = time.monotonic() + 120
+        while len(children(server.pid)) < workers \
+                and time.monotonic() < deadline:
+            time.sleep(0.5)
+        # Let every worker finish loading the app
+        time.sleep(settle)
+        return [memory_kb(server.pid)] + [memory_kb(pid) for pid
+                                          in children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--settle', type=float, default=10,
+                        help='seconds to wait for the workers to load')
+    args = parser.parse_args(argv)
+
+    for preload in (False, True):
+        master, *worker_memory = measure(preload, args.workers, args.port,
+                                         args.settle)
+        print(f"\nGUNICORN_PRELOAD={str(preload).lower()}")
+        print(f"{'process':10} {'RSS MiB':>9} {'PSS MiB':>9}")
+        print(f"{'master':10} {master['Rss'] / 1024:9.1f} "
+              f"{master['Pss'] / 1024:9.1f}")
+        for i, memory in enumerate(worker_memory):
+            print(f"{f'worker {i + 1}':10} {memory['Rss'] / 1024:9.1f} "
+                  f"{memory['Pss'] / 1024:9.1f}")
+        total = sum(memory['Pss'] for memory in [master] + worker_memory)
+        print(f"{'total PSS':10} {'':9} {total / 1024:9.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+Synthetic CIS-CAT reports for benchmarks and load tests.
+
+Rule ids are shaped like the ones of real benchmarks, with recommendation
+numbers taken from the safeguards and controls of the loaded mapping, so
+the generated rules go through the same lookups as real reports.
+"""
+import random
+
+from api.convert import get_mapping
+
+# Results of CIS-CAT besides pass and fail, skipped by the conversion
+OTHER_RESULTS = ('notapplicable', 'notselected', 'error', 'unknown')
+
+RULE_ID_PREFIX = 'xccdf_org.cisecurity.benchmarks_rule_'
+
+
+def recommendation_number(rng: random.Random, unmapped_ratio: float) -> str:
+    """
+    A section number like 4.1 matching a safeguard of the mapping, one
+    only matching a control, or for unmapped_ratio one matching nothing.
+    """
+    mapping = get_mapping()
+    roll = rng.random()
+    if roll < unmapped_ratio:
+        # Past the last CIS Control, so never mapped
+        return f'{rng.randint(19, 99)}.{rng.randint(1, 20)}'
+    if roll < unmapped_ratio + 0.1:
+        # No safeguard is numbered this high
+        control = rng.choice(list(mapping.control_map))
+        return f'{control}.{rng.randint(50, 99)}'
+    return rng.choice(list(mapping.safeguard_map))
+
+
+def draw_result(rng: random.Random, pass_ratio: float,
+                other_ratio: float) -> str:
+    if rng.random() < other_ratio:
+        return rng.choice(OTHER_RESULTS)
+    return 'pass' if rng.random() < pass_ratio else 'fail'
+
+
+def generate_report(rules: int = 1000, pass_ratio: float = 0.7,
+                    other_ratio: float = 0.05, unmapped_ratio: float = 0.1,
+                    seed: int = 0, title: str = 'Synthetic Benchmark') -> dict:
+    """
+    A report of a benchmark with the given number of rules. other_ratio
+    of the rules get a result that is neither pass nor fail and
+    pass_ratio of the rest pass. The same seed gives the same report.
+    """
+    rng = random.Random(seed)
+    report_rules = []
+    for i in range(rules):
+        number = f'{recommendation_number(rng, unmapped_ratio)}.{i + 1}'
+        report_rules.append({
+            'rule-id': f'{RULE_ID_PREFIX}{number}_L1_Ensure_setting_{i + 1}'
+                       '_is_configured',
+            'rule-title': f"(L1) Ensure 'Setting {i + 1}' is configured",
+            'result': draw_result(rng, pass_ratio, other_ratio),
+        })
+
+    return {
+        'benchmark-id': 'xccdf_org.cisecurity.benchmarks_benchmark_1.0.0_'
+                        + title.replace(' ', '_'),
+        'benchmark-title': title,
+        'benchmark-version': '1.0.0',
+        'profile-id': 'xccdf_org.cisecurity.benchmarks_profile_Level_1',
+        'profile-title': 'Level 1 (L1)',
+        'score': f'{pass_ratio * 100:.2f}',
+        'rules': report_rules,
+    }
+
+
+def generate_host_reports(hosts: int, rules: int = 1000,
+                          pass_ratio: float = 0.7, other_ratio: float = 0.05,
+                          seed: int = 0, **kwargs) -> list[dict]:
+    """
+    Reports of hosts scanned with the same benchmark: the same rules
+    with results drawn per host.
+    """
+    base = generate_report(rules, pass_ratio, other_ratio, seed=seed,
+                           **kwargs)
+    reports = []
+    for host in range(hosts):
+        rng = random.Random(f'{seed}-{host}')
+        reports.append(base | {'rules': [
+            rule | {'result': draw_result(rng, pass_ratio, other_ratio)}
+            for rule in base['rules']
+        ]})
+    return reports
@@ -1,10 +1,12 @@
 import os
 import shutil
 import tempfile
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
 import pytest
 from api.app import create_app
+from api.db.db_stats import capture_queries
 from api.db.models import Metadata, BearerToken, Department, DepartmentUser, \
     Benchmark, Hostname, Result
 
@@ -255,3 +257,14 @@ def enable_authentication(
         client.application.config['ENABLE_SSO'] = True
         client.application.config['SUPER_ADMINS'] = super_admins
         client.application.config['TRUSTED_IPS'] = trusted_ips
+
+
+@contextmanager
+def assert_max_queries(app, max_queries: int):
+    """Fail if the block executes more than max_queries SQL statements"""
+    with capture_queries(app.db.engine) as statements:
+        yield statements
+    assert len(statements) <= max_queries, (
+        f"{len(statements)} queries executed, expected at most "
+        f"{max_queries}:\n" + "\n".join(statements)
+    )
@@ -0,0 +1,206 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, inspect, text
+from api.app import create_app
+from api.db.models import Metadata, Benchmark, Department, DepartmentUser, \
+    Hostname, Result
+from tests.conftest import enable_authentication
+
+DEPT_ADMIN = {
+    'X-Forwarded-User': 'dept_admin',
+    'X-Forwarded-For': '127.0.0.1'
+}
+SUPER_ADMIN = {
+    'X-Forwarded-User': 'super_admin',
+    'X-Forwarded-For': '127.0.0.1'
+}
+TIME_RANGE = 'min_time=2025-01-02T00:00:00&max_time=2025-01-03T00:00:00'
+
+# The filter combinations the admin UI produces
+FILTER_COMBINATIONS = [
+    '',
+    TIME_RANGE,
+    'department=1',
+    'benchmark=1',
+    'result=1',
+    'hostname=1',
+    f'benchmark=1&{TIME_RANGE}',
+    f'result=2&{TIME_RANGE}',
+    f'hostname=2&{TIME_RANGE}',
+    'benchmark=1&result=1&hostname=1',
+    'search=host1',
+]
+
+# A substring search over every file cannot use an index
+SUPER_ADMIN_COMBINATIONS = [
+    query for query in FILTER_COMBINATIONS if not query.startswith('search')
+]
+
+# Indexed on their own before the composite indexes replaced them
+REPLACED_INDEX_COLUMNS = ('hostname_id', 'benchmark_id', 'result_id',
+                          'department_id')
+
+
+@pytest.fixture
+def fleet(app):
+    """Enough rows spread over departments and hosts for realistic plans"""
+    departments = [Department(name=f'dept{i}') for i in range(5)]
+    benchmarks = [Benchmark(name=f'bench{i}') for i in range(3)]
+    results = [Result(name='Passing'), Result(name='NonPassing')]
+    hostnames = [Hostname(name=f'host{i}') for i in range(50)]
+    app.db.session.add_all(departments + benchmarks + results + hostnames)
+    app.db.session.flush()
+
+    start = datetime(2025, 1, 1)
+    app.db.session.add_all([
+        Metadata(
+            id=f'file_id{i}',
+            filename=f'host{i % 50}-bench{i % 3}-{i}.json',
+            time_created=start + timedelta(minutes=10 * i),
+            department=departments[i % 5],
+            benchmark=benchmarks[i % 3],
+            result=results[i % 2],
+            hostname=hostnames[i % 50],
+        )
+        for i in range(500)
+    ])
+    app.db.session.add(DepartmentUser(department_id=departments[0].id,
+                                      user_handle='dept_admin'))
+    app.db.session.commit()
+
+    # Every query should be planned, not served from the cache
+    app.extensions.pop('query_cache', None)
+
+
+@contextmanager
+def capture_query_plans(app):
+    """Record EXPLAIN QUERY PLAN of every statement touching metadata"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'metadata' in statement and statement.startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(app.db.engine, 'before_cursor_execute', record)
+    plans = []
+    try:
+        yield plans
+    finally:
+        event.remove(app.db.engine, 'before_cursor_execute', record)
+
+    connection = app.db.session.connection()
+    for statement, parameters in statements:
+        rows = connection.exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {statement}', parameters
+        ).all()
+        plans.append((statement, [row[3] for row in rows]))
+
+
+def full_table_scans(plans):
+    """Plan steps reading the whole metadata table without any index"""
+    return [
+        (statement, step)
+        for statement, steps in plans
+        for step in steps
+        if step.startswith('SCAN metadata') and 'INDEX' not in step
+    ]
+
+
+@pytest.mark.parametrize('query', FILTER_COMBINATIONS)
+@pytest.mark.parametrize('verbose', ['true', 'false'])
+def test_department_admin_queries_use_indexes(client, app, fleet,
+                                              query, verbose):
+    """Department scoped queries only ever search indexes"""
+    enable_authentication(client)
+
+    with capture_query_plans(app) as plans:
+        response = client.get(f'/api/files?verbose={verbose}&{query}',
+                              headers=DEPT_ADMIN)
+    assert response.status_code == 200
+    assert plans
+
+    scans = [
+        (statement, step)
+        for statement, steps in plans
+        for step in steps
+        if step.startswith('SCAN metadata')
+    ]
+    assert not scans, f'Query regressed to a full scan: {scans}'
+
+
+@pytest.mark.parametrize('query', FILTER_COMBINATIONS)
+def test_department_admin_page_needs_no_sort(client, app, fleet, query):
+    """The page of files is read in time_created order from an index"""
+    enable_authentication(client)
+
+    with capture_query_plans(app) as plans:
+        client.get(f'/api/files?verbose=true&{query}', headers=DEPT_ADMIN)
+
+    page_plans = [steps for statement, steps in plans
+                  if 'ORDER BY' in statement]
+    assert len(page_plans) == 1
+    assert 'USE TEMP B-TREE FOR ORDER BY' not in page_plans[0]
+
+
+@pytest.mark.parametrize('query', SUPER_ADMIN_COMBINATIONS)
+@pytest.mark.parametrize('verbose', ['true', 'false'])
+def test_super_admin_queries_avoid_table_scans(client, app, fleet,
+                                               query, verbose):
+    """
+    Super admins may need to read every row for the filter counts,
+    but that should always happen through an index.
+    """
+    enable_authentication(client)
+
+    with capture_query_plans(app) as plans:
+        response = client.get(f'/api/files?verbose={verbose}&{query}',
+                              headers=SUPER_ADMIN)
+    assert response.status_code == 200
+    assert plans
+
+    scans = full_table_scans(plans)
+    assert not scans, f'Query regressed to a full table scan: {scans}'
+
+
+def test_missing_indexes_are_created_on_startup():
+    """
+    Databases created before the composite indexes get them added,
+    and lose the single column indexes they replace
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='test_schema_')
+    config = {
+        'TESTING': True,
+        'UPLOAD_FOLDER': os.path.join(tmp_dir, 'uploads'),
+        'SQLALCHEMY_DATABASE_URI':
+            f"sqlite:///{os.path.join(tmp_dir, 'app.db')}",
+    }
+    try:
+        old_app = create_app(config)
+        with old_app.app_context():
+            old_app.db.session.execute(text(
+                'DROP INDEX ix_metadata_department_id_time_created'
+            ))
+            for column in REPLACED_INDEX_COLUMNS:
+                old_app.db.session.execute(text(
+                    f'CREATE INDEX ix_metadata_{column} '
+                    f'ON metadata ({column})'
+                ))
+            old_app.db.session.commit()
+            old_app.db.engine.dispose()
+
+        new_app = create_app(config)
+        with new_app.app_context():
+            indexes = inspect(new_app.db.engine).get_indexes('metadata')
+            new_app.db.engine.dispose()
+
+        names = [index['name'] for index in indexes]
+        assert 'ix_metadata_department_id_time_created' in names
+        for column in REPLACED_INDEX_COLUMNS:
+            assert f'ix_metadata_{column}' not in names
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,94 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from flask import g
+from api import app as app_module
+from api.db.db_methods import get_bearer_token_by_token
+from api.db.models import BearerToken, Department
+
+
+def make_app(app, **config):
+    return app_module.create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'ENABLE_SSO': False,
+        **config
+    })
+
+
+@pytest.fixture
+def slow_query_app(app):
+    """An app logging every statement as slow"""
+    slow_app = make_app(app, SLOW_QUERY_MS=1e-9)
+    with slow_app.app_context():
+        yield slow_app
+
+
+def test_queries_are_counted_per_request(app):
+    timed_app = make_app(app, REQUEST_TIMING=True)
+    client = timed_app.test_client()
+
+    with client:
+        client.get('/api/admin/departments')
+        stats = g.query_stats
+        assert stats.count == 1
+        assert stats.duration > 0
+
+        # Counted from zero for every request
+        client.get('/api/admin/departments')
+        assert g.query_stats.count == 1
+
+
+def test_queries_are_not_counted_by_default(client):
+    with client:
+        client.get('/api/admin/departments')
+        assert g.get('query_stats') is None
+
+
+def test_slow_queries_are_logged(slow_query_app, capsys):
+    """Slow statements are logged with the types of their parameters"""
+    client = slow_query_app.test_client()
+    response = client.post('/api/admin/departments',
+                           json={'name': 'slow dept'})
+
+    logged = [json.loads(line) for line in capsys.readouterr().out
+              .splitlines()]
+    inserts = [entry for entry in logged
+               if entry['message'] == 'Slow query'
+               and entry['statement'].startswith('INSERT INTO department')]
+    assert len(inserts) == 1
+    assert inserts[0]['level'] == 'WARNING'
+    assert inserts[0]['request_id'] == response.headers['X-Request-Id']
+    assert inserts[0]['parameter_types'] == ['str']
+    assert 'slow dept' not in json.dumps(inserts[0])
+    assert inserts[0]['slow_query_ms'] >= 0
+
+
+def test_slow_query_log_has_no_tokens(slow_query_app, capsys):
+    """Looking up a bearer token does not write the token to the log"""
+    department = Department(name='dept')
+    slow_query_app.db.session.add(department)
+    slow_query_app.db.session.commit()
+    slow_query_app.db.session.add(BearerToken(
+        token='secret-token-value', machine_name='machine',
+        department_id=department.id, created_by='admin', is_active=True,
+        created_at=datetime.now(timezone.utc)
+    ))
+    slow_query_app.db.session.commit()
+
+    assert get_bearer_token_by_token('secret-token-value') is not None
+
+    logged = capsys.readouterr().out
+    assert 'FROM bearer_token' in logged
+    assert 'secret-token-value' not in logged
+
+
+def test_fast_queries_are_not_logged(app, caplog):
+    quiet_app = make_app(app, SLOW_QUERY_MS=60000)
+    with quiet_app.app_context():
+        quiet_app.test_client().get('/api/admin/departments')
+
+    assert not [record for record in caplog.records
+                if record.getMessage() == 'Slow query']
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+
+from sqlalchemy import inspect, text
+from api.app import create_app
+from api.db.models import Metadata
+
+
+def test_missing_columns_are_added_on_startup():
+    """Databases created before storage paths were recorded get them added"""
+    tmp_dir = tempfile.mkdtemp(prefix='test_schema_')
+    config = {
+        'TESTING': True,
+        'UPLOAD_FOLDER': os.path.join(tmp_dir, 'uploads'),
+        'SQLALCHEMY_DATABASE_URI':
+            f"sqlite:///{os.path.join(tmp_dir, 'app.db')}",
+    }
+    try:
+        old_app = create_app(config)
+        with old_app.app_context():
+            old_app.db.session.execute(text(
+                "INSERT INTO metadata (id, filename) "
+                "VALUES ('legacy', 'legacy.json')"
+            ))
+            for column in ('storage_path', 'size'):
+                old_app.db.session.execute(text(
+                    f'ALTER TABLE metadata DROP COLUMN {column}'
+                ))
+            old_app.db.session.commit()
+            old_app.db.engine.dispose()
+
+        new_app = create_app(config)
+        with new_app.app_context():
+            columns = inspect(new_app.db.engine).get_columns('metadata')
+            legacy = new_app.db.session.get(Metadata, 'legacy')
+            new_app.db.engine.dispose()
+
+        assert {'storage_path', 'size'} <= \
+            {column['name'] for column in columns}
+        assert legacy.storage_path is None
+        assert legacy.size is None
+    finally:
+        shutil.rmtree(tmp_dir)
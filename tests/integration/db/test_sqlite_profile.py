@@ -0,0 +1,137 @@
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import text
+from api.app import create_app
+from api.db.db import sqlite_pragmas
+from api.db.models import Department, Metadata
+
+UPLOADERS = 4
+UPLOADS_PER_UPLOADER = 15
+
+
+@pytest.fixture
+def database_config():
+    """Configuration for an app backed by a SQLite file"""
+    tmp_dir = tempfile.mkdtemp(prefix='test_sqlite_')
+    yield {
+        'TESTING': True,
+        'UPLOAD_FOLDER': os.path.join(tmp_dir, 'uploads'),
+        'SQLALCHEMY_DATABASE_URI':
+            f"sqlite:///{os.path.join(tmp_dir, 'app.db')}",
+        'ENABLE_SSO': False
+    }
+    shutil.rmtree(tmp_dir)
+
+
+def read_pragmas(app):
+    with app.app_context():
+        with app.db.engine.connect() as connection:
+            pragmas = {
+                name: connection.execute(text(f'PRAGMA {name}')).scalar()
+                for name in ('journal_mode', 'synchronous', 'busy_timeout',
+                             'mmap_size')
+            }
+        app.db.engine.dispose()
+    return pragmas
+
+
+def test_default_pragmas_are_applied(database_config):
+    """Every connection is set up for concurrent workers"""
+    app = create_app(database_config)
+
+    assert read_pragmas(app) == {
+        'journal_mode': 'wal',
+        'synchronous': 1,  # NORMAL
+        'busy_timeout': 30000,
+        'mmap_size': 256 * 1024 * 1024,
+    }
+
+
+def test_pragmas_are_configurable(database_config):
+    """The pragmas can be tuned through the config"""
+    app = create_app({
+        **database_config,
+        'SQLITE_JOURNAL_MODE': 'delete',
+        'SQLITE_SYNCHRONOUS': 'full',
+        'SQLITE_BUSY_TIMEOUT': 1000,
+        'SQLITE_MMAP_SIZE': 0,
+    })
+
+    assert read_pragmas(app) == {
+        'journal_mode': 'delete',
+        'synchronous': 2,  # FULL
+        'busy_timeout': 1000,
+        'mmap_size': 0,
+    }
+
+
+@pytest.mark.parametrize('option', ['SQLITE_JOURNAL_MODE',
+                                    'SQLITE_SYNCHRONOUS'])
+def test_invalid_pragma_values_are_rejected(option):
+    """Pragma values end up in SQL so only known values are allowed"""
+    config = {
+        'SQLITE_JOURNAL_MODE': 'WAL',
+        'SQLITE_SYNCHRONOUS': 'NORMAL',
+        'SQLITE_BUSY_TIMEOUT': 0,
+        'SQLITE_MMAP_SIZE': 0,
+        option: 'WAL; DROP TABLE metadata',
+    }
+    with pytest.raises(ValueError):
+        sqlite_pragmas(config)
+
+
+def upload_reports(config, department_id, uploader):
+    """Upload reports through a separate app, like a gunicorn worker"""
+    app = create_app(config)
+    client = app.test_client()
+    status_codes = []
+    for i in range(UPLOADS_PER_UPLOADER):
+        # Hosts and benchmarks overlap so uploaders race on creating them
+        filename = f'host{i % 3}-bench{uploader % 2}-20250101T000000Z.json'
+        data = {
+            'file': (
+                io.BytesIO(json.dumps({
+                    'benchmark-title': f'bench{uploader % 2}'
+                }).encode('utf-8')),
+                filename
+            ),
+        }
+        response = client.post(f'/api/files?department_id={department_id}',
+                               data=data,
+                               content_type='multipart/form-data')
+        status_codes.append(response.status_code)
+
+    with app.app_context():
+        app.db.engine.dispose()
+    return status_codes
+
+
+def test_parallel_uploaders_do_not_lock(database_config):
+    """Upload bursts from several workers never hit a locked database"""
+    app = create_app(database_config)
+    with app.app_context():
+        department = Department(name='dept')
+        app.db.session.add(department)
+        app.db.session.commit()
+        department_id = department.id
+
+    # Spawn so every uploader opens its own connections to the file
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(UPLOADERS) as pool:
+        results = pool.starmap(
+            upload_reports,
+            [(database_config, department_id, uploader)
+             for uploader in range(UPLOADERS)]
+        )
+
+    assert all(code == 201 for codes in results for code in codes), results
+    with app.app_context():
+        assert app.db.session.query(Metadata).count() == \
+            UPLOADERS * UPLOADS_PER_UPLOADER
+        app.db.engine.dispose()
@@ -3,6 +3,8 @@ import os
 import pytest
 from unittest.mock import mock_open
 
+from api.convert import get_mapping
+
 
 def test_convert_file_success(client, uploads_folder, mocker):
     """Test case for successful file conversion."""
@@ -19,7 +21,9 @@ def test_convert_file_success(client, uploads_folder, mocker):
     assert response.mimetype == 'application/json'
     assert response.data == json.dumps({'converted': 'data'}).encode('utf-8')
 
-    mock_convert.assert_called_once_with({'mock': 'data'})
+    mock_convert.assert_called_once_with({'mock': 'data'},
+                                         mapping=get_mapping())
+    assert response.headers['X-Mapping-Version'] == get_mapping().version
 
 
 @pytest.mark.parametrize("file_id",
@@ -0,0 +1,124 @@
+import io
+import json
+import os
+
+from sqlalchemy import event
+from api import storage
+from api.db import db_methods
+from api.db.models import Metadata
+
+
+def upload(client, department_id, hostname='HOST'):
+    """Upload a minimal report and return its id"""
+    content = {'benchmark-title': 'BENCH', 'rules': []}
+    data = {
+        'file': (
+            io.BytesIO(json.dumps(content).encode('utf-8')),
+            f'{hostname}-BENCH-20250506T093226Z.json'
+        ),
+    }
+    response = client.post(f'/api/files/?department_id={department_id}',
+                           data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def count_storage_lookups(app):
+    """Count the queries looking up storage paths"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'storage_path' in statement and 'WHERE' in statement:
+            statements.append(statement)
+
+    event.listen(app.db.engine, 'before_cursor_execute', record)
+    return statements
+
+
+def test_upload_records_storage_path_and_size(client, app, uploads_folder,
+                                              bootstrap_department):
+    """The location and size of new uploads are stored in the database"""
+    file_id = upload(client, bootstrap_department.id)
+
+    metadata = app.db.session.get(Metadata, file_id)
+    assert metadata.storage_path
+
+    file_path = os.path.join(uploads_folder, *metadata.storage_path.split('/'))
+    assert metadata.size == os.path.getsize(file_path)
+
+    # Storage details are internal
+    assert 'storage_path' not in metadata.to_dict()
+    assert 'size' not in metadata.to_dict()
+
+
+def test_download_does_not_search_the_upload_folder(client, app,
+                                                    uploads_folder,
+                                                    bootstrap_department,
+                                                    mocker):
+    """Files with a recorded path are opened without listing directories"""
+    file_id = upload(client, bootstrap_department.id)
+    legacy = mocker.spy(storage, 'find_legacy_file')
+    listdir = mocker.spy(os, 'listdir')
+
+    response = client.get(f'/api/files/{file_id.upper()}')
+
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == \
+        'attachment; filename=converted_HOST-BENCH-20250506T093226Z.json'
+    legacy.assert_not_called()
+    listdir.assert_not_called()
+
+
+def test_aggregate_resolves_all_files_in_one_query(client, app,
+                                                   uploads_folder,
+                                                   bootstrap_department,
+                                                   mocker):
+    """Many ids are resolved with a single batched query"""
+    file_ids = [upload(client, bootstrap_department.id, f'HOST{i}')
+                for i in range(10)]
+    legacy = mocker.spy(storage, 'find_legacy_file')
+    mock_combine = mocker.patch('api.app.combine_results', return_value={})
+
+    lookups = count_storage_lookups(app)
+    query = '&'.join(f'id={file_id}' for file_id in file_ids)
+    response = client.get(f'/api/files/aggregate?{query}')
+
+    assert response.status_code == 200
+    assert len(lookups) == 1
+    legacy.assert_not_called()
+    assert len(mock_combine.call_args[0][0]) == 10
+
+
+def test_storage_lookups_are_batched(app, uploads_folder,
+                                     bootstrap_department, mocker):
+    """Large id lists are split into several queries"""
+    client = app.test_client()
+    file_ids = [upload(client, bootstrap_department.id, f'HOST{i}')
+                for i in range(5)]
+    mocker.patch.object(db_methods, 'STORAGE_LOOKUP_BATCH_SIZE', 2)
+
+    lookups = count_storage_lookups(app)
+    paths = db_methods.get_storage_paths(file_ids + ['unknown'])
+
+    assert len(lookups) == 3
+    assert set(paths) == set(file_ids)
+
+
+def test_legacy_and_new_uploads_aggregate_in_order(client, bootstrap_full,
+                                                   mocker):
+    """Uploads without a recorded path fall back to the upload folder"""
+    dept_id = bootstrap_full['dept1'].id
+    new_id = upload(client, dept_id)
+    legacy = mocker.spy(storage, 'find_legacy_file')
+    mock_combine = mocker.patch('api.app.combine_results', return_value={})
+
+    response = client.get(
+        f'/api/files/aggregate?id=file_id1&id={new_id}&id=file_id3'
+    )
+
+    assert response.status_code == 200
+    assert [call.args[1] for call in legacy.call_args_list] == \
+        ['file_id1', 'file_id3']
+    reports = mock_combine.call_args[0][0]
+    assert reports[1] == {'benchmark-title': 'BENCH', 'rules': []}
+    assert 'benchmark-title' in reports[0] and 'benchmark-title' in reports[2]
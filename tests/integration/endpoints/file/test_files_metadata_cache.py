@@ -0,0 +1,157 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import pytest
+from api.app import create_app
+from api.db import db_methods
+from tests.conftest import enable_authentication
+
+
+def upload(client, department_id, hostname='HOST'):
+    """Upload a minimal report and return its id"""
+    content = {'benchmark-title': 'BENCH', 'rules': []}
+    data = {
+        'file': (
+            io.BytesIO(json.dumps(content).encode('utf-8')),
+            f'{hostname}-BENCH-20250506T093226Z.json'
+        ),
+    }
+    response = client.post(f'/api/files/?department_id={department_id}',
+                           data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def test_repeated_query_is_served_from_cache(client, app, bootstrap_full,
+                                             mocker):
+    """Identical requests only execute the query once"""
+    spy = mocker.spy(db_methods, 'execute_query')
+
+    first = client.get('/api/files?verbose=true&department=1&department=2')
+    # Same filters in a different order should hit the same entry
+    second = client.get('/api/files?department=2&verbose=true&department=1')
+
+    assert first.status_code == 200
+    assert first.get_json() == second.get_json()
+    assert spy.call_count == 1
+    assert app.extensions['query_cache'].hits == 1
+
+
+def test_upload_invalidates_cache(client, bootstrap_full):
+    """Uploading a file makes it visible to an already cached query"""
+    dept_id = bootstrap_full['dept1'].id
+
+    before = client.get('/api/files').get_json()['ids']
+    new_id = upload(client, dept_id)
+    after = client.get('/api/files').get_json()['ids']
+
+    assert new_id not in before
+    assert set(after) == set(before) | {new_id}
+
+
+def test_department_deletion_invalidates_cache(client, bootstrap_full):
+    """Deleted departments disappear from cached filter options"""
+    dept_id = bootstrap_full['dept2'].id
+
+    before = client.get('/api/files?verbose=true').get_json()
+    assert dept_id in [d['id'] for d in before['filters']['department']]
+
+    response = client.delete(f'/api/admin/departments/{dept_id}')
+    assert response.status_code == 200
+
+    after = client.get('/api/files?verbose=true').get_json()
+    assert dept_id not in [d['id'] for d in after['filters']['department']]
+
+
+def test_user_department_change_invalidates_cache(client, bootstrap_full):
+    """A department admin sees files as soon as they are added"""
+    enable_authentication(client)
+    dept1_id = bootstrap_full['dept1'].id
+    user_headers = {
+        'X-Forwarded-User': 'dept2_admin',
+        'X-Forwarded-For': '127.0.0.1'
+    }
+    admin_headers = {
+        'X-Forwarded-User': 'super_admin',
+        'X-Forwarded-For': '127.0.0.1'
+    }
+
+    before = client.get('/api/files', headers=user_headers).get_json()
+    assert set(before['ids']) == {'file_id3'}
+
+    response = client.post('/api/admin/department-users', json={
+        'department_id': dept1_id,
+        'user_handle': 'dept2_admin'
+    }, headers=admin_headers)
+    assert response.status_code == 201
+
+    after = client.get('/api/files', headers=user_headers).get_json()
+    assert set(after['ids']) == {'file_id1', 'file_id2', 'file_id3'}
+
+
+def test_cache_is_scoped_by_departments(client, bootstrap_full):
+    """Users with different departments never share cached results"""
+    enable_authentication(client)
+    dept1 = client.get('/api/files', headers={
+        'X-Forwarded-User': 'dept1_admin',
+        'X-Forwarded-For': '127.0.0.1'
+    }).get_json()
+    dept2 = client.get('/api/files', headers={
+        'X-Forwarded-User': 'dept2_admin',
+        'X-Forwarded-For': '127.0.0.1'
+    }).get_json()
+
+    assert set(dept1['ids']) == {'file_id1', 'file_id2'}
+    assert set(dept2['ids']) == {'file_id3'}
+
+
+def test_cache_disabled(client, app, bootstrap_full, mocker):
+    """Setting QUERY_CACHE_SIZE to 0 runs every query"""
+    app.extensions.pop('query_cache')
+    spy = mocker.spy(db_methods, 'execute_query')
+
+    client.get('/api/files')
+    client.get('/api/files')
+
+    assert spy.call_count == 2
+
+
+@pytest.fixture
+def shared_database_apps():
+    """Two apps sharing one database, like two gunicorn workers"""
+    tmp_dir = tempfile.mkdtemp(prefix='test_cache_')
+    config = {
+        'TESTING': True,
+        'UPLOAD_FOLDER': os.path.join(tmp_dir, 'uploads'),
+        'SQLALCHEMY_DATABASE_URI':
+            f"sqlite:///{os.path.join(tmp_dir, 'app.db')}",
+        'ENABLE_SSO': False
+    }
+    worker1 = create_app(config)
+    worker2 = create_app(config)
+
+    yield worker1, worker2
+
+    for worker in (worker1, worker2):
+        with worker.app_context():
+            worker.db.engine.dispose()
+    shutil.rmtree(tmp_dir)
+
+
+def test_cache_invalidated_across_workers(shared_database_apps):
+    """An upload through one worker invalidates the cache of the other"""
+    worker1, worker2 = shared_database_apps
+    client1 = worker1.test_client()
+    client2 = worker2.test_client()
+
+    response = client1.post('/api/admin/departments', json={'name': 'dept'})
+    dept_id = response.get_json()['department']['id']
+
+    assert client2.get('/api/files').get_json()['ids'] == []
+
+    new_id = upload(client1, dept_id)
+
+    assert client2.get('/api/files').get_json()['ids'] == [new_id]
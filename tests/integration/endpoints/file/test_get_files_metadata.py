@@ -2,6 +2,7 @@ import json
 from datetime import datetime
 
 import pytest
+from api.db.db_methods import estimate_count
 from tests.conftest import enable_authentication
 
 
@@ -540,3 +541,93 @@ def test_get_files_empty_folder(client, uploads_folder):
     assert 'data' in data
     assert isinstance(data['data'], list)
     assert len(data['data']) == 0  # Empty folder should return empty list
+
+
+def test_get_files_metadata_exact_count_by_default(client, bootstrap_full):
+    """Without opting in the total count is always exact"""
+    response = client.get('/api/files?verbose=true&page_size=2')
+
+    pagination = response.get_json()['pagination']
+    assert pagination['total_count'] == 3
+    assert pagination['total_count_exact'] is True
+
+
+def test_get_files_metadata_estimated_count(client, app, bootstrap_full,
+                                            mocker):
+    """Large totals are estimated from the filter counts when requested"""
+    app.config['APPROX_COUNT_THRESHOLD'] = 2
+    execute = mocker.spy(app.db.session, 'execute')
+
+    response = client.get(
+        '/api/files?verbose=true&page_size=2&count=estimate'
+    )
+
+    pagination = response.get_json()['pagination']
+    assert pagination['total_count'] == 3
+    assert pagination['total_count_exact'] is False
+    # No separate count(*) query was executed
+    assert not any('count(*) AS count_1 \nFROM (SELECT' in str(c.args[0])
+                   and 'GROUP BY' not in str(c.args[0])
+                   for c in execute.call_args_list)
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('department=1', 2),
+    ('department=2', 1),
+    ('department=1&department=2', 3),
+    ('department=null', 0),
+    ('hostname=1', 1),
+    ('search=true', 1),
+])
+def test_get_files_metadata_estimated_count_with_filters(
+        client, app, bootstrap_full, query, expected):
+    """Estimates match the exact count for every kind of filter"""
+    app.config['APPROX_COUNT_THRESHOLD'] = 0
+
+    response = client.get(
+        f'/api/files?verbose=true&page_size=1&page=5&count=estimate&{query}'
+    )
+
+    pagination = response.get_json()['pagination']
+    assert pagination['total_count'] == expected
+    assert pagination['total_count_exact'] is False
+
+
+@pytest.mark.parametrize('selected, expected', [
+    (['null'], 4),
+    ([None], 4),
+    # Only a department literally named None, like compute_filter
+    (['None'], 0),
+    (['1', 'null'], 6),
+])
+def test_estimate_count_null_options(selected, expected):
+    filter_counts = [{'id': 1, 'count': 2}, {'id': None, 'count': 4}]
+    assert estimate_count(filter_counts, selected) == expected
+
+
+def test_get_files_metadata_estimate_below_threshold(client, app,
+                                                     bootstrap_full):
+    """Small totals are still counted exactly"""
+    app.config['APPROX_COUNT_THRESHOLD'] = 10
+
+    response = client.get(
+        '/api/files?verbose=true&page_size=2&count=estimate'
+    )
+
+    pagination = response.get_json()['pagination']
+    assert pagination['total_count'] == 3
+    assert pagination['total_count_exact'] is True
+
+
+def test_get_files_metadata_estimate_on_last_page(client, app,
+                                                  bootstrap_full):
+    """A partially filled page gives the exact total"""
+    app.config['APPROX_COUNT_THRESHOLD'] = 0
+
+    response = client.get(
+        '/api/files?verbose=true&page=1&page_size=2&count=estimate'
+    )
+
+    pagination = response.get_json()['pagination']
+    assert pagination['total_count'] == 3
+    assert pagination['total_count_exact'] is True
@@ -0,0 +1,51 @@
+import pytest
+from api.db.models import Hostname, Metadata
+from tests.conftest import assert_max_queries
+
+
+@pytest.fixture
+def uncached(app):
+    """Every request queries the database"""
+    app.extensions.pop('query_cache', None)
+
+
+@pytest.mark.parametrize('url, max_queries', [
+    ('/api/files', 12),
+    ('/api/files?verbose=true', 13),
+    ('/api/files/file_id1', 1),
+    ('/api/files/aggregate?id=file_id1&id=file_id2', 1),
+    ('/api/admin/departments', 1),
+    ('/api/admin/storage', 3),
+    ('/api/admin/bearer-tokens', 2),
+])
+def test_query_budget(client, app, bootstrap_full, uncached,
+                      url, max_queries):
+    with assert_max_queries(app, max_queries):
+        response = client.get(url)
+
+    assert response.status_code == 200
+
+
+def test_listing_does_not_query_per_file(client, app, bootstrap_full,
+                                         uncached):
+    """Related rows are loaded with the files, not one by one"""
+    for i in range(10):
+        app.db.session.add(Metadata(
+            id=f'extra_{i}', filename='extra.json',
+            department_id=bootstrap_full['dept1'].id,
+            hostname=Hostname(name=f'extra_host_{i}')
+        ))
+    app.db.session.commit()
+
+    with assert_max_queries(app, 13):
+        response = client.get('/api/files?verbose=true')
+
+    assert len(response.get_json()['data']) == 13
+    assert all(row['hostname'] is not None
+               for row in response.get_json()['data'])
+
+
+def test_assert_max_queries_reports_statements(app):
+    with pytest.raises(AssertionError, match='SELECT 1'):
+        with assert_max_queries(app, 0):
+            app.db.session.execute(app.db.text('SELECT 1'))
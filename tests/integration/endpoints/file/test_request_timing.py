@@ -0,0 +1,97 @@
+import json
+import re
+
+import pytest
+from flask import g
+from api import app as app_module
+from api.timing import format_server_timing, timed
+
+
+@pytest.fixture
+def timed_client(app):
+    """A client for an app with request timing enabled"""
+    timed_app = app_module.create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'ENABLE_SSO': False,
+        'REQUEST_TIMING': True,
+    })
+    with timed_app.app_context():
+        yield timed_app.test_client()
+
+
+def server_timing(response) -> dict[str, float]:
+    return {
+        name: float(duration) for name, duration in re.findall(
+            r'(\w+);dur=([\d.]+)', response.headers['Server-Timing']
+        )
+    }
+
+
+def test_timing_is_off_by_default(client, bootstrap_full):
+    response = client.get('/api/files')
+
+    assert response.status_code == 200
+    assert 'Server-Timing' not in response.headers
+
+
+def test_phases_of_a_listing(timed_client, capsys):
+    """Listing files reports the authentication and the query"""
+    response = timed_client.get('/api/files')
+
+    assert response.status_code == 200
+    timings = server_timing(response)
+    assert set(timings) == {'auth', 'query', 'sql', 'total'}
+    assert timings['total'] >= timings['auth'] + timings['query']
+    assert timings['auth'] + timings['query'] >= timings['sql']
+
+    log = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert log['method'] == 'GET'
+    assert log['path'] == '/api/files'
+    assert log['status'] == 200
+    assert set(log['timings_ms']) == {'auth', 'query', 'sql'}
+    assert log['queries'] > 0
+
+
+def test_phases_of_a_conversion(timed_client, mocker):
+    """Reading, converting and serializing a report are timed apart"""
+    mocker.patch('api.app.find_file',
+                 return_value=('test.json', '/path/to/test.json'))
+    mocker.patch('builtins.open', mocker.mock_open(read_data='{}'))
+    mocker.patch('api.app.convert_cis_to_attack', return_value={})
+
+    response = timed_client.get('/api/files/some-id')
+
+    assert response.status_code == 200
+    assert set(server_timing(response)) == \
+        {'auth', 'read', 'convert', 'serialize', 'sql', 'total'}
+
+
+def test_failed_requests_are_timed(timed_client):
+    response = timed_client.get('/api/files/unknown-id')
+
+    assert response.status_code == 404
+    assert 'total' in server_timing(response)
+
+
+def test_repeated_phases_are_added_up(app):
+    with app.test_request_context():
+        g.timings = {}
+        with timed('read'):
+            pass
+        with timed('read'):
+            pass
+        assert list(g.timings) == ['read']
+
+
+def test_timed_without_timing_does_nothing(app):
+    with app.test_request_context():
+        with timed('read'):
+            pass
+        assert 'timings' not in g
+
+
+def test_format_server_timing():
+    assert format_server_timing({'auth': 0.0012, 'query': 0.25}, 0.3) == \
+        'auth;dur=1.20, query;dur=250.00, total;dur=300.00'
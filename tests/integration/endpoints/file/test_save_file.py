@@ -8,6 +8,13 @@ from api.db.models import Metadata, Department, BearerToken
 from tests.conftest import enable_authentication
 
 
+def stored_file_path(app, uploads_folder, file_id):
+    """Where the file of an upload ended up in the uploads folder"""
+    with app.app_context():
+        storage_path = app.db.session.get(Metadata, file_id).storage_path
+    return os.path.join(uploads_folder, *storage_path.split('/'))
+
+
 def test_no_file_in_request(client, app, bootstrap_department):
     """Test if save_file returns
      the correct response when no file is provided."""
@@ -93,7 +100,7 @@ def test_valid_file_upload(client, app, uploads_folder, bootstrap_department):
     assert 'id' in response_data
     assert response_data['filename'] == filename
     unique_id = response_data['id']
-    file_path = os.path.join(uploads_folder, unique_id, filename)
+    file_path = stored_file_path(app, uploads_folder, unique_id)
     assert os.path.exists(file_path)
     with open(file_path, 'r', encoding='utf-8') as f:
         stored_content = json.load(f)
@@ -157,8 +164,10 @@ def test_unique_id_collision(
 
     # Create a directory with the same
     # name as our first mocked UUID to force a collision
-    collision_dir = os.path.join(uploads_folder, str(uuid.UUID(
-        int=int(hash(first_id)) & 0xFFFFFFFFFFFFFFFF)))
+    colliding_id = str(uuid.UUID(
+        int=int(hash(first_id)) & 0xFFFFFFFFFFFFFFFF))
+    collision_dir = os.path.join(uploads_folder, colliding_id[:2],
+                                 colliding_id[2:4], colliding_id)
     os.makedirs(collision_dir, exist_ok=True)
 
     # Now make the request,
@@ -185,7 +194,7 @@ def test_unique_id_collision(
     assert response_data['id'] == expected_id
 
     # Verify the file was saved with the second UUID
-    file_path = os.path.join(uploads_folder, expected_id, filename)
+    file_path = stored_file_path(app, uploads_folder, expected_id)
     assert os.path.exists(file_path)
 
     # Verify the UUID generation was called twice
@@ -586,7 +595,7 @@ def test_large_json_file_upload(client, app, uploads_folder,
     unique_id = response_data['id']
 
     # Verify file was stored correctly
-    file_path = os.path.join(uploads_folder, unique_id, filename)
+    file_path = stored_file_path(app, uploads_folder, unique_id)
     assert os.path.exists(file_path)
 
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -0,0 +1,112 @@
+import io
+import json
+import re
+
+import pytest
+from api import app as app_module
+from api import convert
+
+
+@pytest.fixture
+def metrics_client(app, tmp_path):
+    """A client for an app with metrics enabled"""
+    metrics_app = app_module.create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'ENABLE_SSO': False,
+        'METRICS_ENABLED': True,
+        'METRICS_DIR': str(tmp_path),
+    })
+    with metrics_app.app_context():
+        yield metrics_app.test_client()
+
+
+def metric_value(text: str, sample: str) -> float:
+    match = re.search(rf'^{re.escape(sample)} (\S+)$', text, re.MULTILINE)
+    assert match, f'{sample} not found'
+    return float(match.group(1))
+
+
+def upload(client, department_id, hostname):
+    data = {
+        'file': (
+            io.BytesIO(json.dumps({
+                'benchmark-title': 'BENCH',
+                'rules': [{
+                    'rule-id':
+                        'xccdf_org.cisecurity.benchmarks_rule_1.1.1_test',
+                    'result': 'pass'
+                }]
+            }).encode('utf-8')),
+            f'{hostname}-BENCH-20250506T093226Z.json'
+        ),
+    }
+    response = client.post(f'/api/files/?department_id={department_id}',
+                           data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def test_metrics_are_off_by_default(client):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_request_metrics(metrics_client):
+    """Requests are counted and timed per route"""
+    metrics_client.get('/api/files')
+    metrics_client.get('/api/files')
+
+    response = metrics_client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert metric_value(
+        text, 'http_requests_total{method="GET",route="/api/files",'
+              'status="200"}'
+    ) == 2
+    assert metric_value(
+        text, 'http_request_duration_seconds_count{method="GET",'
+              'route="/api/files"}'
+    ) == 2
+    assert metric_value(
+        text, 'db_queries_per_request_count{route="/api/files"}'
+    ) == 2
+    assert metric_value(
+        text, 'db_queries_per_request_sum{route="/api/files"}'
+    ) > 0
+
+
+def test_mapping_load_metric(metrics_client, monkeypatch):
+    """The load time is only reported once the mapping is loaded"""
+    convert.preload_mapping()
+    text = metrics_client.get('/metrics').get_data(as_text=True)
+    assert metric_value(text, 'mapping_load_duration_seconds') > 0
+
+    default = convert.mapping_registry.sources[convert.DEFAULT_MAPPING]
+    monkeypatch.setattr(default, 'load_seconds', None)
+    text = metrics_client.get('/metrics').get_data(as_text=True)
+    assert '\nmapping_load_duration_seconds ' not in text
+
+
+def test_upload_and_conversion_metrics(metrics_client):
+    response = metrics_client.post('/api/admin/departments',
+                                   json={'name': 'dept'})
+    dept_id = response.get_json()['department']['id']
+    file_ids = [upload(metrics_client, dept_id, f'HOST{i}')
+                for i in range(2)]
+    for file_id in file_ids:
+        metrics_client.get(f'/api/files/{file_id}')
+    metrics_client.get(
+        f'/api/files/aggregate?id={file_ids[0]}&id={file_ids[1]}'
+    )
+
+    text = metrics_client.get('/metrics').get_data(as_text=True)
+
+    assert metric_value(text, 'uploads_total') == 2
+    # Identical reports are converted once
+    assert metric_value(text, 'conversions_total') == 1
+    assert metric_value(text, 'cache_hits_total{cache="conversion"}') == 1
+    assert metric_value(text, 'aggregate_files_sum') == 2
+    assert metric_value(text, 'aggregate_rules_sum') == 2
@@ -0,0 +1,162 @@
+import pstats
+import tracemalloc
+
+import pytest
+from api import app as app_module
+from api import profiling
+from tests.conftest import enable_authentication
+
+DEPT1_ADMIN = {
+    'X-Forwarded-User': 'dept1_admin',
+    'X-Forwarded-For': '127.0.0.1'
+}
+
+
+@pytest.fixture
+def profile_app(app, tmp_path):
+    """An app saving profiles to a temporary directory"""
+    profile_app = app_module.create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'ENABLE_SSO': False,
+        'PROFILE_DIR': str(tmp_path),
+        'PROFILE_KEEP': 3,
+    })
+    with profile_app.app_context():
+        yield profile_app
+
+
+@pytest.fixture
+def profile_client(profile_app):
+    return profile_app.test_client()
+
+
+def test_requests_are_not_profiled_by_default(profile_client):
+    response = profile_client.get('/api/admin/departments')
+
+    assert response.status_code == 200
+    assert profiling.PROFILE_ID_HEADER not in response.headers
+    assert profile_client.get('/api/admin/profiles').get_json() == {
+        'profiles': []
+    }
+
+
+def test_cpu_profile(profile_client, tmp_path):
+    """The request runs under cProfile and the stats can be downloaded"""
+    response = profile_client.get('/api/admin/departments',
+                                  headers={'X-Profile': 'cpu'})
+
+    assert response.status_code == 200
+    profile_id = response.headers[profiling.PROFILE_ID_HEADER]
+    profiles = profile_client.get('/api/admin/profiles').get_json()
+    assert len(profiles['profiles']) == 1
+    profile = profiles['profiles'][0]
+    assert profile['id'] == profile_id
+    assert profile['kind'] == 'cpu'
+    assert profile['method'] == 'GET'
+    assert profile['path'] == '/api/admin/departments'
+    assert profile['status'] == 200
+    assert profile['user'] == 'admin'
+
+    response = profile_client.get(f'/api/admin/profiles/{profile_id}')
+    assert response.status_code == 200
+    path = tmp_path / f'{profile_id}.prof'
+    assert response.data == path.read_bytes()
+    stats = pstats.Stats(str(path))
+    assert any(function == 'api_get_departments'
+               for _, _, function in stats.stats)
+
+    response = profile_client.get(
+        f'/api/admin/profiles/{profile_id}?format=text'
+    )
+    assert response.mimetype == 'text/plain'
+    assert 'api_get_departments' in response.get_data(as_text=True)
+
+
+def test_memory_profile(profile_client, tmp_path):
+    response = profile_client.get('/api/admin/departments',
+                                  headers={'X-Profile': 'memory'})
+
+    profile_id = response.headers[profiling.PROFILE_ID_HEADER]
+    profile = profile_client.get('/api/admin/profiles').get_json()[
+        'profiles'][0]
+    assert profile['kind'] == 'memory'
+    assert profile['peak_bytes'] > 0
+    assert not tracemalloc.is_tracing()
+    snapshot = tracemalloc.Snapshot.load(
+        str(tmp_path / f'{profile_id}.tracemalloc')
+    )
+    assert snapshot.traces
+
+    response = profile_client.get(
+        f'/api/admin/profiles/{profile_id}?format=text'
+    )
+    assert response.status_code == 200
+
+
+def test_profiles_need_super_admin(profile_client, bootstrap_full):
+    """Only super admins can profile requests and read profiles"""
+    enable_authentication(profile_client)
+
+    response = profile_client.get('/api/files', headers={
+        **DEPT1_ADMIN, 'X-Profile': 'cpu'
+    })
+    assert response.status_code == 403
+    assert profile_client.get('/api/admin/profiles',
+                              headers=DEPT1_ADMIN).status_code == 403
+
+
+def test_unknown_profiler(profile_client):
+    response = profile_client.get('/api/admin/departments',
+                                  headers={'X-Profile': 'gpu'})
+
+    assert response.status_code == 400
+    assert profiling.PROFILE_ID_HEADER not in response.headers
+
+
+def test_one_request_is_profiled_at_a_time(profile_client):
+    with profiling._profile_lock:
+        response = profile_client.get('/api/admin/departments',
+                                      headers={'X-Profile': 'cpu'})
+
+    assert response.status_code == 409
+
+
+def test_failed_requests_are_profiled(profile_client, mocker):
+    """Profiles of failing requests are saved and the profiler stopped"""
+    mocker.patch('api.app.get_all_departments_with_access',
+                 side_effect=RuntimeError('boom'))
+
+    response = profile_client.get('/api/admin/departments',
+                                  headers={'X-Profile': 'cpu'})
+
+    assert response.status_code == 500
+    assert profiling.PROFILE_ID_HEADER in response.headers
+    assert not profiling._profile_lock.locked()
+
+
+def test_old_profiles_are_removed(profile_client, tmp_path):
+    for _ in range(5):
+        profile_client.get('/api/admin/departments',
+                           headers={'X-Profile': 'cpu'})
+
+    assert len(profile_client.get('/api/admin/profiles')
+               .get_json()['profiles']) == 3
+    assert len(list(tmp_path.iterdir())) == 6
+
+
+@pytest.mark.parametrize('profile_id', [
+    'missing', '0' * 32, '..%2F..%2Fetc%2Fpasswd',
+])
+def test_unknown_profile(profile_client, profile_id):
+    response = profile_client.get(f'/api/admin/profiles/{profile_id}')
+    assert response.status_code == 404
+
+
+def test_profile_header_is_ignored_without_directory(client):
+    response = client.get('/api/admin/departments',
+                          headers={'X-Profile': 'cpu'})
+
+    assert response.status_code == 200
+    assert profiling.PROFILE_ID_HEADER not in response.headers
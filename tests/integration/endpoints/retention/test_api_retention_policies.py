@@ -0,0 +1,134 @@
+import os
+
+import pytest
+from api.storage import find_file
+from api.db.db_methods import set_retention_policy
+from api.db.models import RetentionPolicy
+from tests.conftest import enable_authentication
+
+DEPT1_ADMIN = {
+    'X-Forwarded-User': 'dept1_admin',
+    'X-Forwarded-For': '127.0.0.1'
+}
+
+
+def test_set_retention_policy(client, app, bootstrap_department):
+    """A policy is created and replaced on the second request"""
+    dept_id = bootstrap_department.id
+
+    response = client.put(f'/api/admin/retention/{dept_id}',
+                          json={'max_age_days': 90})
+    assert response.status_code == 200
+    assert response.get_json()['policy'] == {
+        'department_id': dept_id,
+        'max_age_days': 90,
+        'max_reports_per_host': None,
+    }
+
+    response = client.put(f'/api/admin/retention/{dept_id}',
+                          json={'max_reports_per_host': 5})
+    assert response.status_code == 200
+
+    policy = app.db.session.query(RetentionPolicy).one()
+    assert policy.max_age_days is None
+    assert policy.max_reports_per_host == 5
+
+
+@pytest.mark.parametrize('data', [
+    {},
+    {'max_age_days': 0},
+    {'max_age_days': -1},
+    {'max_age_days': '30'},
+    {'max_reports_per_host': True},
+    {'max_age_days': None, 'max_reports_per_host': None},
+])
+def test_set_retention_policy_invalid(client, app, bootstrap_department,
+                                      data):
+    """Limits must be positive integers and at least one must be set"""
+    response = client.put(f'/api/admin/retention/{bootstrap_department.id}',
+                          json=data)
+
+    assert response.status_code == 400
+    assert app.db.session.query(RetentionPolicy).count() == 0
+
+
+def test_set_retention_policy_unknown_department(client):
+    response = client.put('/api/admin/retention/999',
+                          json={'max_age_days': 30})
+
+    assert response.status_code == 404
+
+
+def test_get_retention_policies_scoped(client, app,
+                                       bootstrap_tokens_and_users):
+    """Department admins only see the policies of their departments"""
+    dept1 = bootstrap_tokens_and_users['dept1'].id
+    dept2 = bootstrap_tokens_and_users['dept2'].id
+    set_retention_policy(dept1, 30, None)
+    set_retention_policy(dept2, None, 3)
+    enable_authentication(client)
+
+    response = client.get('/api/admin/retention', headers=DEPT1_ADMIN)
+
+    assert response.status_code == 200
+    assert response.get_json()['policies'] == [{
+        'department_id': dept1,
+        'max_age_days': 30,
+        'max_reports_per_host': None,
+    }]
+
+
+def test_changing_retention_requires_super_admin(client,
+                                                 bootstrap_tokens_and_users):
+    dept1 = bootstrap_tokens_and_users['dept1'].id
+    enable_authentication(client)
+
+    response = client.put(f'/api/admin/retention/{dept1}',
+                          json={'max_age_days': 1}, headers=DEPT1_ADMIN)
+    assert response.status_code == 403
+
+    response = client.get('/api/admin/retention/preview',
+                          headers=DEPT1_ADMIN)
+    assert response.status_code == 403
+
+
+def test_delete_retention_policy(client, app, bootstrap_department):
+    dept_id = bootstrap_department.id
+    set_retention_policy(dept_id, 30, None)
+
+    response = client.delete(f'/api/admin/retention/{dept_id}')
+    assert response.status_code == 200
+    assert app.db.session.query(RetentionPolicy).count() == 0
+
+    response = client.delete(f'/api/admin/retention/{dept_id}')
+    assert response.status_code == 404
+
+
+def test_deleting_department_removes_its_policy(client, app,
+                                                bootstrap_department):
+    dept_id = bootstrap_department.id
+    set_retention_policy(dept_id, 30, None)
+
+    response = client.delete(f'/api/admin/departments/{dept_id}')
+
+    assert response.status_code == 200
+    assert app.db.session.query(RetentionPolicy).count() == 0
+
+
+def test_preview_retention(client, app, bootstrap_full):
+    """The preview reports what would be deleted without deleting it"""
+    set_retention_policy(bootstrap_full['dept1'].id, 1, None)
+    sizes = [os.path.getsize(find_file(app.config['UPLOAD_FOLDER'],
+                                       file_id)[1])
+             for file_id in ('file_id1', 'file_id2')]
+
+    response = client.get('/api/admin/retention/preview')
+
+    assert response.status_code == 200
+    assert response.get_json()['departments'] == [{
+        'department_id': bootstrap_full['dept1'].id,
+        'department': 'bearer_token_dept1',
+        'reports': 2,
+        'bytes': sum(sizes),
+    }]
+    assert client.get('/api/files/file_id1').status_code == 200
@@ -0,0 +1,427 @@
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))
+)))
+
+# navigator-config is not a package, so update.py is loaded from its path
+spec = importlib.util.spec_from_file_location(
+    'navigator_update', os.path.join(ROOT, 'navigator-config', 'update.py')
+)
+update = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(update)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Serves files from a dict of path to content, counting requests"""
+    daemon_threads = True
+
+    def __init__(self, files: dict[str, bytes], delay: float = 0.0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.files = files
+        self.delay = delay
+        self.requests = []
+        # (path, status) of every response
+        self.responses = []
+        # Path to the number of bytes sent before the connection drops,
+        # once for every entry in the list
+        self.cut: dict[str, list[int]] = {}
+        self.request_headers = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.request_headers.append(dict(self.headers))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+        try:
+            time.sleep(server.delay)
+            content = server.files.get(self.path)
+            if content is None:
+                self.respond(404)
+                return
+            etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.respond(304)
+                return
+            start = 0
+            ranged = self.headers.get('Range')
+            if ranged and self.headers.get('If-Range', etag) == etag:
+                start = int(ranged.removeprefix('bytes=').split('-')[0])
+                self.respond(206, len(content) - start)
+                self.send_header('Content-Range', f'bytes {start}-'
+                                 f'{len(content) - 1}/{len(content)}')
+            else:
+                self.respond(200, len(content))
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('ETag', etag)
+            self.end_headers()
+            body = content[start:]
+            cuts = server.cut.get(self.path)
+            if cuts:
+                body = body[:cuts.pop(0)]
+                self.close_connection = True
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def respond(self, status: int, length: int = 0):
+        self.server.responses.append((self.path, status))
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        if status not in (200, 206):
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bundle(collection: str, version: str) -> bytes:
+    return json.dumps({
+        'type': 'bundle',
+        'id': f'bundle--{collection}-{version}',
+        'objects': [{'type': 'x-mitre-collection', 'name': collection,
+                     'x_mitre_version': version}],
+    }).encode('utf-8')
+
+
+@pytest.fixture
+def stand_in():
+    """An ATT&CK Navigator config, collection index and bundles"""
+    server = StandInServer({})
+    collections = []
+    for name, short in (('Enterprise ATT&CK', 'enterprise-attack'),
+                        ('Mobile ATT&CK', 'mobile-attack')):
+        versions = []
+        for version in ('15.1', '16.0', '16.1'):
+            path = f'/{short}/{short}-{version}.json'
+            server.files[path] = bundle(short, version)
+            versions.append({'version': version, 'url': server.url(path),
+                             'modified': '2024-10-31'})
+        collections.append({'id': f'x-mitre-collection--{short}',
+                            'name': name, 'versions': versions})
+    collections.append({'id': 'x-mitre-collection--empty', 'name': 'Empty'})
+    server.files['/index.json'] = json.dumps({
+        'id': 'index', 'name': 'MITRE ATT&CK', 'collections': collections,
+    }).encode('utf-8')
+    server.files['/config.json'] = json.dumps({
+        'collection_index_url': server.url('/index.json'),
+        'banner': '',
+    }).encode('utf-8')
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def expected_index(server, base_dir) -> dict:
+    """The local index as written by downloading one file after the other"""
+    index = json.loads(server.files['/index.json'])
+    for collection in index['collections']:
+        directory = collection['id'].split('--')[1]
+        if collection['name'] == 'Empty':
+            continue
+        for version in collection['versions']:
+            version['url'] = (
+                base_dir / 'data' / directory / version['url'].split('/')[-1]
+            ).as_posix()
+    return index
+
+
+def test_collections_are_downloaded_concurrently(stand_in, tmp_path):
+    stand_in.delay = 0.1
+    base_dir = tmp_path / 'mitre_attack_local'
+    downloader = update.MitreAttackDownloader(
+        base_dir, config_url=stand_in.url('/config.json'), max_workers=4
+    )
+
+    result = downloader.run()
+
+    with open(base_dir / 'config' / 'index_local.json') as F:
+        assert json.load(F) == expected_index(stand_in, base_dir)
+    assert result['collection_index'] == expected_index(stand_in, base_dir)
+    path = base_dir / 'data' / 'enterprise-attack' \
+        / 'enterprise-attack-16.1.json'
+    assert json.loads(path.read_bytes()) == json.loads(
+        stand_in.files['/enterprise-attack/enterprise-attack-16.1.json']
+    )
+    assert 1 < stand_in.max_in_flight <= 4
+    with open(base_dir / 'config' / 'config_local.json') as F:
+        assert json.load(F)['collection_index_url'] == \
+            (base_dir / 'config' / 'index_local.json').as_posix()
+
+
+def test_failed_downloads_keep_their_url(stand_in, tmp_path, monkeypatch):
+    monkeypatch.setattr(update.time, 'sleep', lambda seconds: None)
+    del stand_in.files['/mobile-attack/mobile-attack-16.0.json']
+    base_dir = tmp_path / 'mitre_attack_local'
+    downloader = update.MitreAttackDownloader(
+        base_dir, config_url=stand_in.url('/config.json')
+    )
+
+    index = downloader.run()['collection_index']
+
+    mobile = index['collections'][1]['versions']
+    assert mobile[1]['url'] == \
+        stand_in.url('/mobile-attack/mobile-attack-16.0.json')
+    assert mobile[2]['url'].startswith(base_dir.as_posix())
+
+
+def downloads(server) -> list[str]:
+    """Paths of the bundles sent in full"""
+    return [path for path, status in server.responses
+            if status == 200 and path.count('/') > 1]
+
+
+def test_unchanged_versions_are_not_downloaded_again(stand_in, tmp_path):
+    base_dir = tmp_path / 'mitre_attack_local'
+    config_url = stand_in.url('/config.json')
+    update.MitreAttackDownloader(base_dir, config_url=config_url).run()
+    assert len(downloads(stand_in)) == 6
+    manifest = json.loads((base_dir / 'manifest.json').read_text())
+    entry = manifest['files']['data/enterprise-attack/'
+                              'enterprise-attack-16.1.json']
+    path = base_dir / 'data' / 'enterprise-attack' \
+        / 'enterprise-attack-16.1.json'
+    assert entry['sha256'] == update.file_sha256(path)
+    assert entry['size'] == path.stat().st_size
+    assert entry['etag']
+
+    # A new version is published and an old one changed
+    stand_in.responses.clear()
+    index = json.loads(stand_in.files['/index.json'])
+    new_path = '/enterprise-attack/enterprise-attack-17.0.json'
+    stand_in.files[new_path] = bundle('enterprise-attack', '17.0')
+    index['collections'][0]['versions'].append(
+        {'version': '17.0', 'url': stand_in.url(new_path)}
+    )
+    stand_in.files['/index.json'] = json.dumps(index).encode('utf-8')
+    stand_in.files['/mobile-attack/mobile-attack-15.1.json'] = b'{}'
+
+    downloader = update.MitreAttackDownloader(base_dir,
+                                              config_url=config_url)
+    result = downloader.run()
+
+    assert sorted(downloads(stand_in)) == [
+        new_path, '/mobile-attack/mobile-attack-15.1.json'
+    ]
+    assert [status for path, status in stand_in.responses
+            if path.count('/') > 1].count(304) == 5
+    assert result['collection_index'] == expected_index(stand_in, base_dir)
+
+
+def test_verify_finds_damaged_files(stand_in, tmp_path):
+    base_dir = tmp_path / 'mitre_attack_local'
+    config_url = stand_in.url('/config.json')
+    update.MitreAttackDownloader(base_dir, config_url=config_url).run()
+    damaged = base_dir / 'data' / 'mobile-attack' / 'mobile-attack-16.0.json'
+    damaged.write_bytes(damaged.read_bytes().replace(b'16.0', b'16.9'))
+    missing = base_dir / 'data' / 'mobile-attack' / 'mobile-attack-16.1.json'
+    missing.unlink()
+
+    downloader = update.MitreAttackDownloader(base_dir,
+                                              config_url=config_url)
+    assert downloader.verify() == [damaged, missing]
+    assert downloader.verify() == []
+
+    stand_in.responses.clear()
+    downloader.run()
+    assert sorted(downloads(stand_in)) == [
+        '/mobile-attack/mobile-attack-16.0.json',
+        '/mobile-attack/mobile-attack-16.1.json',
+    ]
+    assert json.loads(damaged.read_bytes()) == json.loads(
+        stand_in.files['/mobile-attack/mobile-attack-16.0.json']
+    )
+
+
+def test_interrupted_downloads_resume(stand_in, tmp_path, monkeypatch):
+    """Dropped connections continue with a Range request after a backoff"""
+    sleeps = []
+    monkeypatch.setattr(update.time, 'sleep', sleeps.append)
+    # What was received of an incomplete chunk is lost
+    monkeypatch.setattr(update, 'CHUNK_SIZE', 10)
+    path = '/enterprise-attack/enterprise-attack-16.1.json'
+    stand_in.files[path] = bundle('enterprise-attack', '16.1') + b' ' * 1000
+    stand_in.cut[path] = [100, 200]
+    base_dir = tmp_path / 'mitre_attack_local'
+
+    update.MitreAttackDownloader(
+        base_dir, config_url=stand_in.url('/config.json')
+    ).run()
+
+    local = base_dir / 'data' / 'enterprise-attack' \
+        / 'enterprise-attack-16.1.json'
+    assert local.read_bytes() == stand_in.files[path]
+    assert not local.with_name(local.name + '.part').exists()
+    # Besides the sleeps of the stand-in server
+    assert [seconds for seconds in sleeps if seconds] == [1, 2]
+    ranges = [headers.get('Range') for requested, headers
+              in zip(stand_in.requests, stand_in.request_headers)
+              if requested == path]
+    assert ranges[0] is None
+    resumed = [int(r.removeprefix('bytes=').rstrip('-')) for r in ranges[1:]]
+    assert 90 <= resumed[0] <= 100 and resumed[0] + 190 <= resumed[1]
+    manifest = json.loads((base_dir / 'manifest.json').read_text())
+    assert manifest['files']['data/enterprise-attack/'
+                             'enterprise-attack-16.1.json']['sha256'] == \
+        hashlib.sha256(stand_in.files[path]).hexdigest()
+
+
+def test_partial_download_of_a_changed_file_starts_over(stand_in,
+                                                        tmp_path):
+    """A part left by an earlier run is only resumed if still current"""
+    path = '/mobile-attack/mobile-attack-16.1.json'
+    base_dir = tmp_path / 'mitre_attack_local'
+    local = base_dir / 'data' / 'mobile-attack' / 'mobile-attack-16.1.json'
+    local.parent.mkdir(parents=True)
+    local.with_name(local.name + '.part').write_bytes(b'{"stale": ')
+    local.with_name(local.name + '.part.json').write_text(json.dumps({
+        'url': stand_in.url(path), 'validator': '"outdated"'
+    }))
+
+    update.MitreAttackDownloader(
+        base_dir, config_url=stand_in.url('/config.json')
+    ).run()
+
+    assert local.read_bytes() == stand_in.files[path]
+    assert (path, 200) in stand_in.responses
+    assert not local.with_name(local.name + '.part.json').exists()
+
+
+def test_non_json_response_is_not_saved(stand_in, tmp_path):
+    path = '/mobile-attack/mobile-attack-15.1.json'
+    stand_in.files[path] = b'<html>Rate limited</html>'
+    base_dir = tmp_path / 'mitre_attack_local'
+
+    index = update.MitreAttackDownloader(
+        base_dir, config_url=stand_in.url('/config.json')
+    ).run()['collection_index']
+
+    assert index['collections'][1]['versions'][0]['url'] == \
+        stand_in.url(path)
+    assert list((base_dir / 'data' / 'mobile-attack').iterdir()) and not [
+        p for p in (base_dir / 'data' / 'mobile-attack').iterdir()
+        if p.name.startswith('mobile-attack-15.1')
+    ]
+
+
+def test_selected_collections_and_versions(stand_in, tmp_path):
+    """Only the selected versions are mirrored, listed and kept on disk"""
+    base_dir = tmp_path / 'mitre_attack_local'
+    config_url = stand_in.url('/config.json')
+    update.MitreAttackDownloader(base_dir, config_url=config_url).run()
+    stand_in.responses.clear()
+    # Newest first, as in the published index
+    index = json.loads(stand_in.files['/index.json'])
+    index['collections'][0]['versions'].reverse()
+    stand_in.files['/index.json'] = json.dumps(index).encode('utf-8')
+
+    result = update.MitreAttackDownloader(
+        base_dir, config_url=config_url,
+        collections=['Enterprise ATT&CK'], latest=2
+    ).run()
+
+    collections = result['collection_index']['collections']
+    assert [c['name'] for c in collections] == ['Enterprise ATT&CK']
+    assert [v['version'] for v in collections[0]['versions']] == \
+        ['16.1', '16.0']
+    with open(base_dir / 'config' / 'index_local.json') as F:
+        assert json.load(F) == result['collection_index']
+    assert sorted(p.relative_to(base_dir).as_posix()
+                  for p in (base_dir / 'data').rglob('*')) == [
+        'data/enterprise-attack',
+        'data/enterprise-attack/enterprise-attack-16.0.json',
+        'data/enterprise-attack/enterprise-attack-16.1.json',
+    ]
+    manifest = json.loads((base_dir / 'manifest.json').read_text())
+    assert sorted(manifest['files']) == [
+        'data/enterprise-attack/enterprise-attack-16.0.json',
+        'data/enterprise-attack/enterprise-attack-16.1.json',
+    ]
+    assert sorted(path for path, status in stand_in.responses
+                  if path.count('/') > 1) == [
+        '/enterprise-attack/enterprise-attack-16.0.json',
+        '/enterprise-attack/enterprise-attack-16.1.json',
+    ]
+
+
+def test_collection_selected_by_directory_name(stand_in, tmp_path):
+    base_dir = tmp_path / 'mitre_attack_local'
+    downloader = update.MitreAttackDownloader(
+        base_dir, config_url=stand_in.url('/config.json'),
+        collections=['mobile-attack'], latest=1
+    )
+
+    index = downloader.run()['collection_index']
+
+    assert [(c['name'], [v['version'] for v in c['versions']])
+            for c in index['collections']] == [('Mobile ATT&CK', ['16.1'])]
+
+
+def mirrored_files(base_dir) -> list[str]:
+    return sorted(p.relative_to(base_dir).as_posix()
+                  for p in (base_dir / 'data').rglob('*.json'))
+
+
+def test_unknown_collection_keeps_the_mirror(stand_in, tmp_path):
+    """A mistyped collection fails instead of pruning everything"""
+    base_dir = tmp_path / 'mitre_attack_local'
+    config_url = stand_in.url('/config.json')
+    update.MitreAttackDownloader(base_dir, config_url=config_url).run()
+    mirrored = mirrored_files(base_dir)
+
+    with pytest.raises(ValueError, match='enterprise-atack'):
+        update.MitreAttackDownloader(
+            base_dir, config_url=config_url,
+            collections=['Enterprise ATT&CK', 'enterprise-atack']
+        ).run()
+
+    assert mirrored_files(base_dir) == mirrored
+
+
+def test_empty_index_keeps_the_mirror(stand_in, tmp_path):
+    base_dir = tmp_path / 'mitre_attack_local'
+    config_url = stand_in.url('/config.json')
+    update.MitreAttackDownloader(base_dir, config_url=config_url).run()
+    mirrored = mirrored_files(base_dir)
+    stand_in.files['/index.json'] = json.dumps(
+        {'name': 'Index', 'collections': []}
+    ).encode('utf-8')
+
+    update.MitreAttackDownloader(base_dir, config_url=config_url).run()
+
+    assert mirrored and mirrored_files(base_dir) == mirrored
+
+
+@pytest.mark.parametrize('option', ['--latest', '--workers'])
+@pytest.mark.parametrize('value', ['0', '-1', 'two'])
+def test_counts_must_be_positive(option, value, capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        update.main([option, value])
+
+    assert exc_info.value.code == 2
+    assert 'positive whole number' in capsys.readouterr().err
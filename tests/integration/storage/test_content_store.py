@@ -0,0 +1,295 @@
+import io
+import json
+import os
+import shutil
+
+import pytest
+
+from api import app as app_module
+from api import storage
+from api.convert import DEFAULT_MAPPING, mapping_registry
+from api.db.models import Metadata, ReportBlob
+from tests.conftest import enable_authentication
+
+REPORT = {'benchmark-title': 'BENCH', 'rules': [
+    {'rule-id': 'xccdf_org.cisecurity.benchmarks_rule_1.1.1_test',
+     'result': 'pass'}
+]}
+OTHER_REPORT = {'benchmark-title': 'BENCH', 'rules': []}
+DEPT1_ADMIN = {
+    'X-Forwarded-User': 'dept1_admin',
+    'X-Forwarded-For': '127.0.0.1'
+}
+
+
+def upload(client, department_id, content, hostname='HOST'):
+    """Upload a report and return its id"""
+    data = {
+        'file': (
+            io.BytesIO(json.dumps(content).encode('utf-8')),
+            f'{hostname}-BENCH-20250506T093226Z.json'
+        ),
+    }
+    response = client.post(f'/api/files/?department_id={department_id}',
+                           data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def stored_files(upload_folder):
+    return [os.path.join(root, name)
+            for root, _, names in os.walk(upload_folder)
+            for name in names if not name.startswith('.')]
+
+
+def test_identical_reports_are_stored_once(client, app, uploads_folder,
+                                           bootstrap_department):
+    """Uploads with the same content share one stored file"""
+    dept_id = bootstrap_department.id
+    first = upload(client, dept_id, REPORT, 'HOST1')
+    second = upload(client, dept_id, REPORT, 'HOST2')
+    other = upload(client, dept_id, OTHER_REPORT, 'HOST3')
+
+    rows = {file_id: app.db.session.get(Metadata, file_id)
+            for file_id in (first, second, other)}
+    assert rows[first].content_hash == rows[second].content_hash
+    assert rows[first].storage_path == rows[second].storage_path
+    assert rows[first].content_hash != rows[other].content_hash
+    assert len(stored_files(uploads_folder)) == 2
+
+    blob = app.db.session.query(ReportBlob).filter_by(
+        content_hash=rows[first].content_hash
+    ).one()
+    assert blob.ref_count == 2
+    assert blob.storage_path == rows[first].storage_path
+    assert blob.size == rows[first].size
+
+    # Both still download under their own name
+    response = client.get(f'/api/files/{second}')
+    assert response.headers['Content-Disposition'] == \
+        'attachment; filename=converted_HOST2-BENCH-20250506T093226Z.json'
+
+
+def test_identical_reports_are_converted_once(client, app, uploads_folder,
+                                              bootstrap_department, mocker):
+    """The conversion of a report is reused for identical reports"""
+    dept_id = bootstrap_department.id
+    file_ids = [upload(client, dept_id, REPORT, f'HOST{i}')
+                for i in range(3)]
+    convert = mocker.spy(app_module, 'convert_cis_to_attack')
+
+    responses = [client.get(f'/api/files/{file_id}') for file_id in file_ids]
+
+    assert convert.call_count == 1
+    assert responses[0].data == responses[1].data == responses[2].data
+    assert app.extensions['conversion_cache'].hits == 2
+
+
+def test_conversion_cache_can_be_disabled(app, bootstrap_department, mocker):
+    """Without a cache every request converts the report"""
+    app.extensions.pop('conversion_cache')
+    # Routes look up the cache when they are registered
+    disabled = app_module.create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'CONVERSION_CACHE_SIZE': 0,
+    })
+    assert 'conversion_cache' not in disabled.extensions
+
+    with disabled.app_context():
+        client = disabled.test_client()
+        response = client.post('/api/admin/departments',
+                               json={'name': 'dept'})
+        dept_id = response.get_json()['department']['id']
+        file_id = upload(client, dept_id, REPORT)
+        convert = mocker.spy(app_module, 'convert_cis_to_attack')
+
+        client.get(f'/api/files/{file_id}')
+        client.get(f'/api/files/{file_id}')
+
+    assert convert.call_count == 2
+
+
+def test_conversions_are_redone_with_a_new_mapping(client, app,
+                                                   bootstrap_department,
+                                                   mocker, monkeypatch):
+    """Conversions cached with an older mapping are not served"""
+    file_id = upload(client, bootstrap_department.id, REPORT)
+    convert = mocker.spy(app_module, 'convert_cis_to_attack')
+    client.get(f'/api/files/{file_id}')
+
+    # As swapped in after the file changed
+    source = mapping_registry.sources[DEFAULT_MAPPING]
+    monkeypatch.setattr(source, '_mapping', source.get()._replace(
+        version='0123456789ab'
+    ))
+    monkeypatch.setattr(mapping_registry, 'generation',
+                        mapping_registry.generation + 1)
+    response = client.get(f'/api/files/{file_id}')
+
+    assert convert.call_count == 2
+    assert response.headers['X-Mapping-Version'] == '0123456789ab'
+    assert json.loads(response.data)['metadata'] == [
+        {'name': 'mapping', 'value': DEFAULT_MAPPING},
+        {'name': 'mapping_version', 'value': '0123456789ab'}
+    ]
+    response = client.get(f'/api/files/aggregate?id={file_id}')
+    assert response.headers['X-Mapping-Version'] == '0123456789ab'
+
+
+@pytest.fixture
+def other_mapping(mocker):
+    """A second mapping, mapping every rule of REPORT to T9999"""
+    default = mapping_registry.sources[DEFAULT_MAPPING]
+    mapping_registry.configure({
+        DEFAULT_MAPPING: (default.filename, default.sheet_name),
+        'other': (default.filename, 'Other sheet'),
+    }, DEFAULT_MAPPING)
+    mocker.patch('api.convert._load_mapping_dicts',
+                 return_value=({'1.1': ['T9999']}, {}))
+    yield mapping_registry.sources['other']
+    mapping_registry.configure({
+        DEFAULT_MAPPING: (default.filename, default.sheet_name),
+    }, DEFAULT_MAPPING)
+
+
+def test_mapping_is_selected_per_request(client, app, bootstrap_department,
+                                         other_mapping, mocker):
+    file_id = upload(client, bootstrap_department.id, REPORT)
+    convert = mocker.spy(app_module, 'convert_cis_to_attack')
+
+    default = client.get(f'/api/files/{file_id}')
+    other = client.get(f'/api/files/{file_id}?mapping=other')
+    client.get(f'/api/files/{file_id}?mapping=other')
+
+    assert other.status_code == 200
+    layer = json.loads(other.data)
+    assert [t['techniqueID'] for t in layer['techniques']] == ['T9999']
+    assert layer['metadata'][0] == {'name': 'mapping', 'value': 'other'}
+    assert other.headers['X-Mapping-Version'] == \
+        other_mapping.get().version
+    assert default.headers['X-Mapping-Version'] != \
+        other.headers['X-Mapping-Version']
+    # Cached per mapping
+    assert convert.call_count == 2
+
+    response = client.get(f'/api/files/aggregate?id={file_id}&mapping=other')
+    assert response.status_code == 200
+    assert [t['techniqueID'] for t in
+            json.loads(response.data)['techniques']] == ['T9999']
+
+    response = client.get('/api/mappings')
+    assert [m['name'] for m in response.get_json()['mappings']] == \
+        [DEFAULT_MAPPING, 'other']
+
+
+def test_unknown_mapping(client, bootstrap_department):
+    file_id = upload(client, bootstrap_department.id, REPORT)
+
+    for url in (f'/api/files/{file_id}?mapping=missing',
+                f'/api/files/aggregate?id={file_id}&mapping=missing'):
+        response = client.get(url)
+        assert response.status_code == 400
+        assert response.get_json() == {'message': 'Unknown mapping: missing'}
+
+
+def test_aggregate_reads_identical_reports_once(client, app, uploads_folder,
+                                                bootstrap_department,
+                                                mocker):
+    """Identical reports are only read and parsed once when combined"""
+    dept_id = bootstrap_department.id
+    file_ids = [upload(client, dept_id, REPORT, f'HOST{i}')
+                for i in range(3)]
+    file_ids.append(upload(client, dept_id, OTHER_REPORT, 'HOST3'))
+    load = mocker.spy(app_module.json, 'load')
+    combine = mocker.patch('api.app.combine_results', return_value={})
+
+    query = '&'.join(f'id={file_id}' for file_id in file_ids)
+    response = client.get(f'/api/files/aggregate?{query}')
+
+    assert response.status_code == 200
+    assert load.call_count == 2
+    assert combine.call_args[0][0] == [REPORT] * 3 + [OTHER_REPORT]
+
+
+def test_storage_usage_per_department(client, app, bootstrap_full):
+    """Savings are reported for every department the admin can see"""
+    dept1 = bootstrap_full['dept1'].id
+    dept2 = bootstrap_full['dept2'].id
+    storage.deduplicate_uploads(app.config['UPLOAD_FOLDER'])
+    for i in range(3):
+        upload(client, dept1, REPORT, f'HOST{i}')
+    upload(client, dept2, REPORT, 'HOST3')
+
+    response = client.get('/api/admin/storage')
+    assert response.status_code == 200
+    usage = {dept['id']: dept for dept in response.get_json()['departments']}
+
+    report_size = len(json.dumps(REPORT, indent=2).encode('utf-8'))
+    legacy_sizes = {
+        file_id: app.db.session.get(Metadata, file_id).size
+        for file_id in ('file_id1', 'file_id2', 'file_id3')
+    }
+    assert usage[dept1]['reports'] == 5
+    assert usage[dept1]['unique_reports'] == 3
+    assert usage[dept1]['logical_bytes'] == \
+        legacy_sizes['file_id1'] + legacy_sizes['file_id2'] + 3 * report_size
+    assert usage[dept1]['saved_bytes'] == 2 * report_size
+    assert usage[dept1]['stored_bytes'] == \
+        usage[dept1]['logical_bytes'] - usage[dept1]['saved_bytes']
+
+    # The same report in another department is a saving there as well
+    assert usage[dept2]['reports'] == 2
+    assert usage[dept2]['saved_bytes'] == 0
+
+    # Departments without files are listed too
+    assert all(dept['reports'] == 0 for dept_id, dept in usage.items()
+               if dept_id not in (dept1, dept2))
+
+
+def test_storage_usage_is_scoped_to_department_admins(client, app,
+                                                      bootstrap_full):
+    """Department admins only see their own departments"""
+    enable_authentication(client)
+
+    response = client.get('/api/admin/storage', headers=DEPT1_ADMIN)
+
+    assert response.status_code == 200
+    assert [dept['id'] for dept in response.get_json()['departments']] == \
+        [bootstrap_full['dept1'].id]
+
+
+def test_legacy_uploads_are_moved_into_the_content_store(client, app,
+                                                         bootstrap_full):
+    """Existing uploads are deduplicated by the dedupe command"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    # A legacy copy of file_id1 under another id
+    duplicate_dir = os.path.join(upload_folder, 'file_id4')
+    os.makedirs(duplicate_dir)
+    source_dir = os.path.join(upload_folder, 'file_id1')
+    filename = os.listdir(source_dir)[0]
+    shutil.copyfile(os.path.join(source_dir, filename),
+                    os.path.join(duplicate_dir, filename))
+    app.db.session.add(Metadata(id='file_id4', filename=filename,
+                                department_id=bootstrap_full['dept1'].id))
+    app.db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['storage', 'dedupe'])
+
+    assert result.exit_code == 0
+    assert 'Moved 4 uploads to the content store' in result.output
+    assert len(stored_files(upload_folder)) == 3
+    for file_id in ('file_id1', 'file_id2', 'file_id3', 'file_id4'):
+        assert not os.path.exists(os.path.join(upload_folder, file_id))
+        assert client.get(f'/api/files/{file_id}').status_code == 200
+
+    original = app.db.session.get(Metadata, 'file_id1')
+    duplicate = app.db.session.get(Metadata, 'file_id4')
+    assert original.storage_path == duplicate.storage_path
+    assert app.db.session.query(ReportBlob).filter_by(
+        content_hash=original.content_hash
+    ).one().ref_count == 2
+
+    # Nothing left the second time
+    assert storage.deduplicate_uploads(upload_folder) == 0
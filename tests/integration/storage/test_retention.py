@@ -0,0 +1,331 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+from api import retention, storage
+from api.app import create_app
+from api.db.db_methods import set_retention_policy, acquire_report_blob
+from api.db.models import Department, Metadata, ReportBlob
+
+NOW = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+
+def report(n):
+    return {'benchmark-title': 'BENCH', 'rules': [
+        {'rule-id': f'xccdf_org.cisecurity.benchmarks_rule_1.1.{n}_test',
+         'result': 'pass'}
+    ]}
+
+
+def upload(client, department_id, content, hostname, timestamp):
+    """Upload a report and return its id"""
+    data = {
+        'file': (
+            io.BytesIO(json.dumps(content).encode('utf-8')),
+            f'{hostname}-BENCH-{timestamp}.json'
+        ),
+    }
+    response = client.post(f'/api/files/?department_id={department_id}',
+                           data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def stored_path(app, file_id):
+    metadata = app.db.session.get(Metadata, file_id)
+    return storage.to_absolute_path(app.config['UPLOAD_FOLDER'],
+                                    metadata.storage_path)
+
+
+def test_reports_older_than_max_age_are_deleted(client, app, uploads_folder,
+                                                bootstrap_department):
+    """Only reports older than the policy allows are removed"""
+    dept_id = bootstrap_department.id
+    old = upload(client, dept_id, report(1), 'HOST1', '20250101T000000Z')
+    new = upload(client, dept_id, report(2), 'HOST1', '20250530T000000Z')
+    old_path = stored_path(app, old)
+    set_retention_policy(dept_id, 30, None)
+
+    result = retention.run_retention(uploads_folder, now=NOW)
+
+    assert result == [{
+        'department_id': dept_id,
+        'department': 'dept',
+        'reports': 1,
+        'bytes': os.path.getsize(stored_path(app, new)),
+        'freed_bytes': os.path.getsize(stored_path(app, new)),
+    }]
+    assert app.db.session.get(Metadata, old) is None
+    assert not os.path.exists(old_path)
+    assert client.get(f'/api/files/{old}').status_code == 404
+    assert client.get(f'/api/files/{new}').status_code == 200
+
+
+def test_only_newest_reports_per_host_are_kept(client, app, uploads_folder,
+                                               bootstrap_department):
+    """Each host keeps its newest reports up to the limit"""
+    dept_id = bootstrap_department.id
+    host1 = [upload(client, dept_id, report(i), 'HOST1',
+                    f'2025050{i}T000000Z') for i in range(1, 5)]
+    host2 = [upload(client, dept_id, report(9), 'HOST2', '20250101T000000Z')]
+    set_retention_policy(dept_id, None, 2)
+
+    result = retention.run_retention(uploads_folder, now=NOW)
+
+    assert result[0]['reports'] == 2
+    remaining = {row.id for row in app.db.session.query(Metadata)}
+    assert remaining == {host1[2], host1[3], host2[0]}
+
+
+def test_limits_are_combined(client, app, uploads_folder,
+                             bootstrap_department):
+    """Reports are deleted when either limit applies"""
+    dept_id = bootstrap_department.id
+    expired = upload(client, dept_id, report(1), 'HOST1', '20240101T000000Z')
+    older = upload(client, dept_id, report(2), 'HOST2', '20250520T000000Z')
+    newest = upload(client, dept_id, report(3), 'HOST2', '20250530T000000Z')
+    set_retention_policy(dept_id, 30, 1)
+
+    retention.run_retention(uploads_folder, now=NOW)
+
+    for file_id in (expired, older):
+        assert app.db.session.get(Metadata, file_id) is None
+    assert app.db.session.get(Metadata, newest) is not None
+
+
+def test_shared_reports_are_kept_while_referenced(client, app,
+                                                  uploads_folder,
+                                                  bootstrap_department):
+    """A report stored once is only removed with its last reference"""
+    dept_id = bootstrap_department.id
+    old = upload(client, dept_id, report(1), 'HOST1', '20250101T000000Z')
+    new = upload(client, dept_id, report(1), 'HOST2', '20250530T000000Z')
+    path = stored_path(app, old)
+    content_hash = app.db.session.get(Metadata, old).content_hash
+    set_retention_policy(dept_id, 30, None)
+
+    result = retention.run_retention(uploads_folder, now=NOW)
+
+    assert result[0]['reports'] == 1
+    assert result[0]['freed_bytes'] == 0
+    assert os.path.exists(path)
+    assert client.get(f'/api/files/{new}').status_code == 200
+    blob = app.db.session.query(ReportBlob).filter_by(
+        content_hash=content_hash
+    ).one()
+    assert blob.ref_count == 1
+
+    set_retention_policy(dept_id, 1, None)
+    retention.run_retention(uploads_folder, now=NOW)
+
+    assert not os.path.exists(path)
+    assert app.db.session.query(ReportBlob).count() == 0
+
+    # Uploading the same report again stores it again
+    again = upload(client, dept_id, report(1), 'HOST1', '20250601T000000Z')
+    assert os.path.exists(stored_path(app, again))
+    assert client.get(f'/api/files/{again}').status_code == 200
+
+
+def test_dry_run_keeps_everything(client, app, uploads_folder,
+                                  bootstrap_department):
+    """A dry run only reports what would be deleted"""
+    dept_id = bootstrap_department.id
+    old = upload(client, dept_id, report(1), 'HOST1', '20250101T000000Z')
+    set_retention_policy(dept_id, 30, None)
+
+    result = retention.run_retention(uploads_folder, dry_run=True, now=NOW)
+
+    assert result[0]['reports'] == 1
+    assert 'freed_bytes' not in result[0]
+    assert os.path.exists(stored_path(app, old))
+    assert client.get(f'/api/files/{old}').status_code == 200
+
+
+def test_departments_without_policy_are_kept(client, app, uploads_folder,
+                                             bootstrap_department):
+    """Reports are kept indefinitely without a retention policy"""
+    dept_id = bootstrap_department.id
+    old = upload(client, dept_id, report(1), 'HOST1', '20200101T000000Z')
+
+    assert retention.run_retention(uploads_folder, now=NOW) == []
+    assert app.db.session.get(Metadata, old) is not None
+
+
+def test_legacy_uploads_are_deleted(client, app, bootstrap_full):
+    """Uploads not stored by content hash lose their directory"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    storage.migrate_uploads(upload_folder, limit=1)
+    set_retention_policy(bootstrap_full['dept1'].id, 30, None)
+
+    result = retention.run_retention(upload_folder, now=NOW)
+
+    assert result[0]['reports'] == 2
+    assert result[0]['freed_bytes'] > 0
+    for file_id in ('file_id1', 'file_id2'):
+        assert not os.path.exists(os.path.join(upload_folder, file_id))
+        assert not os.path.exists(
+            storage.upload_dir_path(upload_folder, file_id)
+        )
+    assert client.get('/api/files/file_id3').status_code == 200
+
+
+def test_deleting_in_batches(client, app, uploads_folder,
+                             bootstrap_department):
+    """Every batch releases its own stored reports"""
+    dept_id = bootstrap_department.id
+    file_ids = [upload(client, dept_id, report(i % 2), f'HOST{i}',
+                       '20250101T000000Z') for i in range(5)]
+    paths = {stored_path(app, file_id) for file_id in file_ids}
+    size = sum(os.path.getsize(path) for path in paths)
+
+    freed = retention.delete_expired_files(uploads_folder, file_ids,
+                                           batch_size=2)
+
+    assert freed == size
+    assert not any(os.path.exists(path) for path in paths)
+    assert app.db.session.query(Metadata).count() == 0
+    assert app.db.session.query(ReportBlob).count() == 0
+
+
+def test_reports_are_kept_when_commit_fails(client, app, uploads_folder,
+                                            bootstrap_department, mocker):
+    """Stored reports stay on disk until their rows are deleted"""
+    dept_id = bootstrap_department.id
+    file_id = upload(client, dept_id, report(1), 'HOST1', '20250101T000000Z')
+    path = stored_path(app, file_id)
+    mocker.patch.object(app.db.session, 'commit',
+                        side_effect=RuntimeError('disk full'))
+
+    with pytest.raises(RuntimeError):
+        retention.delete_expired_files(uploads_folder, [file_id])
+
+    assert os.path.exists(path)
+    assert app.db.session.get(Metadata, file_id) is not None
+
+
+@pytest.fixture
+def database_app():
+    """An app with a database file, so threads use their own connections"""
+    tmp_dir = tempfile.mkdtemp(prefix='test_retention_')
+    app = create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': os.path.join(tmp_dir, 'uploads'),
+        'SQLALCHEMY_DATABASE_URI':
+            f"sqlite:///{os.path.join(tmp_dir, 'app.db')}",
+        'ENABLE_SSO': False
+    })
+
+    yield app
+
+    with app.app_context():
+        app.db.engine.dispose()
+    shutil.rmtree(tmp_dir)
+
+
+def test_concurrent_upload_keeps_its_report(database_app, mocker):
+    """An upload of a report being deleted is not left without its file"""
+    app = database_app
+    upload_folder = app.config['UPLOAD_FOLDER']
+    with app.app_context():
+        department = Department(name='dept')
+        app.db.session.add(department)
+        app.db.session.commit()
+        file_id = upload(app.test_client(), department.id, report(1),
+                         'HOST1', '20250101T000000Z')
+        blob = app.db.session.query(ReportBlob).one()
+        content_hash, storage_path, size = \
+            blob.content_hash, blob.storage_path, blob.size
+    path = storage.to_absolute_path(upload_folder, storage_path)
+    with open(path, 'rb') as F:
+        content = F.read()
+
+    referenced = threading.Event()
+
+    def upload_same_report():
+        # Like save_file, committing only after retention checked the file
+        with app.app_context():
+            acquire_report_blob(content_hash, storage_path, size)
+            storage.store_blob(upload_folder, storage_path, content)
+            referenced.set()
+            time.sleep(0.2)
+            app.db.session.commit()
+
+    lock_unused = retention.lock_unused_storage_paths
+    thread = threading.Thread(target=upload_same_report)
+
+    def upload_after_deleting(storage_paths):
+        thread.start()
+        assert referenced.wait(timeout=10)
+        return lock_unused(storage_paths)
+
+    mocker.patch.object(retention, 'lock_unused_storage_paths',
+                        side_effect=upload_after_deleting)
+
+    with app.app_context():
+        assert retention.delete_expired_files(upload_folder,
+                                              [file_id]) == 0
+    thread.join(timeout=10)
+
+    assert os.path.exists(path)
+    with app.app_context():
+        assert app.db.session.query(ReportBlob).one().ref_count == 1
+
+
+def test_file_list_cache_is_invalidated(client, app, uploads_folder,
+                                        bootstrap_department):
+    """Deleted reports disappear from cached file lists"""
+    dept_id = bootstrap_department.id
+    file_id = upload(client, dept_id, report(1), 'HOST1', '20250101T000000Z')
+    assert client.get('/api/files').get_json()['ids'] == [file_id]
+    set_retention_policy(dept_id, 30, None)
+
+    retention.run_retention(uploads_folder, now=NOW)
+
+    assert client.get('/api/files').get_json()['ids'] == []
+
+
+def test_database_is_optimized_after_deleting(client, app, uploads_folder,
+                                              bootstrap_department, mocker):
+    """Statistics are refreshed and the file rebuilt on request"""
+    dept_id = bootstrap_department.id
+    upload(client, dept_id, report(1), 'HOST1', '20250101T000000Z')
+    set_retention_policy(dept_id, 30, None)
+    optimize = mocker.spy(retention, 'optimize_database')
+
+    retention.run_retention(uploads_folder, vacuum=True, now=NOW)
+    # Nothing left to delete
+    retention.run_retention(uploads_folder, vacuum=True, now=NOW)
+
+    optimize.assert_called_once_with(True)
+
+
+@pytest.mark.skipif(storage.fcntl is None, reason='requires fcntl')
+def test_retention_waits_for_other_maintenance(app, uploads_folder):
+    """Retention does not run next to a migration"""
+    with storage.maintenance_lock(uploads_folder):
+        assert retention.run_retention(uploads_folder) is None
+
+
+def test_retention_command(client, app, runner, uploads_folder,
+                           bootstrap_department):
+    """Retention can be run from the command line"""
+    dept_id = bootstrap_department.id
+    old = upload(client, dept_id, report(1), 'HOST1', '20200101T000000Z')
+    set_retention_policy(dept_id, 30, None)
+
+    result = runner.invoke(args=['retention', 'run', '--dry-run'])
+    assert result.exit_code == 0
+    assert 'dept: Would delete 1 reports' in result.output
+    assert app.db.session.get(Metadata, old) is not None
+
+    result = runner.invoke(args=['retention', 'run', '--vacuum'])
+    assert result.exit_code == 0
+    assert 'Deleted 1 reports in total' in result.output
+    assert app.db.session.get(Metadata, old) is None
@@ -0,0 +1,226 @@
+import io
+import json
+import os
+import shutil
+from datetime import datetime
+
+from api import storage
+from api.db.models import Metadata, ReportBlob
+from api.retention import delete_expired_files
+
+CUTOFF = datetime(2025, 3, 1)
+
+
+def report(n):
+    return {'benchmark-title': 'BENCH', 'rules': [
+        {'rule-id': f'xccdf_org.cisecurity.benchmarks_rule_1.1.{n}_test',
+         'result': 'pass'}
+    ]}
+
+
+def upload(client, department_id, content, hostname,
+           timestamp='20250101T000000Z'):
+    """Upload a report and return its id"""
+    data = {
+        'file': (
+            io.BytesIO(json.dumps(content).encode('utf-8')),
+            f'{hostname}-BENCH-{timestamp}.json'
+        ),
+    }
+    response = client.post(f'/api/files/?department_id={department_id}',
+                           data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+
+def segments(upload_folder):
+    segment_dir = os.path.join(upload_folder, storage.SEGMENT_DIR)
+    if not os.path.isdir(segment_dir):
+        return []
+    return sorted(os.listdir(segment_dir))
+
+
+def loose_reports(upload_folder):
+    return [name for _, _, names in os.walk(upload_folder)
+            for name in names if name.endswith('.json')]
+
+
+def test_cold_reports_are_packed(client, app, uploads_folder,
+                                 bootstrap_department):
+    """Old reports end up in one segment and read the same as before"""
+    dept_id = bootstrap_department.id
+    cold = [upload(client, dept_id, report(i), f'HOST{i}') for i in range(3)]
+    hot = upload(client, dept_id, report(9), 'HOST9', '20250501T000000Z')
+    before = {file_id: client.get(f'/api/files/{file_id}').data
+              for file_id in cold}
+
+    assert storage.pack_reports(uploads_folder, CUTOFF) == 3
+
+    assert len(segments(uploads_folder)) == 1
+    assert len(loose_reports(uploads_folder)) == 1
+    for file_id in cold:
+        metadata = app.db.session.get(Metadata, file_id)
+        assert metadata.storage_path.startswith(f'{storage.SEGMENT_DIR}/')
+        _, location = storage.find_file(uploads_folder, file_id)
+        assert isinstance(location, storage.PackedReport)
+        assert client.get(f'/api/files/{file_id}').data == before[file_id]
+    assert client.get(f'/api/files/{hot}').status_code == 200
+
+    query = '&'.join(f'id={file_id}' for file_id in cold + [hot])
+    assert client.get(f'/api/files/aggregate?{query}').status_code == 200
+
+    # Nothing left the second time
+    assert storage.pack_reports(uploads_folder, CUTOFF) == 0
+
+
+def test_packed_reports_are_read_by_offset(client, app, uploads_folder,
+                                           bootstrap_department):
+    """Only the bytes of the report are read from the segment"""
+    dept_id = bootstrap_department.id
+    file_ids = [upload(client, dept_id, report(i), f'HOST{i}')
+                for i in range(3)]
+    storage.pack_reports(uploads_folder, CUTOFF)
+
+    for i, file_id in enumerate(file_ids):
+        _, location = storage.find_file(uploads_folder, file_id)
+        with storage.open_report(location) as F:
+            assert json.load(F) == report(i)
+
+
+def test_reports_found_before_packing_stay_readable(client, app,
+                                                    uploads_folder,
+                                                    bootstrap_department,
+                                                    mocker):
+    """A path looked up before its file was packed is looked up again"""
+    dept_id = bootstrap_department.id
+    file_id = upload(client, dept_id, report(1), 'HOST1')
+    stale = storage.find_file(uploads_folder, file_id)
+
+    assert storage.pack_reports(uploads_folder, CUTOFF) == 1
+
+    assert not os.path.exists(stale[1])
+    assert storage.read_report(uploads_folder, file_id, stale[1]) == \
+        report(1)
+    mocker.patch('api.app.find_file', return_value=stale)
+    assert client.get(f'/api/files/{file_id}').status_code == 200
+    mocker.patch('api.app.find_files', return_value=[stale])
+    assert client.get(f'/api/files/aggregate?id={file_id}').status_code \
+        == 200
+
+
+def test_segments_are_split_by_size(client, app, uploads_folder,
+                                    bootstrap_department):
+    """A new segment is started once one is full"""
+    dept_id = bootstrap_department.id
+    file_ids = [upload(client, dept_id, report(i), f'HOST{i}')
+                for i in range(3)]
+    size = app.db.session.get(Metadata, file_ids[0]).size
+
+    assert storage.pack_reports(uploads_folder, CUTOFF,
+                                max_size=2 * size) == 3
+
+    assert len(segments(uploads_folder)) == 2
+    for file_id in file_ids:
+        assert client.get(f'/api/files/{file_id}').status_code == 200
+
+
+def test_pack_limit(client, app, uploads_folder, bootstrap_department):
+    dept_id = bootstrap_department.id
+    for i in range(3):
+        upload(client, dept_id, report(i), f'HOST{i}')
+
+    assert storage.pack_reports(uploads_folder, CUTOFF, limit=2) == 2
+    assert storage.pack_reports(uploads_folder, CUTOFF) == 1
+
+
+def test_reports_with_recent_copies_stay_loose(client, app, uploads_folder,
+                                               bootstrap_department):
+    """A report is only cold when none of its uploads are recent"""
+    dept_id = bootstrap_department.id
+    upload(client, dept_id, report(1), 'HOST1')
+    upload(client, dept_id, report(1), 'HOST2', '20250501T000000Z')
+
+    assert storage.pack_reports(uploads_folder, CUTOFF) == 0
+
+
+def test_damaged_reports_are_not_packed(client, app, uploads_folder,
+                                        bootstrap_department):
+    dept_id = bootstrap_department.id
+    file_id = upload(client, dept_id, report(1), 'HOST1')
+    metadata = app.db.session.get(Metadata, file_id)
+    path = storage.to_absolute_path(uploads_folder, metadata.storage_path)
+    with open(path, 'a') as F:
+        F.write(' ')
+
+    assert storage.pack_reports(uploads_folder, CUTOFF) == 0
+    assert segments(uploads_folder) == []
+    assert os.path.exists(path)
+
+
+def test_uploading_a_packed_report_again(client, app, uploads_folder,
+                                         bootstrap_department):
+    """Identical uploads reference the packed report"""
+    dept_id = bootstrap_department.id
+    first = upload(client, dept_id, report(1), 'HOST1')
+    storage.pack_reports(uploads_folder, CUTOFF)
+
+    second = upload(client, dept_id, report(1), 'HOST2', '20250501T000000Z')
+
+    assert loose_reports(uploads_folder) == []
+    assert app.db.session.get(Metadata, second).storage_path == \
+        app.db.session.get(Metadata, first).storage_path
+    assert client.get(f'/api/files/{second}').status_code == 200
+
+
+def test_deduplicating_against_a_packed_report(client, app, uploads_folder,
+                                               bootstrap_department):
+    """Legacy copies of a packed report do not leave a loose file"""
+    dept_id = bootstrap_department.id
+    first = upload(client, dept_id, report(1), 'HOST1')
+    metadata = app.db.session.get(Metadata, first)
+    source = storage.to_absolute_path(uploads_folder, metadata.storage_path)
+    legacy_dir = os.path.join(uploads_folder, 'legacy-id')
+    os.makedirs(legacy_dir)
+    shutil.copyfile(source, os.path.join(legacy_dir, 'legacy.json'))
+    app.db.session.add(Metadata(id='legacy-id', filename='legacy.json',
+                                department_id=dept_id))
+    app.db.session.commit()
+    storage.pack_reports(uploads_folder, CUTOFF)
+
+    assert storage.deduplicate_uploads(uploads_folder) == 1
+
+    assert loose_reports(uploads_folder) == []
+    assert client.get('/api/files/legacy-id').status_code == 200
+    # The segment directory is not mistaken for a legacy upload
+    assert storage.migrate_uploads(uploads_folder) == 0
+
+
+def test_segments_are_removed_once_empty(client, app, uploads_folder,
+                                         bootstrap_department):
+    """Deleting packed reports keeps the segment until all are gone"""
+    dept_id = bootstrap_department.id
+    file_ids = [upload(client, dept_id, report(i), f'HOST{i}')
+                for i in range(2)]
+    storage.pack_reports(uploads_folder, CUTOFF)
+    segment = os.path.join(uploads_folder, storage.SEGMENT_DIR,
+                           segments(uploads_folder)[0])
+    size = os.path.getsize(segment)
+
+    assert delete_expired_files(uploads_folder, file_ids[:1]) == 0
+    assert os.path.exists(segment)
+    assert client.get(f'/api/files/{file_ids[1]}').status_code == 200
+
+    assert delete_expired_files(uploads_folder, file_ids[1:]) == size
+    assert not os.path.exists(segment)
+    assert app.db.session.query(ReportBlob).count() == 0
+
+
+def test_pack_command(runner, client, app, uploads_folder,
+                      bootstrap_department):
+    """Packing can be started from the command line"""
+    upload(client, bootstrap_department.id, report(1), 'HOST1')
+
+    result = runner.invoke(args=['storage', 'pack', '--older-than', '0'])
+
+    assert result.exit_code == 0
+    assert 'Packed 1 reports into segments' in result.output
@@ -0,0 +1,142 @@
+import json
+import os
+
+import pytest
+from api import storage
+from api.db.models import Metadata
+
+LEGACY_IDS = ['file_id1', 'file_id2', 'file_id3']
+
+
+def sharded_dir(upload_folder, file_id):
+    return os.path.join(upload_folder, file_id[:2], file_id[2:4], file_id)
+
+
+def test_migration_moves_legacy_uploads(client, app, bootstrap_full):
+    """Uploads in the flat layout are moved and their paths recorded"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    assert storage.migrate_uploads(upload_folder) == 3
+
+    for file_id in LEGACY_IDS:
+        assert not os.path.exists(os.path.join(upload_folder, file_id))
+        metadata = app.db.session.get(Metadata, file_id)
+        assert metadata.storage_path == \
+            f'fi/le/{file_id}/{metadata.filename}'
+        path = os.path.join(sharded_dir(upload_folder, file_id),
+                            metadata.filename)
+        assert metadata.size == os.path.getsize(path)
+
+        response = client.get(f'/api/files/{file_id}')
+        assert response.status_code == 200
+
+    # Nothing left to do the second time
+    assert storage.migrate_uploads(upload_folder) == 0
+
+
+def test_migration_limit(app, bootstrap_full):
+    """The migration can be done in steps"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    assert storage.migrate_uploads(upload_folder, limit=2) == 2
+    assert storage.migrate_uploads(upload_folder, limit=2) == 1
+
+
+def test_uploads_stay_readable_during_migration(client, app, bootstrap_full,
+                                                mocker):
+    """Every step of moving an upload leaves it readable"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    update_storage_path = storage.update_storage_path
+    responses = []
+
+    def update_and_read(file_id, storage_path, size):
+        # The file is in both places before the path is recorded
+        responses.append(client.get(f'/api/files/{file_id}').status_code)
+        updated = update_storage_path(file_id, storage_path, size)
+        # And still there after, before the old directory is removed
+        responses.append(client.get(f'/api/files/{file_id}').status_code)
+        return updated
+
+    mocker.patch.object(storage, 'update_storage_path',
+                        side_effect=update_and_read)
+
+    assert storage.migrate_uploads(upload_folder, limit=1) == 1
+    assert responses == [200, 200]
+
+
+def test_uploads_found_before_migrating_stay_readable(app, bootstrap_full):
+    """A path looked up before the upload moved is looked up again"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    _, stale = storage.find_file(upload_folder, 'file_id1')
+    with open(stale) as F:
+        content = json.load(F)
+
+    assert storage.migrate_uploads(upload_folder) == 3
+
+    assert not os.path.exists(stale)
+    assert storage.read_report(upload_folder, 'file_id1', stale) == content
+
+
+def test_moved_upload_without_metadata_is_found(client, app, uploads_folder):
+    """Uploads without a recorded path are found in the sharded layout"""
+    orphan_dir = os.path.join(uploads_folder, 'orphan-id')
+    os.makedirs(orphan_dir)
+    with open(os.path.join(orphan_dir, 'orphan.json'), 'w') as F:
+        json.dump({'mock': 'data'}, F)
+
+    assert storage.migrate_uploads(uploads_folder) == 1
+    assert os.path.exists(os.path.join(
+        sharded_dir(uploads_folder, 'orphan-id'), 'orphan.json'
+    ))
+    assert storage.find_file(uploads_folder, 'orphan-id') == (
+        'orphan.json',
+        os.path.join(sharded_dir(uploads_folder, 'orphan-id'), 'orphan.json')
+    )
+
+
+def test_directories_with_unexpected_files_are_skipped(app, uploads_folder):
+    """Directories not holding exactly one file are left alone"""
+    broken_dir = os.path.join(uploads_folder, 'broken-id')
+    os.makedirs(broken_dir)
+    for name in ('a.json', 'b.json'):
+        with open(os.path.join(broken_dir, name), 'w') as F:
+            F.write('{}')
+
+    assert storage.migrate_uploads(uploads_folder) == 0
+    assert sorted(os.listdir(broken_dir)) == ['a.json', 'b.json']
+
+
+@pytest.mark.skipif(storage.fcntl is None, reason='requires fcntl')
+def test_only_one_migration_runs_at_a_time(app, bootstrap_full):
+    """A second migration gives up while the first one holds the lock"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    with storage.maintenance_lock(upload_folder) as acquired:
+        assert acquired
+        assert storage.migrate_uploads(upload_folder) is None
+
+    assert storage.migrate_uploads(upload_folder) == 3
+
+
+def test_background_migration(app, bootstrap_full):
+    """The migration can run next to serving requests"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    storage.start_background_migration(app).join(timeout=10)
+
+    for file_id in LEGACY_IDS:
+        assert not os.path.exists(os.path.join(upload_folder, file_id))
+        metadata = app.db.session.get(Metadata, file_id)
+        # Moved all the way into the content store
+        assert metadata.content_hash
+        assert os.path.exists(os.path.join(
+            upload_folder, *metadata.storage_path.split('/')
+        ))
+
+
+def test_migrate_command(runner, app, bootstrap_full):
+    """The migration can be started from the command line"""
+    result = runner.invoke(args=['storage', 'migrate', '--limit', '1'])
+
+    assert result.exit_code == 0
+    assert 'Migrated 1 uploads' in result.output
@@ -1,5 +1,11 @@
 import json
+import os
+import time
 
+import pytest
+
+from api import convert
+from api.app import create_app
 from api.convert import combine_results, convert_cis_to_attack
 
 
@@ -88,7 +94,7 @@ def test_layer_schema():
     layer = convert_cis_to_attack(cis_true)
     keys = set(layer.keys())
     assert keys == {'version', 'name', 'domain', 'description',
-                    'techniques'}
+                    'metadata', 'techniques'}
     for t in layer['techniques']:
         tkeys = set(t.keys())
         assert tkeys == {'techniqueID', 'score', 'color',
@@ -133,3 +139,216 @@ def test_ordering_invariance():
     ids2 = sorted(t['techniqueID']
                   for t in out_shuf['techniques'])
     assert ids1 == ids2, "Ordering affects output IDs"
+
+
+def test_mapping_is_loaded_once_on_first_use(monkeypatch, mocker):
+    """The mapping is loaded by the first conversion, not again after"""
+    mapping = convert.get_mapping()
+    monkeypatch.setattr(convert, 'mapping_registry', convert.MappingRegistry(
+        {'default': (convert.EX_MAP, convert.SHEET_NAME)}, 'default'
+    ))
+    load = mocker.patch.object(convert, '_load_mapping_dicts', return_value=(
+        mapping.safeguard_map, mapping.control_map
+    ))
+
+    layer = convert_cis_to_attack({'rules': []})
+    convert_cis_to_attack({'rules': []})
+
+    load.assert_called_once()
+    assert load.call_args.args[1] == convert.SHEET_NAME
+    assert convert.get_mapping_load_seconds() is not None
+    assert layer['metadata'] == [
+        {'name': 'mapping', 'value': 'default'},
+        {'name': 'mapping_version', 'value': mapping.version},
+    ]
+
+
+def fake_mappings(mocker):
+    """Replace compiling a mapping with a new technique per compile"""
+    compiled = iter(range(1, 100))
+
+    def compile_mapping(source, sheet_name):
+        technique = f'T{next(compiled)}'
+        return {'1.1': [technique]}, {'1': [technique]}
+    return mocker.patch.object(convert, '_load_mapping_dicts',
+                               side_effect=compile_mapping)
+
+
+def mapping_file(tmp_path, name='mapping.xlsx', content=b'mapping') -> str:
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def wait_for_reload(source: convert.MappingSource):
+    deadline = time.monotonic() + 5
+    while source._reloading and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_changed_mapping_is_swapped_in(tmp_path, mocker):
+    """A changed file is compiled in the background and then used"""
+    fake_mappings(mocker)
+    path = mapping_file(tmp_path, content=b'first')
+    replaced = mocker.Mock()
+    source = convert.MappingSource('default', path, convert.SHEET_NAME,
+                                   replaced)
+    source.check_seconds = 60
+    first = source.get()
+
+    # Checked at most once per check_seconds
+    with open(path, 'wb') as F:
+        F.write(b'second version')
+    assert source.check()
+    wait_for_reload(source)
+    with open(path, 'wb') as F:
+        F.write(b'third version!')
+    assert not source.check()
+
+    second = source.get()
+    assert second.version != first.version
+    assert second.safeguard_map == {'1.1': ['T2']}
+    replaced.assert_called_once()
+    rule = {'rule-id': 'xccdf_org.cisecurity.benchmarks_rule_1.1.1_L1_x',
+            'result': 'pass'}
+    assert [t['techniqueID'] for t in
+            convert.generate_techniques({'rules': [rule]}, mapping=first)] \
+        == ['T1']
+
+
+def test_unchanged_mapping_is_not_swapped(tmp_path, mocker):
+    """Touching the file without changing it keeps the mapping"""
+    compile_mapping = fake_mappings(mocker)
+    path = mapping_file(tmp_path)
+    source = convert.MappingSource('default', path, convert.SHEET_NAME)
+    mapping = source.get()
+
+    os.utime(path, ns=(0, 0))
+    assert source.reload() is mapping
+    assert compile_mapping.call_count == 1
+
+
+def test_failed_reload_keeps_the_mapping(tmp_path, mocker):
+    """A file that can not be compiled leaves the current mapping in use"""
+    compile_mapping = fake_mappings(mocker)
+    path = mapping_file(tmp_path)
+    source = convert.MappingSource('default', path, convert.SHEET_NAME)
+    source.check_seconds = 60
+    mapping = source.get()
+
+    compile_mapping.side_effect = ValueError('incomplete file')
+    with open(path, 'wb') as F:
+        F.write(b'half written')
+    assert source.check()
+    wait_for_reload(source)
+
+    assert source.get() is mapping
+    # Tried again on the next check
+    source._next_check = 0
+    assert source.check()
+    wait_for_reload(source)
+
+
+def test_mappings_are_selected_by_name(tmp_path, mocker):
+    compile_mapping = fake_mappings(mocker)
+    path = mapping_file(tmp_path)
+    registry = convert.MappingRegistry({
+        'default': (path, 'Low'),
+        'high': (path, 'High'),
+    }, 'default')
+
+    assert registry.get().name == 'default'
+    high = registry.get('high')
+    assert high.name == 'high'
+    # Sheets of the same file are different versions
+    assert high.version != registry.get('default').version
+    assert compile_mapping.call_count == 2
+    with pytest.raises(KeyError):
+        registry.get('missing')
+    assert [(m['name'], m['version'] is not None)
+            for m in registry.describe()] == \
+        [('default', True), ('high', True)]
+
+
+def test_least_recently_used_mapping_is_freed(tmp_path, mocker):
+    """Mappings over the memory budget are freed and compiled again"""
+    compile_mapping = fake_mappings(mocker)
+    path = mapping_file(tmp_path)
+    registry = convert.MappingRegistry({
+        name: (path, name) for name in ('a', 'b', 'c')
+    }, 'a')
+    registry.get('a')
+    # Room for two mappings
+    registry.memory_budget = registry.sources['a'].size * 2
+
+    registry.get('b')
+    registry.get('a')
+    registry.get('c')
+
+    assert [name for name, source in registry.sources.items()
+            if source.loaded] == ['a', 'c']
+    registry.get('b')
+    assert compile_mapping.call_count == 4
+    assert not registry.sources['a'].loaded
+
+    # The mapping in use stays even if it alone is over the budget
+    registry.memory_budget = 0
+    assert registry.get('c')
+    assert [name for name, source in registry.sources.items()
+            if source.loaded] == ['c']
+
+
+def test_reconfiguring_keeps_loaded_mappings(tmp_path, mocker):
+    compile_mapping = fake_mappings(mocker)
+    path = mapping_file(tmp_path)
+    other = mapping_file(tmp_path, 'other.xlsx')
+    registry = convert.MappingRegistry({'default': (path, 'Low')},
+                                       'default')
+    mapping = registry.get()
+
+    registry.configure({'default': (path, 'Low'), 'new': (other, 'Low')},
+                       'default', check_seconds=60)
+    assert registry.get() is mapping
+    assert registry.sources['default'].check_seconds == 60
+    registry.configure({'default': (other, 'Low')}, 'default')
+    assert registry.get() is not mapping
+    assert compile_mapping.call_count == 2
+    with pytest.raises(ValueError):
+        registry.configure({'new': (other, 'Low')}, 'default')
+
+
+def test_mapping_is_preloaded_on_request(app, mocker):
+    preload = mocker.patch('api.app.preload_mapping')
+
+    create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'PRELOAD_MAPPING': True,
+    })
+
+    preload.assert_called_once()
+
+
+def test_mappings_are_configured_from_the_environment(app, monkeypatch):
+    monkeypatch.setenv('MAPPINGS', 'v14=/mappings/v14.xlsx; '
+                                   'high=/mappings/v8.xlsx|High Level;')
+    configured = create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+    })
+
+    assert configured.config['MAPPINGS'] == {
+        'v14': ('/mappings/v14.xlsx', convert.SHEET_NAME),
+        'high': ('/mappings/v8.xlsx', 'High Level'),
+    }
+    assert sorted(convert.mapping_registry.sources) == \
+        ['default', 'high', 'v14']
+    monkeypatch.delenv('MAPPINGS')
+    create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+    })
+    assert list(convert.mapping_registry.sources) == ['default']
@@ -0,0 +1,104 @@
+import os
+import runpy
+from types import SimpleNamespace
+
+import pytest
+
+CONFIG = os.path.join(os.path.dirname(__file__), '..', '..', 'api',
+                      'gunicorn.conf.py')
+
+
+def unset_preload_mapping(monkeypatch):
+    # Set first so the variables the config sets are removed again after
+    for name in ('PRELOAD_MAPPING', 'START_BACKGROUND_TASKS', 'METRICS_DIR'):
+        monkeypatch.setenv(name, '')
+        monkeypatch.delenv(name)
+
+
+@pytest.fixture
+def config(monkeypatch):
+    unset_preload_mapping(monkeypatch)
+    monkeypatch.setenv('WEB_PORT', '8080')
+    monkeypatch.setenv('WORKER_THREADS', '3')
+    return runpy.run_path(CONFIG)
+
+
+def test_settings(config):
+    assert config['bind'] == ':8080'
+    assert config['workers'] == 3
+    assert config['preload_app']
+    assert os.environ['PRELOAD_MAPPING'] == 'true'
+    assert os.environ['START_BACKGROUND_TASKS'] == 'false'
+    assert os.environ['METRICS_DIR']
+
+
+def test_single_worker_keeps_metrics_in_memory(monkeypatch):
+    unset_preload_mapping(monkeypatch)
+    monkeypatch.setenv('WORKER_THREADS', '1')
+
+    runpy.run_path(CONFIG)
+
+    assert 'METRICS_DIR' not in os.environ
+
+
+def test_preloading_can_be_disabled(monkeypatch):
+    unset_preload_mapping(monkeypatch)
+    monkeypatch.setenv('GUNICORN_PRELOAD', 'false')
+
+    config = runpy.run_path(CONFIG)
+
+    assert not config['preload_app']
+    assert 'PRELOAD_MAPPING' not in os.environ
+    assert 'START_BACKGROUND_TASKS' not in os.environ
+
+
+def test_workers_drop_inherited_connections(config, app, mocker):
+    """Connections of the master are left open for the master"""
+    dispose = mocker.spy(type(app.db.engine), 'dispose')
+    server = SimpleNamespace(app=SimpleNamespace(wsgi=lambda: app))
+
+    config['post_fork'](server, None)
+
+    dispose.assert_called_once_with(app.db.engine, close=False)
+
+
+def test_workers_start_background_threads(config, app, mocker):
+    """Threads are started after forking, not in the master"""
+    migration = mocker.patch('api.app.start_background_migration')
+    retention = mocker.patch('api.app.start_retention_schedule')
+    app.config['MIGRATE_UPLOADS'] = True
+    app.config['RETENTION_INTERVAL_HOURS'] = 24
+    server = SimpleNamespace(app=SimpleNamespace(wsgi=lambda: app))
+
+    config['post_fork'](server, None)
+
+    migration.assert_called_once_with(app)
+    retention.assert_called_once_with(app)
+
+
+def test_preloaded_app_starts_no_threads(config, monkeypatch, mocker,
+                                         tmp_path):
+    from api.app import create_app
+
+    migration = mocker.patch('api.app.start_background_migration')
+    retention = mocker.patch('api.app.start_retention_schedule')
+    monkeypatch.setenv('MIGRATE_UPLOADS', 'true')
+    monkeypatch.setenv('RETENTION_INTERVAL_HOURS', '24')
+    monkeypatch.setenv('PRELOAD_MAPPING', 'false')
+
+    app = create_app({'TESTING': True, 'UPLOAD_FOLDER': str(tmp_path),
+                      'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+
+    assert not app.config['START_BACKGROUND_TASKS']
+    migration.assert_not_called()
+    retention.assert_not_called()
+
+
+def test_old_worker_metrics_are_removed(config, monkeypatch, tmp_path):
+    (tmp_path / 'metrics-123.json').write_text('{}')
+    (tmp_path / 'other.txt').write_text('')
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+
+    config['on_starting'](None)
+
+    assert [path.name for path in tmp_path.iterdir()] == ['other.txt']
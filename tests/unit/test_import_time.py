@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+# Seconds importing the app may take, override with IMPORT_BUDGET_SECONDS
+# on slow machines
+IMPORT_BUDGET_SECONDS = float(os.getenv('IMPORT_BUDGET_SECONDS', 2.0))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+MEASURE_IMPORT = """
+import json, sys, time
+start = time.perf_counter()
+import api.app
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'pandas': 'pandas' in sys.modules,
+    'mapping': api.app.get_mapping_load_seconds() is not None,
+}))
+"""
+
+
+def measure_import() -> dict:
+    """Import the app in a fresh interpreter"""
+    result = subprocess.run([sys.executable, '-c', MEASURE_IMPORT],
+                            cwd=ROOT, capture_output=True, text=True,
+                            check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_importing_the_app_does_not_load_the_mapping():
+    measured = measure_import()
+
+    assert not measured['pandas']
+    assert not measured['mapping']
+
+
+def test_import_time_budget():
+    # Best of a few runs to leave out a cold disk cache
+    seconds = min(measure_import()['seconds'] for _ in range(3))
+
+    assert seconds < IMPORT_BUDGET_SECONDS, (
+        f'import api.app took {seconds:.2f} s, '
+        f'the budget is {IMPORT_BUDGET_SECONDS} s'
+    )
@@ -0,0 +1,122 @@
+import json
+import logging
+
+import pytest
+from api import app as app_module
+from api.logs import JsonFormatter
+
+
+def make_client(app, **config):
+    logged_app = app_module.create_app({
+        'TESTING': True,
+        'UPLOAD_FOLDER': app.config['UPLOAD_FOLDER'],
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'ENABLE_SSO': False,
+        **config
+    })
+    return logged_app.test_client()
+
+
+def logged_lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out
+            .splitlines()]
+
+
+def test_json_format():
+    """Extra fields and exceptions end up in the JSON object"""
+    try:
+        raise ValueError('broken')
+    except ValueError as e:
+        record = logging.getLogger('api.test').makeRecord(
+            'api.test', logging.ERROR, __file__, 1, 'Failed %s', ('x',),
+            (type(e), e, e.__traceback__), extra={'file_id': 'id1'}
+        )
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry['level'] == 'ERROR'
+    assert entry['logger'] == 'api.test'
+    assert entry['message'] == 'Failed x'
+    assert entry['file_id'] == 'id1'
+    assert 'ValueError: broken' in entry['exception']
+    assert 'request_id' not in entry
+
+
+def test_request_id_is_generated(client):
+    first = client.get('/api/auth/status').headers['X-Request-Id']
+    second = client.get('/api/auth/status').headers['X-Request-Id']
+
+    assert first and second and first != second
+
+
+@pytest.mark.parametrize('request_id, kept', [
+    ('0f8b3e52-5d1c-4a8e-9f2c-6d0e7a1b2c3d', True),
+    ('bad id', False),
+    ('x' * 65, False),
+])
+def test_request_id_from_proxy(client, request_id, kept):
+    response = client.get('/api/auth/status',
+                          headers={'X-Request-Id': request_id})
+
+    assert (response.headers['X-Request-Id'] == request_id) == kept
+
+
+def test_logs_carry_request_id(app, capsys):
+    client = make_client(app, REQUEST_TIMING=True)
+
+    response = client.get('/api/auth/status',
+                          headers={'X-Request-Id': 'request-1'})
+
+    entries = logged_lines(capsys)
+    assert entries[-1]['logger'] == 'api.requests'
+    assert entries[-1]['request_id'] == 'request-1'
+    assert entries[-1]['status'] == response.status_code
+
+
+def test_unsampled_requests_only_log_warnings(app, capsys):
+    client = make_client(app, REQUEST_TIMING=True, SLOW_QUERY_MS=1e-9,
+                         LOG_SAMPLE_RATE=0)
+
+    client.get('/api/admin/departments')
+
+    loggers = {entry['logger'] for entry in logged_lines(capsys)}
+    assert 'api.requests' not in loggers
+    assert 'api.db' in loggers
+
+
+def test_debug_messages_are_not_formatted_when_disabled(app, capsys):
+    """Arguments are only formatted for records that are logged"""
+    formatted = []
+
+    class Argument:
+        def __str__(self):
+            formatted.append(True)
+            return 'argument'
+
+    make_client(app, LOG_LEVEL='INFO')
+    logging.getLogger('api.convert').debug('Converted %s', Argument())
+    assert formatted == []
+
+    make_client(app, LOG_LEVEL='DEBUG')
+    logging.getLogger('api.convert').debug('Converted %s', Argument())
+    assert formatted
+    assert logged_lines(capsys)[-1]['message'] == 'Converted argument'
+
+
+def test_text_format(app, capsys):
+    make_client(app, LOG_FORMAT='text')
+
+    logging.getLogger('api.test').warning('Plain %s', 'text')
+
+    assert capsys.readouterr().out.rstrip().endswith(
+        'WARNING [None] api.test: Plain text'
+    )
+
+
+def test_configuring_again_replaces_the_handler(app, capsys):
+    make_client(app)
+    make_client(app)
+
+    logging.getLogger('api.test').warning('Once')
+
+    assert len(capsys.readouterr().out.splitlines()) == 1
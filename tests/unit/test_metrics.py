@@ -0,0 +1,89 @@
+from api.metrics import MetricsRegistry
+
+
+def make_registry(directory=None):
+    registry = MetricsRegistry(directory)
+    registry.counter('uploads_total', 'Reports uploaded.')
+    registry.gauge('load_seconds', 'Load time.')
+    registry.histogram('latency_seconds', 'Latency.', (0.1, 1.0))
+    return registry
+
+
+def test_render_prometheus_format():
+    """Histograms are rendered with cumulative buckets"""
+    registry = make_registry()
+    registry.inc('uploads_total')
+    registry.inc('uploads_total', 2)
+    registry.set('load_seconds', 1.5)
+    for value in (0.05, 0.1, 0.5, 3):
+        registry.observe('latency_seconds', value, route='/api/files')
+
+    assert registry.render() == (
+        '# HELP uploads_total Reports uploaded.\n'
+        '# TYPE uploads_total counter\n'
+        'uploads_total 3\n'
+        '# HELP load_seconds Load time.\n'
+        '# TYPE load_seconds gauge\n'
+        'load_seconds 1.5\n'
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{route="/api/files",le="0.1"} 2\n'
+        'latency_seconds_bucket{route="/api/files",le="1.0"} 3\n'
+        'latency_seconds_bucket{route="/api/files",le="+Inf"} 4\n'
+        'latency_seconds_sum{route="/api/files"} 3.65\n'
+        'latency_seconds_count{route="/api/files"} 4\n'
+    )
+
+
+def test_label_values_are_escaped():
+    registry = make_registry()
+    registry.inc('uploads_total', source='a "quoted" \\ value')
+
+    assert 'uploads_total{source="a \\"quoted\\" \\\\ value"} 1' in \
+        registry.render()
+
+
+def test_workers_are_aggregated(tmp_path, mocker):
+    """Counters and histograms are summed, gauges take the maximum"""
+    worker1 = make_registry(str(tmp_path))
+    worker2 = make_registry(str(tmp_path))
+    worker1.inc('uploads_total', 2)
+    worker1.set('load_seconds', 1.0)
+    worker1.observe('latency_seconds', 0.5)
+    worker2.inc('uploads_total', 3)
+    worker2.set('load_seconds', 2.0)
+    worker2.observe('latency_seconds', 0.05)
+
+    mocker.patch('os.getpid', return_value=1)
+    worker1.flush()
+    mocker.patch('os.getpid', return_value=2)
+    rendered = worker2.render()
+
+    assert 'uploads_total 5\n' in rendered
+    assert 'load_seconds 2.0\n' in rendered
+    assert 'latency_seconds_count 2\n' in rendered
+    assert 'latency_seconds_bucket{le="0.1"} 1\n' in rendered
+    assert sorted(p.name.split('-')[1] for p in tmp_path.iterdir()) == \
+        ['1', '2']
+
+
+def test_recycled_pid_keeps_earlier_values(tmp_path, mocker):
+    """A worker reusing the PID of a stopped one writes its own file"""
+    mocker.patch('os.getpid', return_value=1)
+    stopped = make_registry(str(tmp_path))
+    stopped.inc('uploads_total', 2)
+    stopped.flush()
+    worker = make_registry(str(tmp_path))
+    worker.inc('uploads_total', 3)
+
+    assert 'uploads_total 5\n' in worker.render()
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_collectors_report_external_counts():
+    registry = make_registry()
+    registry.collectors.append(
+        lambda: [('uploads_total', {'source': 'cache'}, 7)]
+    )
+
+    assert 'uploads_total{source="cache"} 7\n' in registry.render()
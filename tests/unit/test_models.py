@@ -0,0 +1,74 @@
+import datetime
+import json
+
+from api.db.models import Metadata, BearerToken, Department, Benchmark, \
+    Hostname, Result
+
+
+def reference_to_dict(obj):
+    """The original introspective serializer, kept as reference output"""
+    result_dict = {}
+    hidden_fields = set(getattr(obj, "__hidden_fields__", set()))
+
+    for column in obj.__table__.columns:
+        if column.foreign_keys or column.name in hidden_fields:
+            continue
+
+        value = getattr(obj, column.name)
+        if isinstance(value, datetime.datetime):
+            if (
+                hasattr(obj, "__utc_timestamp_fields__") and
+                column.name in obj.__utc_timestamp_fields__
+            ):
+                value = value.replace(tzinfo=datetime.timezone.utc)
+
+            value = value.isoformat()
+        result_dict[column.name] = value
+
+    for rel in obj.__mapper__.relationships:
+        if rel.key not in hidden_fields:
+            related_obj = getattr(obj, rel.key)
+            if related_obj is not None and hasattr(related_obj, "to_dict"):
+                result_dict[rel.key] = reference_to_dict(related_obj)
+            else:
+                result_dict[rel.key] = None
+
+    return result_dict
+
+
+def test_metadata_serialization_is_identical(app, bootstrap_full):
+    """Compiled serializers produce byte-identical JSON"""
+    with app.app_context():
+        # Include a row without any relationships set
+        app.db.session.add(Metadata(id='file_id4', filename='bare.json'))
+        app.db.session.commit()
+
+        rows = app.db.session.query(Metadata).all()
+        expected = json.dumps([reference_to_dict(row) for row in rows])
+
+        assert json.dumps([row.to_dict() for row in rows]) == expected
+        assert json.dumps(Metadata.to_dicts(rows)) == expected
+
+
+def test_other_models_serialization_is_identical(app, bootstrap_full):
+    """Hidden fields and UTC timestamps are handled like before"""
+    with app.app_context():
+        for model in (BearerToken, Department, Benchmark, Hostname, Result):
+            rows = app.db.session.query(model).all()
+            assert rows
+            expected = json.dumps([reference_to_dict(row) for row in rows])
+
+            assert json.dumps([row.to_dict() for row in rows]) == expected
+            assert json.dumps(model.to_dicts(rows)) == expected
+
+
+def test_hidden_fields_are_not_serialized(app, bootstrap_full):
+    """Hidden fields never show up, not even through to_dicts"""
+    with app.app_context():
+        tokens = BearerToken.to_dicts(
+            app.db.session.query(BearerToken).all()
+        )
+        assert all('token' not in token for token in tokens)
+
+        metadata = Metadata.to_dicts(app.db.session.query(Metadata).all())
+        assert all('ip_address' not in row for row in metadata)
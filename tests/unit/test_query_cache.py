@@ -0,0 +1,48 @@
+from api.db.db_cache import QueryCache
+
+
+def test_cache_hit_and_miss():
+    """Values are returned for the generation they were stored in"""
+    cache = QueryCache(4)
+    assert cache.get('key', 0) is None
+
+    cache.set('key', 0, {'ids': ['a']})
+    assert cache.get('key', 0) == {'ids': ['a']}
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_newer_generation_clears_cache():
+    """Seeing a newer generation invalidates every entry"""
+    cache = QueryCache(4)
+    cache.set('key1', 0, 'value1')
+    cache.set('key2', 0, 'value2')
+
+    assert cache.get('key1', 1) is None
+    assert len(cache) == 0
+
+
+def test_older_generation_is_bypassed():
+    """Results computed for an outdated generation are never stored"""
+    cache = QueryCache(4)
+    cache.set('key', 2, 'new')
+    cache.set('key', 1, 'old')
+
+    assert cache.get('key', 1) is None
+    assert cache.get('key', 2) == 'new'
+
+
+def test_least_recently_used_is_evicted():
+    """The cache never grows beyond its maximum size"""
+    cache = QueryCache(2)
+    cache.set('key1', 0, 'value1')
+    cache.set('key2', 0, 'value2')
+
+    # Touch key1 so key2 becomes the least recently used
+    cache.get('key1', 0)
+    cache.set('key3', 0, 'value3')
+
+    assert len(cache) == 2
+    assert cache.get('key2', 0) is None
+    assert cache.get('key1', 0) == 'value1'
+    assert cache.get('key3', 0) == 'value3'